@@ -0,0 +1,29 @@
+#!/bin/sh
+# Data-parallel training on CPUs (gloo), one process per rank.
+#
+#   ./launch_ddp.sh <nproc_per_node> [main.py args]
+#   ./launch_ddp.sh scaling [main.py args]    # ranks of $RANKS, one by one
+#
+# Several machines : NNODES, NODE_RANK, MASTER_ADDR & MASTER_PORT.
+set -e
+
+run() {
+    N=$1
+    shift
+    torchrun --nnodes="${NNODES:-1}" --node_rank="${NODE_RANK:-0}" \
+        --nproc_per_node="$N" --master_addr="${MASTER_ADDR:-127.0.0.1}" \
+        --master_port="${MASTER_PORT:-29500}" \
+        main.py --distributed true "$@"
+}
+
+if [ "$1" = "scaling" ]; then
+    shift
+    # throughput of each is added to <out_dir>/<name>/scaling.json
+    for N in ${RANKS:-1 2 4 8 16}; do
+        run "$N" --bench_steps "${BENCH_STEPS:-200}" "$@"
+    done
+else
+    N=${1:?usage: launch_ddp.sh <nproc_per_node>|scaling [args]}
+    shift
+    run "$N" "$@"
+fi
@@ -230,22 +230,37 @@ class MyDataLoaderIter(_DataLoaderIter):
             if self.num_workers > 0:
                 self._shutdown_workers()
 
+    # iterator of sampled indices ('_sampler_iter' since torch 1.0)
+    _sampler_iter_keys = ('sample_iter', '_sampler_iter')
+
     def __getstate__(self):
         # log.debug("pickling")
-        state_list = ['sample_iter', 'rcvd_idx', 'reorder_dict',
-                      'batches_outstanding']
+        state_list = ['sample_iter', '_sampler_iter', '_num_yielded',
+                      'rcvd_idx', 'reorder_dict', 'batches_outstanding']
         state = dict()
         for key, value in self.__dict__.items():
             if key in state_list:
-                if key == 'sample_iter':
-                    # generator to list (generator can't be pickled)
+                if key in self._sampler_iter_keys:
+                    # generator to list (generator can't be pickled), and
+                    # the rest of it back to the live iterator, which
+                    # pickling mustn't consume (e.g. checkpoint snapshots)
                     value = list(value)
+                    self.__dict__[key] = iter(value)
                 state.update({key:value})
         return state
 
+    def skip(self, num_batches):
+        """Skips batches by their sampled indices, without loading them"""
+        for key in self._sampler_iter_keys:
+            if key in self.__dict__:
+                for _ in range(num_batches):
+                    next(self.__dict__[key])
+        if '_num_yielded' in self.__dict__:
+            self._num_yielded += num_batches
+
     def __setstate__(self, state):
         for key, value in state.items():
-            if key == 'sample_iter':
+            if key in self._sampler_iter_keys:
                 # list to generator
                 value = (val for val in value)
             self.__dict__.update({key:value})
@@ -276,8 +291,20 @@ class DataScheduler(object):
         self.__dict__ = state
 
     def reset(self):
+        sampler = self._dataloader.sampler
+        if hasattr(sampler, 'set_epoch'):  # e.g. DistributedSampler
+            sampler.set_epoch(self.step.epoch)
         self._batch_iter = iter(self._dataloader)
 
+    def seek(self, epoch, batch):
+        """Moves to (epoch, batch) of a scheduler over the same data without
+        its pickle, e.g. ranks of --distributed resuming their own shards
+        at the position of the main process"""
+        self.step.epoch = epoch
+        self.step.batch = batch
+        self.reset()  # the sampler of the epoch
+        self._batch_iter.skip(batch)
+
     def next(self):
         self.step.increase()
         self._batch = next(self._batch_iter, None)
@@ -292,8 +319,11 @@ class DataScheduler(object):
 
     def load_from_pickle(self, file_path):
         with open(file_path, 'rb') as f:
-            loaded = pickle.load(f)
-            self._update_recursively(self, loaded)
+            self.load_from_bytes(f.read())
+
+    def load_from_bytes(self, data):
+        # pickled as save_as_pickle does (e.g. in checkpoints)
+        self._update_recursively(self, pickle.loads(data))
 
     def _update_recursively(self, tar, src):
         # Updates state dict recursively preserving original attributes
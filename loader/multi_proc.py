@@ -4,7 +4,6 @@ import multiprocessing as mp
 import os
 
 import re
-import spacy
 # import nltk # NOTE not available on python 3.6.x
 from tqdm import tqdm
 
@@ -170,6 +169,7 @@ class CorpusMultiProcessor(LargeFileMultiProcessor):
 
     def _get_tokenizer(self, tokenizer):
         if tokenizer == "spacy":
+            import spacy  # slow to import, only for this tokenizer
             spacy_en = spacy.load('en')
             return lambda s: [tok.text for tok in spacy_en.tokenizer(s)]
         elif tokenizer == "nltk": # NOTE : not working on Python 3.6.x
@@ -248,6 +248,7 @@ class CorpusTagMultiProcessor(LargeFileMultiProcessor):
         tag_list = list()
         token_cnt = Counter()
         tag_cnt = Counter()
+        import spacy
         nlp = spacy.load('en_core_web_sm')
 
         def process_line(line):
@@ -1,22 +1,44 @@
+import sys
+from time import time
+_startup = (time(), len(sys.modules))  # for --profile_startup
+
 import logging
-import os
-
-from loader.data import CorpusDataset, CorpusPOSDataset
-from loader.process import process_main_corpus, process_corpus_tag
-from test.test import Tester
-from test.visualize import Visualizer
-from train.train import Trainer
-from train.network import Network
+
 from utils.parser import parser
-from utils.utils import Config, set_logger, prepare_paths
+from utils.utils import (Config, StartupProfiler, set_logger, prepare_paths,
+                         set_random_seed, main_process_first)
 
+# NOTE : modules of each mode are imported in its own branch below, so that
+# a mode doesn't pay for importing the others (and their dependencies).
 
 log = logging.getLogger('main')
 
+
+def load_inference_network(cfg, names):
+    """From --bundle if given, otherwise from checkpoints in log_dir"""
+    if cfg.bundle:
+        from train.bundle import load_bundle
+        net = load_bundle(cfg.bundle, cfg, names)
+    else:
+        from loader.vocab import Vocab
+        from train.network import InferenceNetwork
+        vocab = Vocab.unpickle(cfg.processed_vocab_path)
+        net = InferenceNetwork(cfg, vocab, names)
+    if cfg.quantize:
+        from test.quantize import quantize_network
+        quantize_network(net)
+    return net
+
+
 if __name__ == '__main__':
     # Parsing arguments and set configs
     args = parser.parse_args()
     cfg = Config.init_from_parsed_args(args)
+    if cfg.distributed:  # a rank of launch_ddp.sh
+        from train.distributed import init_distributed
+        init_distributed(cfg)
+    profiler = StartupProfiler(cfg.profile_startup, _startup)
+    profiler.mark('base imports')
 
     # Set all the paths
     prepare_paths(cfg)
@@ -24,6 +46,98 @@ if __name__ == '__main__':
     # Logger
     set_logger(cfg)
     log = logging.getLogger('main')
+    profiler.mark('config & logger')
+
+    # Run GAN trainings from a stage in parallel (each a process of main.py)
+    if cfg.fork > 0:
+        from train.stage import fork_runs
+        fork_runs(cfg, sys.argv[1:])
+        log.info('End of program.')
+        sys.exit()
+
+    # Save the autoencoder of the latest checkpoint in log_dir as a stage
+    if cfg.export_ae:
+        from train.stage import export_stage
+        export_stage(cfg, cfg.export_ae)
+        log.info('End of program.')
+        sys.exit()
+
+    # Archive the latest checkpoint in log_dir (fp16)
+    if cfg.archive_ckpt:
+        from train.checkpoint import archive_checkpoint, latest_checkpoint
+        ckpt_path = latest_checkpoint(cfg.log_dir)
+        if ckpt_path is None:
+            raise Exception("Can't find checkpoints in %s" % cfg.log_dir)
+        archive_checkpoint(ckpt_path, cfg.archive_ckpt)
+        log.info('End of program.')
+        sys.exit()
+
+    # Export modules in log_dir as an inference bundle
+    if cfg.export_bundle:
+        from loader.vocab import Vocab
+        from train.bundle import BUNDLE_MODULES, export_bundle
+        from train.checkpoint import saved_module_names
+        from train.network import InferenceNetwork
+        names = list(BUNDLE_MODULES)
+        if 'dec2' in saved_module_names(cfg.log_dir):
+            names.append('dec2')
+        vocab = Vocab.unpickle(cfg.processed_vocab_path)
+        export_bundle(InferenceNetwork(cfg, vocab, names),
+                      cfg.export_bundle, names)
+        log.info('End of program.')
+        sys.exit()
+
+    # Export the sampler (the generator & a decoder) as static graphs
+    if cfg.export_sampler or cfg.sampler_bench:
+        from test.sampler import (export_sampler, parse_batch_sizes,
+                                  SamplerBenchmark)
+        net = load_inference_network(cfg, ['gen', cfg.gen_decoder])
+        if cfg.export_sampler:
+            export_sampler(net.gen, getattr(net, cfg.gen_decoder), cfg,
+                           cfg.export_sampler,
+                           parse_batch_sizes(cfg.sampler_batch_sizes))
+        if cfg.sampler_bench:
+            SamplerBenchmark(net)
+        log.info('End of program.')
+        sys.exit()
+
+    # Export encoder, generator & a decoder step as ONNX graphs (and/or
+    # check their parity with PyTorch)
+    if cfg.export_onnx or cfg.check_onnx:
+        from test.onnx_export import check_onnx_parity, export_onnx
+        net = load_inference_network(
+            cfg, ['enc', 'reg', 'gen', cfg.gen_decoder])
+        if cfg.export_onnx:
+            export_onnx(net, cfg.export_onnx, cfg.gen_decoder, cfg.onnx_opset)
+        if cfg.check_onnx or cfg.onnx_parity:
+            check_onnx_parity(net, cfg.check_onnx or cfg.export_onnx,
+                              cfg.gen_decoder, atol=cfg.onnx_atol)
+        else:
+            log.warning('Skipped the ONNX parity check! (--onnx_parity)')
+        log.info('End of program.')
+        sys.exit()
+
+    # Generate text (with the generator & a decoder only)
+    if cfg.generate > 0:
+        from test.generate import TextGenerator
+        profiler.mark('mode imports')
+        net = load_inference_network(cfg, ['gen', cfg.gen_decoder])
+        profiler.mark('network')
+        profiler.report()
+        TextGenerator(net)
+        log.info('End of program.')
+        sys.exit()
+
+    # Serve autoencode/sample/interpolate requests
+    if cfg.serve:
+        from test.server import InferenceServer
+        profiler.mark('mode imports')
+        net = load_inference_network(cfg, ['enc', 'reg', 'gen', 'dec'])
+        profiler.mark('network')
+        profiler.report()
+        InferenceServer(net)
+        log.info('End of program.')
+        sys.exit()
 
     # Preprocessing & make dataset
     # if cfg.data_name = 'pos':
@@ -31,28 +145,50 @@ if __name__ == '__main__':
     #     vocab_pos = process_pos_corpus(cfg, 'split')
     #     corpus = CorpusPOSDataset(cfg.processed_train_path,
     #                               cfg.pos_data_path)
+    from loader.data import CorpusDataset, CorpusPOSDataset
+    from loader.process import process_main_corpus, process_corpus_tag
+    profiler.mark('data imports')
 
-    if cfg.pos_tag:
-        vocab, vocab_tag = process_corpus_tag(cfg)
-        corpus_train = CorpusPOSDataset(cfg.processed_train_path,
-                                        cfg.pos_data_path)
+    with main_process_first(cfg):  # preprocessed once with --distributed
+        if cfg.pos_tag:
+            vocab, vocab_tag = process_corpus_tag(cfg)
+            corpus_train = CorpusPOSDataset(cfg.processed_train_path,
+                                            cfg.pos_data_path)
+        else:
+            vocab = process_main_corpus(cfg)
+            vocab_tag = None
+            corpus_train = CorpusDataset(cfg.processed_train_path)
+            corpus_test = CorpusDataset(cfg.processed_test_path)
+    profiler.mark('preprocessing')
+
+    # Mode to run
+    if cfg.encode:
+        from test.encode import CorpusEncoder as Mode
+    elif cfg.nn_audit:
+        from test.code_index import MemorizationAuditor as Mode
+    elif cfg.quant_report:
+        from test.quantize import QuantizationReport as Mode
+    elif cfg.distill:
+        from train.distill import Distiller as Mode
+    elif not (cfg.test or cfg.visualize):
+        from train.train import Trainer as Mode
+    elif cfg.test:
+        from test.test import Tester as Mode
     else:
-        vocab = process_main_corpus(cfg)
-        vocab_tag = None
-        corpus_train = CorpusDataset(cfg.processed_train_path)
-        corpus_test = CorpusDataset(cfg.processed_test_path)
+        from test.visualize import Visualizer as Mode
+    if cfg.distributed and Mode.__name__ != 'Trainer':
+        raise Exception('--distributed is for training only!')
+    from train.network import Network
+    profiler.mark('mode imports')
 
-    # Build network
+    # Build network (initial weights depend on the seed as well)
+    set_random_seed(cfg)
     net = Network(cfg, corpus_train, corpus_test, vocab, vocab_tag)
+    profiler.mark('network')
+    profiler.report()
 
-    # Train
-    if not (cfg.test or cfg.visualize):
-        Trainer(net)
-    # Test
-    else:
-        if cfg.test:
-            Tester(net)
-        else:
-            Visualizer(net)
+    # Encode / NN audit / Quantization report / Distill / Train / Test /
+    # Visualize
+    Mode(net)
 
     log.info('End of program.')
@@ -11,6 +11,8 @@ from utils.utils import to_gpu
 
 log = logging.getLogger('main')
 
+MAX_CONSTANTS = 32  # cached by BaseModule.constant per module
+
 
 class BaseModule(nn.Module):
     def __init__(self):
@@ -32,6 +34,21 @@ class BaseModule(nn.Module):
         nn.utils.clip_grad_norm_(self.parameters(), self.cfg.clip)
         return self
 
+    def constant(self, name, size, value=0, dtype=None):
+        """Tensor filled with value on cfg.device, made once and reused for
+        the same name & size (e.g. initial states). Must not be modified!"""
+        dtype = dtype or self.cfg.dtype
+        key = (name, tuple(size), dtype)
+        constants = self.__dict__.setdefault('_constants', dict())
+        tensor = constants.get(key)
+        if tensor is None:
+            if len(constants) >= MAX_CONSTANTS:
+                constants.clear()  # e.g. many different batch sizes
+            tensor = torch.full(size, value, dtype=dtype,
+                                device=self.cfg.device)
+            constants[key] = tensor
+        return tensor
+
     def forward(self, *input):
         raise NotImplementedError
 
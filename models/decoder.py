@@ -10,7 +10,7 @@ from models.base_module import BaseModule
 from nn.bnlstm import LSTM, BNLSTMCell
 from torch.autograd import Variable
 from torch.nn.utils.rnn import pack_padded_sequence, pad_packed_sequence
-from utils.utils import to_gpu
+from utils.rng import rng
 from utils.writer import ResultWriter
 
 log = logging.getLogger('main')
@@ -27,11 +27,16 @@ class BaseDecoder(BaseModule):
         nn.utils.clip_grad_norm_(self.parameters(), self.cfg.clip)
         return self
 
+    def decode_ids(self, code, max_len):
+        """Token ids of greedy free running decoding : [bsz, max_len]"""
+        with torch.no_grad():
+            return self(code, max_len=max_len).id.ids_tensor
+
     def make_noise_size_of(self, *size):
-        noise = Variable(torch.ones(*size))
-        noise = to_gpu(self.cfg.cuda, noise)
-        noise.data.normal_(0, 1)
-        return noise
+        if len(size) == 1 and not isinstance(size[0], int):
+            size = size[0]  # e.g. torch.Size
+        return rng.normal('dec_noise', size, device=self.cfg.device,
+                          dtype=self.cfg.dtype)
 
 
 class DecoderInPack(object):
@@ -144,10 +149,11 @@ class DecoderRNN(BaseDecoder):
         if self.cfg.dec_embed:
             embed_out_w = self.linear_w(output_w)
             cosim_w = self._compute_cosine_sim(embed_out_w, self.embed_w.embed)
-            prob_w = F.log_softmax(cosim_w * self.cfg.embed_temp, 2)
+            prob_w = F.log_softmax(
+                (cosim_w * self.cfg.embed_temp).float(), 2)
             return self.packer_w.new(probs=prob_w, embeds=embed_out_w)
         else:
-            prob_w = F.log_softmax(self.linear_w(output_w), 2)
+            prob_w = F.log_softmax(self.linear_w(output_w).float(), 2)
             return self.packer_w.new(probs=prob_w)
         #_, id_w = torch.max(cosim_w, 2)
 
@@ -169,9 +175,7 @@ class DecoderRNN(BaseDecoder):
         all_prob_w = []  # for grad norm scaling
         all_id_w = []
 
-        finished = torch.ByteTensor(batch_size, 1).zero_()
-        finished = to_gpu(self.cfg.cuda,
-                          Variable(finished, requires_grad=False))
+        finished = self._init_finished(batch_size)
 
         for i in range(max_len):  # for each step
             # Decoder
@@ -181,13 +185,14 @@ class DecoderRNN(BaseDecoder):
                 embed_out_w = self.linear_w(output_w)
                 cosim_w = self._compute_cosine_sim(embed_out_w,
                                                    self.embed_w.embed)
-                prob_w = F.log_softmax(cosim_w * self.cfg.embed_temp, 2)
+                prob_w = F.log_softmax(
+                    (cosim_w * self.cfg.embed_temp).float(), 2)
                 _, id_w = torch.max(cosim_w, 2)
                 # if eos token has already appeared, fill zeros
                 id_w, embed_out_w, finished = \
                     self._pads_after_eos(id_w, embed_out_w, finished)
             else:
-                prob_w = F.log_softmax(self.linear_w(output_w), 2)
+                prob_w = F.log_softmax(self.linear_w(output_w).float(), 2)
                 _, id_w = torch.max(prob_w, 2)
                 id_w, finished = self._pad_ids_after_eos(id_w, finished)
             # NOTE : words_prob is not considered here
@@ -213,6 +218,41 @@ class DecoderRNN(BaseDecoder):
         else:
             return self.packer_w.new(probs=prob_w, ids=id_w)
 
+    def decode_ids(self, code, max_len):
+        """Same ids as _decode_free_run, but for inference only. Skips
+        log_softmax (argmax doesn't change) and keeping the outputs of every
+        step, and stops as soon as all the sentences have emitted <eos>."""
+        with torch.no_grad():
+            code_w = code.unsqueeze(1)
+            batch_size = code_w.size(0)
+            ids = torch.zeros(batch_size, max_len, dtype=torch.long,
+                              device=self.cfg.device)
+
+            embed_in_w = self.embed_w(self._get_sos_batch(batch_size,
+                                                          self.vocab_w))
+            state_w = self._init_hidden(batch_size, self.cfg.hidden_size_w)
+            finished = self._init_finished(batch_size)
+
+            for i in range(max_len):
+                input_w = torch.cat([embed_in_w, code_w], 2)
+                output_w, state_w = self.decoder(input_w, state_w)
+                id_w = self._greedy_ids(output_w)
+                id_w, finished = self._pad_ids_after_eos(id_w, finished)
+                ids[:, i] = id_w[:, 0]
+                if finished.all():
+                    break  # the rest is already filled with pads
+                embed_in_w = self.embed_w(id_w)
+        return ids
+
+    def _greedy_ids(self, output_w):
+        if self.cfg.dec_embed:
+            score_w = self._compute_cosine_sim(
+                self.linear_w(output_w), self.embed_w.embed)
+        else:
+            score_w = self.linear_w(output_w)
+        _, id_w = torch.max(score_w, 2)
+        return id_w
+
     def _init_weights(self):
         # unifrom initialization in the range of [-0.1, 0.1]
         initrange = 0.1
@@ -229,39 +269,37 @@ class DecoderRNN(BaseDecoder):
             self.linear_t.bias.data.fill_(0)
 
     def _init_hidden(self, bsz, nhidden):
-        nlayers = self.cfg.nlayers
-        zeros1 = Variable(torch.zeros(nlayers, bsz, nhidden))
-        zeros2 = Variable(torch.zeros(nlayers, bsz, nhidden))
-        return (to_gpu(self.cfg.cuda, zeros1), to_gpu(self.cfg.cuda, zeros2))
+        # layers of the lstm, not cfg.nlayers (of the encoder)
+        size = (self.decoder.num_layers, bsz, nhidden)
+        # lstm doesn't modify its initial state, so the same zeros are reused
+        return (self.constant('h0', size), self.constant('c0', size))
 
     def _init_state(self, bsz):
-        zeros = Variable(torch.zeros(self.cfg.nlayers, bsz, self.cfg.nhidden))
-        return to_gpu(self.cfg.cuda, zeros)
+        size = (self.cfg.nlayers, bsz, self.cfg.nhidden)
+        return self.constant('state', size)
+
+    def _init_finished(self, bsz):
+        return self.constant('finished', (bsz, 1), False, torch.bool)
 
     def _get_sos_batch(self, bsz, vocab):
-        sos_ids = to_gpu(self.cfg.cuda, Variable(torch.ones(bsz, 1).long()))
-        sos_ids.fill_(vocab.SOS_ID)
-        return sos_ids
+        return self.constant('sos', (bsz, 1), vocab.SOS_ID, torch.long)
 
     def _get_tag_batch(self, size, num):
-        return to_gpu(self.cfg.cuda, Variable(torch.ones(*size, 1))) * num
+        return self.constant('tag', tuple(size) + (1,), num)
 
     def _pads_after_eos(self, ids, out, finished):
         # zero ids after eos
         assert(self.vocab_w.PAD_ID == 0)
-        finished = finished + ids.eq(self.vocab_w.EOS_ID).byte()
-        ids_mask = finished.eq(0)
-        ids = ids * ids_mask.long()
-        out_mask = ids_mask.unsqueeze(2).expand_as(out)
-        out = out * out_mask.float()
+        finished = finished | ids.eq(self.vocab_w.EOS_ID)
+        ids = ids.masked_fill(finished, 0)
+        out = out.masked_fill(finished.unsqueeze(2), 0)
         return ids, out, finished
 
     def _pad_ids_after_eos(self, ids, finished):
         # zero ids after eos
         assert(self.vocab_w.PAD_ID == 0)
-        finished = finished + ids.eq(self.vocab_w.EOS_ID).byte()
-        ids_mask = finished.eq(0)
-        ids = ids * ids_mask.long()
+        finished = finished | ids.eq(self.vocab_w.EOS_ID)
+        ids = ids.masked_fill(finished, 0)
         return ids, finished
 
     def _compute_cosine_sim(self, out_embed, ref_embed):
@@ -277,6 +315,69 @@ class DecoderRNN(BaseDecoder):
         return cos_sim  # [bsz, (max_len,) vocab_size]
 
 
+class ShortlistLinear(nn.Linear):
+    """Output layer over a shortlist of the vocabulary. forward gives scores
+    over the whole vocabulary (-inf out of the list), so that argmax and
+    log_softmax of DecoderRNN stay the same. short_forward gives the scores
+    over the shortlist only."""
+    def __init__(self, in_features, shortlist, vocab_size):
+        super(ShortlistLinear, self).__init__(in_features, len(shortlist))
+        self.vocab_size = vocab_size
+        self.register_buffer('shortlist', shortlist)
+
+    def forward(self, input):
+        scores = self.short_forward(input)
+        full = scores.new_full(scores.size()[:-1] + (self.vocab_size,),
+                               float('-inf'))
+        full[..., self.shortlist] = scores
+        return full
+
+    def short_forward(self, input):
+        return super(ShortlistLinear, self).forward(input)
+
+
+class StudentDecoder(DecoderRNN):
+    """DecoderRNN with a smaller lstm and/or an output layer over a shortlist
+    of the vocabulary, distilled from a trained decoder (see train.distill).
+    Takes the same codes and returns the same DecoderOutPack."""
+    def __init__(self, cfg, embed_w, hidden_size, shortlist=None):
+        super(StudentDecoder, self).__init__(cfg, embed_w)
+        self.hidden_size = hidden_size
+        input_size = cfg.embed_size_w + cfg.hidden_size_w  # same codes
+        self.decoder = nn.LSTM(input_size=input_size,
+                               hidden_size=hidden_size,
+                               num_layers=1,
+                               dropout=cfg.dropout,
+                               batch_first=True)
+        if shortlist is not None:
+            if cfg.dec_embed:
+                raise Exception("Shortlist can't be used with dec_embed!")
+            self.linear_w = ShortlistLinear(hidden_size, shortlist,
+                                            cfg.vocab_size_w)
+        elif cfg.dec_embed:
+            self.linear_w = nn.Linear(hidden_size, cfg.embed_size_w)
+        else:
+            self.linear_w = nn.Linear(hidden_size, cfg.vocab_size_w)
+        self._init_weights()
+
+    @property
+    def shortlist(self):
+        if isinstance(self.linear_w, ShortlistLinear):
+            return self.linear_w.shortlist
+        return None
+
+    def _init_hidden(self, bsz, nhidden):
+        # state size of the student, whatever the callers of DecoderRNN pass
+        return super(StudentDecoder, self)._init_hidden(bsz, self.hidden_size)
+
+    def _greedy_ids(self, output_w):
+        if self.shortlist is None:
+            return super(StudentDecoder, self)._greedy_ids(output_w)
+        # argmax over the shortlist, without scattering to the vocabulary
+        _, id_w = torch.max(self.linear_w.short_forward(output_w), 2)
+        return self.shortlist[id_w]
+
+
 class DecoderCNN(BaseDecoder):
     def __init__(self, cfg, embed):
         super(DecoderCNN, self).__init__()
@@ -333,7 +434,7 @@ class DecoderOutPackerCNN(object):
     def new(self, embeds):
         cosim = self._compute_cosine_sim(embeds)
         _, ids = torch.max(cosim, dim=2)
-        probs = F.log_softmax(cosim * self.cfg.embed_temp, 2)
+        probs = F.log_softmax((cosim * self.cfg.embed_temp).float(), 2)
         #probs = probs.view(-1, len(self.vocab))
         return DecoderOutPack(self, probs, ids, embeds)
 
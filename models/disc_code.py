@@ -7,6 +7,7 @@ import torch.nn.functional as F
 from torch.autograd import Variable
 
 from models.base_module import BaseModule
+from nn.mlp import MLPStack
 from utils.writer import ResultWriter
 from utils.utils import to_gpu
 
@@ -47,6 +48,7 @@ class CodeDiscriminator(BaseModule):
             self.layers.append(activation)
             self.add_module("activation"+str(i+1), activation)
 
+        self.stack = MLPStack(self.layers)
         self.wgan_linear = nn.Linear(layer_sizes[-1], noutput) # WGAN
         self.pred_linear = nn.Linear(layer_sizes[-1], noutput) # for prediction
 
@@ -64,19 +66,29 @@ class CodeDiscriminator(BaseModule):
 
         self._init_weights()
 
+        # parameters clamped for WGAN (all except pred_linear)
+        self._clamped_params = [
+            param for name, param in self.named_parameters()
+            if not name.startswith('pred_linear.')]
+        if cfg.gan_clamp_after_step:
+            # Network clamps them after each step of optim_disc (see
+            # clamp_weights_), so they stay clamped from the start on
+            self.clamp_weights_()
+            self.register_load_state_dict_post_hook(
+                lambda module, incompatible_keys: module.clamp_weights_())
+
     # override
-    @property
-    def tester(self, zero_grad=True):
-        if zero_grad:
-            self.zero_grad()
-        return self.train(True) # turn on bath norm!
+    def train(self, mode=True):
+        # batch norm of the critic always normalizes with batch statistics,
+        # in evaluation as well (its running statistics are never used)
+        super(CodeDiscriminator, self).train(mode)
+        for module in self.modules():
+            if isinstance(module, nn.modules.batchnorm._BatchNorm):
+                module.train(True)
+        return self
 
     def forward(self, x):
-        for i, layer in enumerate(self.layers):
-            try:
-                x = layer(x)
-            except:
-                import pdb; pdb.set_trace()
+        x = self.stack(x)
         x_wgan = torch.mean(self.wgan_linear(x))
         # x_pred = Variable(x.data, requires_grad=True)
         # x_pred = F.sigmoid(self.pred_linear(x_pred))
@@ -85,24 +97,21 @@ class CodeDiscriminator(BaseModule):
     def _init_weights(self):
         init_std = 0.02
         for layer in self.layers:
-            try:
+            if isinstance(layer, (nn.Linear, nn.BatchNorm1d)):
                 layer.weight.data.normal_(0, init_std)
                 layer.bias.data.fill_(0)
-            except:
-                pass
 
     def clamp_weights(self):
-        # clamp parameters to a cube
-        check_clamped = False
-        from copy import deepcopy
-        for name, param in self.named_parameters():
-            if 'pred_linear' in name:
-                continue
-            #param_copy = deepcopy(param)
-            param.data.clamp_(-self.cfg.gan_clamp, self.cfg.gan_clamp)
-            # WGAN [min,max] clamp (default:0.01)
-            #if not param_copy.equal(param):
-            #    check_clamped = True
-        #if not check_clamped:
-        #    log.info('no clamping')
+        # before a forward (unless clamped after optimizer steps instead)
+        if not self.cfg.gan_clamp_after_step:
+            self.clamp_weights_()
+        return self
+
+    def clamp_weights_(self):
+        # clamp parameters to a cube : WGAN [min,max] clamp (default:0.01)
+        with torch.no_grad():
+            torch._foreach_clamp_min_(self._clamped_params,
+                                      -self.cfg.gan_clamp)
+            torch._foreach_clamp_max_(self._clamped_params,
+                                      self.cfg.gan_clamp)
         return self
@@ -8,6 +8,7 @@ import torch.nn.functional as F
 
 from nn.attention import MultiLinear4D, WordAttention, LayerAttention
 from utils.writer import ResultWriter
+from utils.rng import rng
 from utils.utils import to_gpu
 
 from models.base_module import BaseModule
@@ -205,8 +206,8 @@ class EncoderDisc(BaseModule):
         bsz, lengths, embed_size = tensor.size()
         pad_len = (self.cfg.max_len) - lengths
         if pad_len > 0:
-            pads = torch.zeros([bsz, pad_len, embed_size])
-            pads = Variable(pads, requires_grad=False).cuda()
+            pads = self.constant('pads', (bsz, pad_len, embed_size),
+                                 dtype=tensor.dtype)
             return torch.cat((tensor, pads), dim=1)
         else:
             return tensor
@@ -218,15 +219,15 @@ class EncoderDisc(BaseModule):
         masks = []
         for conv in self.convs_enc_no_bias:
             x = conv(x) # [bsz, 1, 1, max_len]
-            zeros = x.eq(0).data.cpu()
-            mask = torch.zeros(x.size()).masked_fill_(zeros, float('-inf'))
-            masks.append(Variable(mask, requires_grad=False).cuda()) # mask pads as 0s
+            zeros = x.detach().eq(0)
+            mask = torch.zeros_like(x.detach()).masked_fill_(zeros, float('-inf'))
+            masks.append(mask) # mask pads as 0s
         return masks
 
     def _reparameterize(self, mu, logvar):
         if self.training:
             std = logvar.mul(0.5).exp_()
-            eps = Variable(std.data.new(std.size()).normal_())
+            eps = rng.normal_like('enc_disc', std.detach())
             return eps.mul(std).add_(mu)
         else:
             return mu
@@ -7,6 +7,7 @@ import torch.nn.functional as F
 from models.base_module import BaseModule
 from torch.autograd import Variable
 from torch.nn.utils.rnn import pack_padded_sequence
+from utils.rng import rng
 from utils.utils import to_gpu
 
 log = logging.getLogger('main')
@@ -36,10 +37,7 @@ class BaseEncoder(BaseModule):
 
     def _add_gaussian_noise_to(self, code):
         # gaussian noise
-        noise = torch.normal(mean=torch.zeros(code.size()),
-                             std=self.noise_radius)
-        noise = to_gpu(self.cfg.cuda, Variable(noise))
-        return code + noise
+        return code + rng.normal_like('enc_noise', code, self.noise_radius)
 
     def clip_grad_norm_(self):
         nn.utils.clip_grad_norm_(self.parameters(), self.cfg.clip)
@@ -127,8 +125,8 @@ class EncoderCNN(BaseEncoder):
         bsz, lengths, embed_size = tensor.size()
         pad_len = (self.cfg.max_len) - lengths
         if pad_len > 0:
-            pads = torch.zeros([bsz, pad_len, embed_size])
-            pads = Variable(pads, requires_grad=False).cuda()
+            pads = self.constant('pads', (bsz, pad_len, embed_size),
+                                 dtype=tensor.dtype)
             return torch.cat((tensor, pads), dim=1)
         else:
             return tensor
@@ -189,9 +187,7 @@ class VariationalRegularizer(BaseModule):
             self._sigma = sigma = torch.exp(logvar * 0.5)
             #log_sigma = self.sigma_layers(enc_h)
             #self._sigma = sigma = torch.exp(log_sigma)
-            std = np.random.normal(0, 1, size=sigma.size())
-            std = Variable(torch.from_numpy(std).float(), requires_grad=False)
-            std = to_gpu(self.cfg.cuda, std)
+            std = rng.normal_like('reg', sigma)
             code = mu + sigma*std
         else:
             code = mu
@@ -258,8 +254,8 @@ class CodeSmoothingRegularizer(BaseModule):
             self._sigma = sigma = self.sigma_layers(code)
             #logvar = self.sigma_layers(code)
             #self._sigma = sigma = logvar.mul(0.5).exp_() # always positive
-            eps = Variable(sigma.data.new(sigma.size()).normal_())
-            noise = eps.detach().mul(sigma)
+            eps = rng.normal_like('reg', sigma.detach())
+            noise = eps.mul(sigma)
             #self._var = std.mean().data[0]
             #import pdb; pdb.set_trace()
             code = code + noise
@@ -276,7 +272,7 @@ class CodeSmoothingRegularizer(BaseModule):
     def _reparameterize(self, mu, logvar):
         if self.is_with_var:
             std = logvar.mul(0.5).exp_()
-            eps = Variable(std.data.new(std.size()).normal_())
+            eps = rng.normal_like('reg', std.detach())
             var = eps.mul(std)
             self._var = std.mean().data[0]
             return var.add_(mu)
@@ -3,7 +3,9 @@ import torch.nn as nn
 from torch.autograd import Variable
 
 from models.base_module import BaseModule
+from nn.mlp import MLPStack
 from utils.writer import ResultWriter
+from utils.rng import rng
 from utils.utils import to_gpu
 
 
@@ -57,11 +59,9 @@ class BaseGenerator(BaseModule):
         # Initialization with Gaussian distribution: N(0, 0.02)
         init_std = 0.02
         for layer in self.layers:
-            try:
+            if isinstance(layer, (nn.Linear, nn.BatchNorm1d)):
                 layer.weight.data.normal_(0, init_std)
                 layer.bias.data.fill_(0)
-            except:
-                pass
 
 
 class Generator(BaseGenerator):
@@ -75,6 +75,7 @@ class Generator(BaseGenerator):
         # z_size(in) --(layer1)-- 300 --(layer2)-- 300 --(layer3)-- nhidden(out)
         self._with_noise = False
         self.layers = self.stack_layers(cfg.z_size, cfg.hidden_size_w)
+        self.stack = MLPStack(self.layers)
         self._init_weights()
 
     def with_noise(self, noise):
@@ -83,14 +84,10 @@ class Generator(BaseGenerator):
 
     def forward(self, noise):
         assert noise.size(1) == self.cfg.z_size
-        x = noise
-        for i, layer in enumerate(self.layers):
-            x = layer(x)
+        x = self.stack(noise)
 
         if self._with_noise:
-            noise = torch.normal(mean=torch.zeros(x.size()), std=0.1)
-            noise = to_gpu(self.cfg.cuda, Variable(noise))
-            x = x + noise
+            x = x + rng.normal_like('gen_noise', x, 0.1)
             with_noise = False
         return x
 
@@ -103,16 +100,15 @@ class Generator(BaseGenerator):
     def get_noise(self, num_samples=None):
         if num_samples is None:
             num_samples = self.cfg.batch_size
-        noise = Variable(torch.ones(num_samples, self.cfg.z_size))
-        noise = to_gpu(self.cfg.cuda, noise)
-        noise.data.normal_(0, 1)
-        return noise
+        return rng.normal('z', (num_samples, self.cfg.z_size),
+                          device=self.cfg.device, dtype=self.cfg.dtype)
 
 
 class ReversedGenerator(BaseGenerator):
     def __init__(self, cfg):
         super(ReversedGenerator, self).__init__(cfg)
         self.layers = self.stack_layers(cfg.hidden_size_w, cfg.z_size)
+        self.stack = MLPStack(self.layers)
         #self.layers = self.stack_layers(cfg.hidden_size_w, cfg.hidden_size_w)
         # self.mu = nn.Linear(cfg.hidden_size_w, cfg.z_size)
         # self.logvar = nn.Sequential(
@@ -127,9 +123,7 @@ class ReversedGenerator(BaseGenerator):
 
     def forward(self, x):
         assert x.size(1) == self.cfg.hidden_size_w
-        for i, layer in enumerate(self.layers):
-            x = layer(x)
-        return x
+        return self.stack(x)
         # mu = self.mu(x)
         # logvar = self.logvar(x)
         # code = self._reparameterize(mu, logvar)
@@ -137,5 +131,5 @@ class ReversedGenerator(BaseGenerator):
 
     def _reparameterize(self, mu, logvar):
         self._sigma = sigma = logvar.mul(0.5).exp_()
-        eps = torch.tensor(sigma.data.new(sigma.size()).normal_())
+        eps = rng.normal_like('rev', sigma.detach())
         return mu + sigma*eps
@@ -0,0 +1,100 @@
+import torch
+import torch.nn as nn
+import torch.nn.functional as F
+
+
+class MLPStack(object):
+    """Runs a list of layers as blocks of Linear (-> BatchNorm1d) (->
+    activation), e.g. Generator.layers.
+
+    Layers stay registered in their module under their own names (layer1,
+    bn1, activation1, ...), so state dicts keep their keys. Linears and
+    activations are applied functionally, without the call of a module
+    each. In evaluation (batch norm with running statistics, no autograd)
+    batch norm is folded into the linear before it, whose weights are kept
+    until any of the parameters or statistics changes. The forward has no
+    python branches on tensor values, so it can be torch.compile'd.
+
+    The list is looked up on each call, as quantization swaps its layers
+    in place (see test.quantize.quantize_module).
+    """
+    def __init__(self, layers):
+        self.layers = layers
+        self._blocks = None
+        self._layer_ids = None
+        self._folded = dict()
+
+    def __call__(self, x):
+        for linear, bn, act in self.blocks():
+            if type(linear) is not nn.Linear:  # e.g. quantized
+                x = linear(x)
+                if bn is not None:
+                    x = bn(x)
+            elif bn is not None and not bn.training and \
+                    bn.running_var is not None and \
+                    not torch.is_grad_enabled():
+                x = F.linear(x, *self._fold(linear, bn))
+            else:
+                x = F.linear(x, linear.weight, linear.bias)
+                if bn is not None:
+                    x = bn(x)
+            if act is not None:
+                x = act(x)
+        return x
+
+    def blocks(self):
+        layer_ids = tuple(id(layer) for layer in self.layers)
+        if layer_ids != self._layer_ids:
+            self._blocks = self._build_blocks(self.layers)
+            self._layer_ids = layer_ids
+            self._folded.clear()
+        return self._blocks
+
+    @staticmethod
+    def _build_blocks(layers):
+        blocks = []
+        i = 0
+        while i < len(layers):
+            linear, bn, act = layers[i], None, None
+            i += 1
+            if i < len(layers) and isinstance(layers[i], nn.BatchNorm1d):
+                bn = layers[i]
+                i += 1
+            # (activations have no weight)
+            if i < len(layers) and not hasattr(layers[i], 'weight'):
+                act = _functional(layers[i])
+                i += 1
+            blocks.append((linear, bn, act))
+        return blocks
+
+    def _fold(self, linear, bn):
+        """weight & bias of linear followed by bn (with running statistics)"""
+        tensors = [linear.weight, linear.bias, bn.running_mean,
+                   bn.running_var, bn.weight, bn.bias]
+        key = tuple((t._version, t.data_ptr()) for t in tensors
+                    if t is not None)
+        cached = self._folded.get(id(linear))
+        if cached is not None and cached[0] == key:
+            return cached[1]
+        with torch.no_grad():
+            scale = torch.rsqrt(bn.running_var + bn.eps)
+            if bn.weight is not None:
+                scale = scale * bn.weight
+            bias = -bn.running_mean
+            if linear.bias is not None:
+                bias = bias + linear.bias
+            bias = bias * scale
+            if bn.bias is not None:
+                bias = bias + bn.bias
+            folded = (linear.weight * scale.unsqueeze(1), bias)
+        self._folded[id(linear)] = (key, folded)
+        return folded
+
+
+def _functional(activation):
+    if type(activation) is nn.ReLU:
+        return F.relu
+    if type(activation) is nn.LeakyReLU:
+        slope = activation.negative_slope
+        return lambda x: F.leaky_relu(x, slope)
+    return activation
@@ -0,0 +1,357 @@
+"""Nearest neighbour search over latent codes.
+
+ExactCodeIndex scans the (memory-mapped) codes block by block with matrix
+multiplications. IVFPQCodeIndex clusters the codes with k-means (inverted
+file), product-quantizes the residuals to 1 byte per subspace and scans only
+the few clusters closest to each query, optionally re-ranking the best
+candidates with exact distances. Both are plain NumPy.
+"""
+from collections import OrderedDict
+import logging
+import os
+import time
+
+import numpy as np
+import torch
+
+from test.encode import encode_batch
+
+log = logging.getLogger('main')
+odict = OrderedDict
+
+_BLOCK_SIZE = 65536  # number of codes compared at once in exact search
+_PQ_NUM_CENTROIDS = 256  # uint8 codes
+
+
+def squared_norms(x):
+    return np.einsum('ij,ij->i', x, x)
+
+
+def _merge_topk(dists, ids, new_dists, new_ids, k):
+    if dists is not None:
+        new_dists = np.concatenate([dists, new_dists], axis=1)
+        new_ids = np.concatenate([ids, new_ids], axis=1)
+    if new_dists.shape[1] > k:
+        top = np.argpartition(new_dists, k - 1, axis=1)[:, :k]
+        new_dists = np.take_along_axis(new_dists, top, axis=1)
+        new_ids = np.take_along_axis(new_ids, top, axis=1)
+    return new_dists, new_ids
+
+
+def _sort_topk(dists, ids):
+    order = np.argsort(dists, axis=1)
+    dists = np.take_along_axis(dists, order, axis=1)
+    ids = np.take_along_axis(ids, order, axis=1)
+    return np.sqrt(np.maximum(dists, 0)), ids
+
+
+def exact_search(queries, base, k, base_norms=None, block_size=_BLOCK_SIZE):
+    """k nearest rows of base (euclidean) for each query, scanning base in
+    blocks so that it can be a memmap larger than memory.
+
+    Returns:
+        dists (np.ndarray): [num_queries, k] float32, ascending
+        ids (np.ndarray): [num_queries, k] int64
+    """
+    queries = np.ascontiguousarray(queries, dtype=np.float32)
+    k = min(k, base.shape[0])
+    query_norms = squared_norms(queries)[:, None]
+    dists = ids = None
+    for start in range(0, base.shape[0], block_size):
+        block = np.asarray(base[start:start+block_size], dtype=np.float32)
+        if base_norms is None:
+            block_norms = squared_norms(block)
+        else:
+            block_norms = base_norms[start:start+block_size]
+        # ||q - x||^2 = ||q||^2 - 2 q.x + ||x||^2
+        block_dists = query_norms - 2 * queries.dot(block.T) + block_norms
+        block_ids = np.broadcast_to(
+            np.arange(start, start + block.shape[0]), block_dists.shape)
+        dists, ids = _merge_topk(dists, ids, block_dists, block_ids, k)
+    return _sort_topk(dists, ids)
+
+
+def kmeans(x, num_clusters, num_iters=20, seed=None):
+    """Lloyd's k-means. Empty clusters are re-seeded by random points.
+    With fewer points than clusters, points are repeated as initial
+    centroids (the duplicates end up as empty clusters)."""
+    rand = np.random.RandomState(seed)
+    x = np.asarray(x, dtype=np.float32)
+    if x.shape[0] == 0:
+        raise ValueError("No points to cluster!")
+    centroids = x[rand.choice(x.shape[0], num_clusters,
+                              replace=x.shape[0] < num_clusters)]
+    for i in range(num_iters):
+        _, assign = exact_search(x, centroids, 1)
+        assign = assign[:, 0]
+        order = np.argsort(assign, kind='stable')
+        clusters, starts, counts = np.unique(
+            assign[order], return_index=True, return_counts=True)
+        sums = np.add.reduceat(x[order], starts, axis=0)
+        centroids = x[rand.choice(x.shape[0], num_clusters)].copy()
+        centroids[clusters] = sums / counts[:, None]
+    return centroids
+
+
+class ExactCodeIndex(object):
+    kind = 'exact'
+
+    def __init__(self, codes, norms=None):
+        self.codes = codes
+        if norms is None:
+            norms = np.concatenate([
+                squared_norms(np.asarray(codes[i:i+_BLOCK_SIZE], np.float32))
+                for i in range(0, codes.shape[0], _BLOCK_SIZE)])
+        self.norms = norms
+
+    def __len__(self):
+        return self.codes.shape[0]
+
+    def search(self, queries, k=1):
+        return exact_search(queries, self.codes, k, self.norms)
+
+    def state_dict(self):
+        return dict(norms=self.norms)
+
+
+class IVFPQCodeIndex(object):
+    """Inverted file with product quantized residuals.
+
+    Codes of each cluster are stored contiguously (list_offsets delimits the
+    clusters in list_ids and pq_codes). A query scans nprobe clusters with
+    asymmetric distances computed from per-subspace lookup tables, and the
+    best k * rerank candidates are re-ranked exactly if codes are given.
+    """
+    kind = 'ivfpq'
+
+    def __init__(self, centroids, pq_centroids, list_offsets, list_ids,
+                 pq_codes, codes=None, nprobe=16, rerank=10):
+        self.centroids = centroids  # [nlist, dim]
+        self.pq_centroids = pq_centroids  # [m, 256, dim / m]
+        self.list_offsets = list_offsets  # [nlist + 1]
+        self.list_ids = list_ids  # [num_codes]
+        self.pq_codes = pq_codes  # [num_codes, m] uint8
+        self.codes = codes
+        self.nprobe = nprobe
+        self.rerank = rerank
+        self._pq_norms = np.einsum('mcd,mcd->mc', pq_centroids, pq_centroids)
+        self._pq_centroids_t = pq_centroids.transpose(0, 2, 1).copy()
+        self._table_offsets = np.arange(
+            pq_centroids.shape[0], dtype=np.int32) * _PQ_NUM_CENTROIDS
+
+    def __len__(self):
+        return self.list_ids.shape[0]
+
+    @classmethod
+    def build(cls, codes, nlist, m, train_size=100000, num_iters=20,
+              seed=None, **kwargs):
+        num_codes, dim = codes.shape
+        if dim % m != 0:
+            raise ValueError("Code size %d is not divisible by %d subspaces"
+                             % (dim, m))
+        rand = np.random.RandomState(seed)
+        sample = np.sort(rand.choice(
+            num_codes, min(train_size, num_codes), replace=False))
+        sample = np.asarray(codes[sample], dtype=np.float32)
+        if nlist > sample.shape[0]:
+            log.warning('nlist %d is more than the %d training codes, '
+                        'reduced to %d' % (nlist, sample.shape[0],
+                                           sample.shape[0]))
+            nlist = sample.shape[0]
+
+        log.info('Training coarse quantizer (nlist: %d)' % nlist)
+        centroids = kmeans(sample, nlist, num_iters, seed)
+        _, assign = exact_search(sample, centroids, 1)
+        residuals = (sample - centroids[assign[:, 0]]).reshape(
+            sample.shape[0], m, dim // m)
+        log.info('Training product quantizer (m: %d)' % m)
+        pq_centroids = np.stack([
+            kmeans(residuals[:, i], _PQ_NUM_CENTROIDS, num_iters, seed)
+            for i in range(m)])
+
+        log.info('Adding %d codes to the index' % num_codes)
+        assign = np.zeros(num_codes, dtype=np.int64)
+        pq_codes = np.zeros([num_codes, m], dtype=np.uint8)
+        for start in range(0, num_codes, _BLOCK_SIZE):
+            block = np.asarray(codes[start:start+_BLOCK_SIZE], np.float32)
+            _, block_assign = exact_search(block, centroids, 1)
+            block_assign = block_assign[:, 0]
+            residuals = (block - centroids[block_assign]).reshape(
+                block.shape[0], m, dim // m)
+            for i in range(m):
+                _, sub_codes = exact_search(
+                    residuals[:, i], pq_centroids[i], 1)
+                pq_codes[start:start+block.shape[0], i] = sub_codes[:, 0]
+            assign[start:start+block.shape[0]] = block_assign
+
+        list_ids = np.argsort(assign, kind='stable')
+        list_offsets = np.zeros(nlist + 1, dtype=np.int64)
+        list_offsets[1:] = np.cumsum(np.bincount(assign, minlength=nlist))
+        return cls(centroids, pq_centroids, list_offsets, list_ids,
+                   pq_codes[list_ids], codes=codes, **kwargs)
+
+    def search(self, queries, k=1):
+        queries = np.asarray(queries, dtype=np.float32)
+        num_queries, dim = queries.shape
+        m = self.pq_centroids.shape[0]
+        num_cand = k * self.rerank if self.codes is not None else k
+        _, probes = exact_search(queries, self.centroids, self.nprobe)
+
+        dists = np.full([num_queries, k], np.inf, dtype=np.float32)
+        ids = np.zeros([num_queries, k], dtype=np.int64)
+        for q, (query, probe) in enumerate(zip(queries, probes)):
+            # lookup tables : [nprobe, m, 256]
+            residuals = (query - self.centroids[probe]).reshape(
+                len(probe), m, 1, dim // m)
+            tables = (np.square(residuals).sum(-1)
+                      - 2 * np.matmul(residuals, self._pq_centroids_t)[:, :, 0]
+                      + self._pq_norms)
+            starts = self.list_offsets[probe]
+            sizes = self.list_offsets[probe + 1] - starts
+            if sizes.sum() == 0:
+                continue
+            # positions of all the candidates in the inverted lists
+            which = np.repeat(np.arange(len(probe)), sizes)
+            pos = np.arange(sizes.sum()) - np.repeat(
+                np.cumsum(sizes) - sizes, sizes) + starts[which]
+            flat_pos = self.pq_codes[pos] + self._table_offsets
+            flat_pos += (which * (m * _PQ_NUM_CENTROIDS)).astype(
+                np.int32)[:, None]
+            cand_dists = tables.ravel().take(flat_pos).sum(1)
+            cand_ids = self.list_ids[pos]
+            cand_dists, cand_ids = _merge_topk(
+                None, None, cand_dists[None], cand_ids[None], num_cand)
+            if self.codes is not None:
+                cand_ids = np.sort(cand_ids[0])  # sequential memmap access
+                cand = np.asarray(self.codes[cand_ids], dtype=np.float32)
+                diff = cand - query
+                cand_dists = squared_norms(diff)[None]
+                cand_ids = cand_ids[None]
+                cand_dists, cand_ids = _merge_topk(
+                    None, None, cand_dists, cand_ids, k)
+            num = cand_ids.shape[1]
+            dists[q, :num], ids[q, :num] = cand_dists[0], cand_ids[0]
+        return _sort_topk(dists, ids)
+
+    def state_dict(self):
+        return dict(centroids=self.centroids, pq_centroids=self.pq_centroids,
+                    list_offsets=self.list_offsets, list_ids=self.list_ids,
+                    pq_codes=self.pq_codes)
+
+
+def save_index(index, file_path):
+    temp_path = '%s.%d.tmp' % (file_path, os.getpid())
+    with open(temp_path, 'wb') as f:
+        np.savez(f, kind=np.array(index.kind), **index.state_dict())
+    os.replace(temp_path, file_path)
+    log.info('Code index has been saved to : %s' % file_path)
+
+
+def load_index(file_path, codes, **kwargs):
+    loaded = np.load(file_path)
+    kind = str(loaded['kind'])
+    state = {key: loaded[key] for key in loaded.files if key != 'kind'}
+    log.info('Code index has been loaded from : %s' % file_path)
+    if kind == ExactCodeIndex.kind:
+        return ExactCodeIndex(codes, **state)
+    elif kind == IVFPQCodeIndex.kind:
+        return IVFPQCodeIndex(codes=codes, **state, **kwargs)
+    else:
+        raise Exception('Unknown index type : %s' % kind)
+
+
+def load_or_build_index(cfg, split='train'):
+    """Index over log_dir/codes_{split}.npy (made by --encode {split}),
+    saved as log_dir/index_{split}_{index_type}.npz next to checkpoints."""
+    code_path = os.path.join(cfg.log_dir, 'codes_%s.npy' % split)
+    if not os.path.exists(code_path):
+        raise Exception("Can't find %s. Run with --encode %s first."
+                        % (code_path, split))
+    codes = np.load(code_path, mmap_mode='r')
+    index_path = os.path.join(
+        cfg.log_dir, 'index_%s_%s.npz' % (split, cfg.index_type))
+    ivfpq_kwargs = dict(nprobe=cfg.index_nprobe,
+                        rerank=max(cfg.index_rerank, 1))
+
+    if (os.path.exists(index_path) and
+            os.path.getmtime(index_path) >= os.path.getmtime(code_path)):
+        index = load_index(index_path, codes, **ivfpq_kwargs)
+    elif cfg.index_type == 'exact':
+        index = ExactCodeIndex(codes)
+        save_index(index, index_path)
+    elif cfg.index_type == 'ivfpq':
+        index = IVFPQCodeIndex.build(codes, cfg.index_nlist, cfg.index_pq_m,
+                                     seed=cfg.seed, **ivfpq_kwargs)
+        save_index(index, index_path)
+    else:
+        raise Exception('Unknown index type : %s' % cfg.index_type)
+
+    if cfg.index_type == 'ivfpq' and cfg.index_rerank <= 0:
+        index.codes = None  # PQ distances only, codes are never touched
+    return index
+
+
+class MemorizationAuditor(object):
+    """Finds the nearest training sentences of generated codes.
+
+    Held-out test sentences give the reference distribution of distances
+    to the nearest training code : a generated code closer to its nearest
+    neighbour than the 5th percentile of those is counted as memorized,
+    and a generated sentence identical to its nearest one as copied.
+    """
+    def __init__(self, net):
+        log.info("Nearest neighbour audit start!")
+        self.net = net
+        self.cfg = net.cfg
+        net.load_modules()
+        self.index = load_or_build_index(self.cfg, 'train')
+        self.audit()
+
+    def search_generated(self, num_samples=None, k=1):
+        self.net.set_modules_train_mode(True)  # same as Trainer
+        with torch.no_grad():
+            code = self.net.gen(self.net.gen.get_noise(num_samples))
+        return code, self._search(code, k)
+
+    def search_text(self, batch, k=1):
+        self.net.set_modules_train_mode(False)
+        code = encode_batch(self.net, batch)
+        return code, self._search(code, k)
+
+    def neighbour_text(self, ids):
+        vocab = self.net.vocab_w
+        return [vocab.ids2text(self.net.corpus_train[i]) for i in ids]
+
+    def audit(self):
+        cfg = self.cfg
+        _, (dists_real, _) = self.search_text(self.net.data_eval.next())
+        code_fake, (dists_fake, ids_fake) = self.search_generated(
+            cfg.eval_size)
+        dists_real, dists_fake = dists_real[:, 0], dists_fake[:, 0]
+        with torch.no_grad():
+            decoded = self.net.dec.tester(code_fake, max_len=cfg.max_len)
+        text_fake = decoded.get_text_batch()
+        text_nearest = self.neighbour_text(ids_fake[:, 0])
+        threshold = np.percentile(dists_real, 5)
+
+        result = odict(
+            nn_dist_real=float(dists_real.mean()),
+            nn_dist_fake=float(dists_fake.mean()),
+            memorized=float((dists_fake < threshold).mean()),
+            copied=float(np.mean([x == y for x, y in
+                                  zip(text_fake, text_nearest)])),
+        )
+        log.info('| Audit |' + ''.join(
+            ' %s : %.8f |' % (name, value) for name, value in result.items()))
+        for i in np.argsort(dists_fake)[:cfg.log_nsample]:
+            log.info('[G] %s\n[N] %s (%.4f)' % (
+                text_fake[i], text_nearest[i], dists_fake[i]))
+        return result
+
+    def _search(self, code, k):
+        start = time.time()
+        dists, ids = self.index.search(code.cpu().numpy(), k)
+        elapsed = (time.time() - start) * 1000
+        log.info('Searched %d queries in %.1f ms (%.2f ms/query)' % (
+            code.size(0), elapsed, elapsed / code.size(0)))
+        return dists, ids
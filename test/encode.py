@@ -0,0 +1,145 @@
+import json
+import logging
+import os
+import time
+
+import numpy as np
+import torch
+from torch.utils.data import Dataset, DataLoader
+
+from loader.data import Batch
+
+log = logging.getLogger('main')
+
+
+class IndexedCorpus(Dataset):
+    """Wraps a corpus dataset to return (line index, token ids) pairs
+    starting from an offset, so that sorted batches can be written back
+    to the rows they came from."""
+    def __init__(self, corpus, start, end):
+        self.corpus = corpus
+        self.start = start
+        self.end = end
+
+    def __len__(self):
+        return self.end - self.start
+
+    def __getitem__(self, idx):
+        idx += self.start
+        return idx, self.corpus[idx]
+
+
+def collate_indexed(batch):
+    """Sorts (index, ids) pairs in descending order of length and returns
+    plain lists, as Batch can't be pickled back from loader processes."""
+    batch = [(idx, ids) for idx, ids in batch if len(ids) > 0]
+    if not batch:
+        return None
+    batch.sort(key=lambda x: len(x[1]), reverse=True)
+    indices, batch = zip(*batch)
+    return list(indices), list(batch), [len(ids) for ids in batch]
+
+
+def encode_batch(net, batch):
+    """embed_w -> enc -> reg.without_var (modes are set by the caller)"""
+    with torch.no_grad():
+        embed = net.embed_w(batch.enc_src.id)
+        enc_h = net.enc(embed, batch.enc_src.len)
+        return net.reg.without_var(enc_h)
+
+
+class CorpusEncoder(object):
+    """Encodes the whole preprocessed corpus into a memory-mapped code file.
+
+    Sentences go through embed_w -> enc -> reg.without_var and their codes
+    are written to row i of log_dir/codes_{split}.npy (a .npy file that can
+    be opened with np.load(mmap_mode='r')), i being the line index of the
+    sentence in the preprocessed corpus. Rows of empty lines are left zero.
+    The number of encoded lines is saved to codes_{split}.json whenever the
+    memmap is flushed, and encoding resumes from there when re-launched.
+    """
+    def __init__(self, net):
+        log.info("Encoding start!")
+        self.net = net
+        self.cfg = cfg = net.cfg
+        self.split = cfg.encode
+        self.corpus = {'train': net.corpus_train,
+                       'test': net.corpus_test}[self.split]
+        self.dtype = np.float16 if cfg.encode_fp16 else np.float32
+        self.code_path = os.path.join(
+            cfg.log_dir, 'codes_%s.npy' % self.split)
+        self.progress_path = os.path.join(
+            cfg.log_dir, 'codes_%s.json' % self.split)
+
+        net.load_modules()
+        net.set_modules_train_mode(False)
+        self.encode()
+
+    def encode(self):
+        cfg = self.cfg
+        num_sents = len(self.corpus)
+        codes, start = self._open_codes(num_sents, cfg.hidden_size_w)
+        if start >= num_sents:
+            log.info('All %d sentences are already encoded : %s'
+                     % (num_sents, self.code_path))
+            return codes
+
+        dataloader = DataLoader(
+            IndexedCorpus(self.corpus, start, num_sents),
+            batch_size=cfg.encode_batch_size, shuffle=False,
+            num_workers=cfg.encode_workers,
+            collate_fn=collate_indexed,
+            pin_memory=cfg.cuda)
+        log.info('Encoding %d sentences from line %d to : %s'
+                 % (num_sents - start, start, self.code_path))
+
+        done = start
+        last_time = start_time = time.time()
+        last_done = start
+        for i, batch in enumerate(dataloader):
+            if batch is not None:
+                indices, batch, lengths = batch
+                batch = Batch(cfg, self.net.vocab_w, batch, lengths)
+                codes[indices] = self._encode_batch(batch)
+            done = min(start + (i + 1) * cfg.encode_batch_size, num_sents)
+
+            if (i + 1) % cfg.log_interval == 0:
+                self._save_progress(codes, done, num_sents)
+                now = time.time()
+                log.info('| Encoded : %d/%d | %.1f sents/sec |' % (
+                    done, num_sents, (done - last_done) / (now - last_time)))
+                last_time, last_done = now, done
+
+        self._save_progress(codes, done, num_sents)
+        elapsed = time.time() - start_time
+        log.info('Encoding done! %d sentences in %.1f secs (%.1f sents/sec)'
+                 % (done - start, elapsed, (done - start) / elapsed))
+        return codes
+
+    def _encode_batch(self, batch):
+        code = encode_batch(self.net, batch)
+        return code.cpu().numpy().astype(self.dtype)
+
+    def _open_codes(self, num_sents, code_size):
+        shape = (num_sents, code_size)
+        if os.path.exists(self.code_path) and \
+                os.path.exists(self.progress_path):
+            with open(self.progress_path, 'r') as f:
+                progress = json.load(f)
+            codes = np.load(self.code_path, mmap_mode='r+')
+            if codes.shape == shape and codes.dtype == self.dtype:
+                log.info('Resuming encoding from : %s' % self.progress_path)
+                return codes, progress['encoded']
+            log.info('Existing codes mismatch %s %s. Encoding from scratch.'
+                     % (shape, np.dtype(self.dtype).name))
+            del codes
+        codes = np.lib.format.open_memmap(
+            self.code_path, mode='w+', dtype=self.dtype, shape=shape)
+        return codes, 0
+
+    def _save_progress(self, codes, done, num_sents):
+        codes.flush()  # codes must hit the disk before the progress does
+        temp_path = self.progress_path + '.tmp'
+        with open(temp_path, 'w') as f:
+            json.dump(dict(encoded=done, total=num_sents), f)
+        os.replace(temp_path, self.progress_path)
@@ -1,11 +1,12 @@
 # -*- coding: utf-8 -*-
 from functools import partial
 
-from collections import Counter
+from collections import Counter, namedtuple
+import multiprocessing as mp
+import os
 import string
 import re
 import math
-import copy
 
 from utils.writer import ResultWriter
 
@@ -51,12 +52,11 @@ def exact_match_score(prediction, ground_truth):
     return (normalize_answer(prediction) == normalize_answer(ground_truth))
 
 def ngram(n, iterable):
-    iterable = iter(iterable)
-    window = [next(iterable) for _ in range(n)]
-    while True:
-        yield window
-        window.append(next(iterable))
-        window = window[1:]
+    # NOTE : raising StopIteration inside a generator is a RuntimeError
+    #        since python 3.7 (PEP 479), so windows are sliced explicitly
+    items = list(iterable)
+    for i in range(len(items) - n + 1):
+        yield items[i:i+n]
 
 def bleu_ngram(n, candidate, references):
     pred = [' '.join(window) for window in ngram(n, candidate)]
@@ -103,7 +103,7 @@ def bleu_score(prediction, ground_truths, num_ngrams):
     return bleu * penalty
 
 def chunk(a, b):
-    b = copy.deepcopy(b)
+    b = list(b)  # shallow copy is enough for the list of strings
     c, u = 0, 0 # c: number of chunks, u: number of words associated with chunk
 
     # Find a common sequence (= a chunk)
@@ -116,10 +116,10 @@ def chunk(a, b):
         return n
 
     def _find(corpus, x, start=0):
-        for i, word in enumerate(corpus[start:]):
-            if word == x:
-                return start + i
-        return -1
+        try:
+            return corpus.index(x, start)
+        except ValueError:
+            return -1
 
     for i in range(len(a)):
         max_len = 0
@@ -170,45 +170,150 @@ def metric_max_over_ground_truths(metric_fn, prediction, ground_truths):
     return max(scores_for_ground_truths)
 
 
+# Indexed evaluation engine
+#   evaluate_sents / simple_evaluate used to normalize, tokenize and count
+#   n-grams of the same reference sentences over and over for every metric.
+#   References are now processed once into ReferenceIndex (cached by file and
+#   mtime when loaded from a file) and predictions once per evaluation. Scores
+#   are exactly the same as the metric functions above.
+
+_NUM_NGRAMS = 4
+_MIN_PARALLEL = 5000  # minimum number of predictions to use process pool
+_METRICS = ('em', 'f1', 'bleu', 'meteor')
+
+# norm : normalized string, tokens : list of tokens
+# ngrams : [Counter(1-grams), ..., Counter(n-grams)]
+#          (1-grams are counted by tokens, otherwise by tuples of tokens)
+_SentEntry = namedtuple('_SentEntry', 'norm, tokens, ngrams')
+
+
+def _make_entry(sent, num_ngrams=_NUM_NGRAMS):
+    norm = normalize_answer(sent)
+    tokens = norm.split()
+    ngrams = [Counter(tokens)]
+    for n in range(2, num_ngrams + 1):
+        ngrams.append(Counter(tuple(tokens[i:i+n])
+                              for i in range(len(tokens) - n + 1)))
+    return _SentEntry(norm, tokens, ngrams)
+
+
+def _score_entries(pred, ref):
+    """Returns (em, f1, bleu, meteor) of a prediction against a reference,
+    equivalent to the corresponding metric functions with a single truth."""
+    # exact match
+    em = (pred.norm == ref.norm)
+
+    # f1 & meteor
+    num_same = sum((pred.ngrams[0] & ref.ngrams[0]).values())
+    if num_same == 0:
+        f1 = meteor = 0
+    else:
+        precision = 1.0 * num_same / len(pred.tokens)
+        recall = 1.0 * num_same / len(ref.tokens)
+        f1 = (2 * precision * recall) / (precision + recall)
+        fmean = 10.0 * precision * recall / (recall + 9 * precision)
+        c, u = chunk(pred.tokens, ref.tokens)
+        frag = 1.0 * c / u
+        penalty = 0.5 * (frag ** 3)
+        meteor = fmean * (1 - penalty)
+
+    # bleu
+    score = 0
+    any_match = 0
+    num_ngrams = len(pred.ngrams)
+    for i in range(num_ngrams):
+        num_pred = len(pred.tokens) - i  # number of (i+1)-grams
+        same = sum((pred.ngrams[i] & ref.ngrams[i]).values())
+        precision = 0.0 if same == 0 else same / num_pred
+        if precision > 0:
+            any_match += 1
+            score += math.log(precision)
+    if any_match == 0:
+        bleu = 0.0
+    else:
+        num_pred = len(pred.tokens)
+        num_truth = len(ref.tokens)
+        if 1 <= num_pred <= num_truth:
+            penalty = math.exp(1 - 1.0 * num_truth / num_pred)
+        else:
+            penalty = 1
+        bleu = math.exp(score / num_ngrams) * penalty
+
+    return em, f1, bleu, meteor
+
+
+def _score_chunk(args):
+    predictions, ref_entries = args
+    return [_score_entries(_make_entry(pred), ref)
+            for pred, ref in zip(predictions, ref_entries)]
+
+
+class ReferenceIndex(object):
+    """Normalized & n-gram counted reference sentences."""
+    _cache = dict()  # file path -> (mtime, size, ReferenceIndex)
+
+    def __init__(self, sents):
+        self.entries = [_make_entry(sent) for sent in sents]
+
+    def __len__(self):
+        return len(self.entries)
+
+    @classmethod
+    def from_file(cls, file_path):
+        file_path = os.path.abspath(file_path)
+        stat = os.stat(file_path)
+        cached = cls._cache.get(file_path)
+        if cached is not None and cached[:2] == (stat.st_mtime, stat.st_size):
+            return cached[2]
+        with open(file_path) as f:
+            index = cls([line.strip() for line in f])
+        cls._cache[file_path] = (stat.st_mtime, stat.st_size, index)
+        return index
+
+    def score_batch(self, predictions, num_process=None):
+        """Scores predictions against references of the same position.
+        Returns a list of (em, f1, bleu, meteor) per sentence pair."""
+        predictions = list(predictions)[:len(self.entries)]
+        if num_process is None:
+            num_process = mp.cpu_count()
+        if len(predictions) < _MIN_PARALLEL or num_process <= 1:
+            return _score_chunk((predictions, self.entries))
+
+        size = math.ceil(len(predictions) / num_process)
+        chunks = [(predictions[i:i+size], self.entries[i:i+size])
+                  for i in range(0, len(predictions), size)]
+        with mp.Pool(processes=num_process) as pool:
+            results = pool.map(_score_chunk, chunks)
+        return [scores for result in results for scores in result]
+
+    def evaluate(self, predictions, num_process=None):
+        """Averaged scores over the sentence pairs (in percentage)"""
+        pair_scores = self.score_batch(predictions, num_process)
+        scores = {k: 0 for k in _METRICS}
+        total = 0
+        for pair_score in pair_scores:  # same summation order as before
+            total += 1
+            for k, score in zip(_METRICS, pair_score):
+                scores[k] += score
+        for k in _METRICS:
+            scores[k] = 100.0 * scores[k] / total
+        return scores
+
+
 # ref_dir : reference file directory. ex) '/path/to/directory/file.txt'
+# reference : list[string] or ReferenceIndex
 # predictions : list[string]. for example, ["he is a boy", "she went home"]
 # output : for example, {'meteor': 8.3064, 'bleu': 28.43696, 'em': 0.0, 'f1': 14.9253}
 # sample usage : print('ae eval:', eval.simple_evaluate(real_data, ae_data))
-def evaluate_sents(reference, predictions):
-    metrics = { # p = pred, g = ref
-        'em': lambda p, g: metric_max_over_ground_truths(exact_match_score, p, g),
-        'f1': lambda p, g: metric_max_over_ground_truths(f1_score, p, g),
-        'bleu': lambda p, g: bleu_score(p, g, 4),
-        'meteor': lambda p, g: metric_max_over_ground_truths(meteor_score, p, g),
-    }
-    scores = { k: 0 for k in metrics }
-    total = 0
-    for ref, pred in zip(reference, predictions):
-        total += 1
-        for k in metrics:
-            scores[k] += metrics[k](pred, [ref])
-    for k in metrics:
-        scores[k] = 100.0 * scores[k] / total
-    return scores
-
-# references : list[string]. for example, ["he is a boy", "she went home"]
+def evaluate_sents(reference, predictions, num_process=None):
+    if not isinstance(reference, ReferenceIndex):
+        # only the references paired with predictions are needed
+        reference = ReferenceIndex(list(reference)[:len(predictions)])
+    return reference.evaluate(predictions, num_process)
+
+# references : list[string] or ReferenceIndex
 # predictions : list[string]. for example, ["he is a boy", "she went home"]
 # output : for example, {'meteor': 8.3064, 'bleu': 28.43696, 'em': 0.0, 'f1': 14.9253}
 # sample usage : print('ae eval:', eval.simple_evaluate(real_data, ae_data))
-def simple_evaluate(references, predictions):
-    metrics = { # p = pred, g = ref
-        'em': lambda p, g: metric_max_over_ground_truths(exact_match_score, p, g),
-        'f1': lambda p, g: metric_max_over_ground_truths(f1_score, p, g),
-        'bleu': lambda p, g: bleu_score(p, g, 4),
-        'meteor': lambda p, g: metric_max_over_ground_truths(meteor_score, p, g),
-    }
-
-    scores = { k: 0 for k in metrics }
-    total = 0
-    for ref, pred in zip(references, predictions):
-        total += 1
-        for k in metrics:
-            scores[k] += metrics[k](pred, [ref])
-    for k in metrics:
-        scores[k] = 100.0 * scores[k] / total
-    return scores
+def simple_evaluate(references, predictions, num_process=None):
+    return evaluate_sents(references, predictions, num_process)
@@ -0,0 +1,69 @@
+import logging
+import os
+import time
+
+import torch
+
+from test.sampler import ExportedSampler
+from utils.utils import set_random_seed
+
+log = logging.getLogger('main')
+
+
+class TextGenerator(object):
+    """Samples cfg.generate sentences and streams them to a text file.
+
+    Noise is drawn in batches of cfg.gen_batch_size, mapped to codes by the
+    generator and decoded with the inference path of the chosen decoder.
+    Each batch is written and dropped right away, so memory stays constant
+    whatever the number of sentences.
+    """
+    def __init__(self, net):
+        self.net = net
+        self.cfg = cfg = net.cfg
+        self.dec = getattr(net, cfg.gen_decoder)
+        if cfg.sampler:
+            self.sampler = ExportedSampler(cfg.sampler)
+        else:
+            self.sampler = self.sample_eager
+        self.out_path = cfg.out or os.path.join(cfg.log_dir, 'generated.txt')
+
+        set_random_seed(cfg)
+        if cfg.gen_threads > 0:
+            torch.set_num_threads(cfg.gen_threads)
+        # generator in train mode (batch statistics) as in Trainer
+        net.gen.train(True)
+        self.dec.train(False)
+        self.generate()
+
+    def generate(self):
+        cfg = self.cfg
+        vocab = self.net.vocab_w
+        log.info('Generating %d sentences with %s to : %s'
+                 % (cfg.generate, cfg.gen_decoder, self.out_path))
+
+        done = 0
+        num_batch = 0
+        start_time = time.time()
+        with open(self.out_path, 'w') as f:
+            while done < cfg.generate:
+                # the last batch is sampled in full size as well, since
+                # batch statistics of the generator depend on it
+                noise = self.net.gen.get_noise(cfg.gen_batch_size)
+                ids = self.sampler(noise)
+                ids = ids[:cfg.generate - done].cpu().numpy()
+                f.write('\n'.join(vocab.ids2text_batch(ids)) + '\n')
+                f.flush()
+                done += len(ids)
+                num_batch += 1
+                if num_batch % cfg.log_interval == 0:
+                    log.info('| Generated : %d/%d | %.1f sents/sec |' % (
+                        done, cfg.generate, done / (time.time() - start_time)))
+
+        elapsed = time.time() - start_time
+        log.info('Generation done! %d sentences in %.1f secs (%.1f sents/sec)'
+                 % (done, elapsed, done / elapsed))
+
+    def sample_eager(self, noise):
+        with torch.no_grad():
+            return self.dec.decode_ids(self.net.gen(noise), self.cfg.max_len)
@@ -8,8 +8,11 @@ def load_kenlm():
     import kenlm
 
 
-def train_kenlm(net, decoded_text, global_step):
-    save_name = "generated_{}".format(global_step)
+def train_kenlm(net, decoded_text, global_step, name=None):
+    if name is None:
+        save_name = "generated_{}".format(global_step)
+    else:  # to avoid collisions between concurrent evaluations
+        save_name = "generated_{}_{}".format(name, global_step)
     save_dir = os.path.join(net.cfg.log_dir, 'kenlm')
     eval_path = os.path.join(net.cfg.data_dir, 'test.txt')
     data_path = os.path.join(save_dir, save_name+".txt")
@@ -0,0 +1,170 @@
+"""Cheap quality metrics in the latent code space.
+
+Real codes (from the encoder) and fake codes (from the generator) are
+already computed at every evaluation, so comparing their distributions gives
+a quality signal far more often than reverse PPL does.
+"""
+from collections import OrderedDict
+import logging
+import math
+
+import numpy as np
+import torch
+
+log = logging.getLogger('main')
+odict = OrderedDict
+
+
+class RunningMoments(object):
+    """Incremental mean & covariance merged batch by batch (Chan et al.)
+    Older batches are down-weighted by decay (1.0 : plain cumulative)."""
+    def __init__(self, decay=1.0):
+        self.decay = decay
+        self.n = 0.
+        self.mean = None
+        self.m2 = None
+
+    def update(self, x):
+        x = x.detach().double()
+        n_b = x.size(0)
+        mean_b = x.mean(0)
+        x_c = x - mean_b
+        m2_b = torch.mm(x_c.t(), x_c)
+        if self.mean is None:
+            self.n, self.mean, self.m2 = float(n_b), mean_b, m2_b
+            return self
+        self.n *= self.decay
+        self.m2 *= self.decay
+        n = self.n + n_b
+        delta = mean_b - self.mean
+        self.mean = self.mean + delta * (n_b / n)
+        self.m2 = self.m2 + m2_b + torch.ger(delta, delta) * (self.n * n_b / n)
+        self.n = n
+        return self
+
+    @property
+    def cov(self):
+        return self.m2 / max(self.n - 1., 1.)
+
+
+class RunningFeatureMean(object):
+    """Running mean of random Fourier features of the gaussian kernel."""
+    def __init__(self, decay=1.0):
+        self.decay = decay
+        self.n = 0.
+        self.mean = None
+
+    def update(self, features):
+        n_b = features.size(0)
+        mean_b = features.detach().double().mean(0)
+        if self.mean is None:
+            self.n, self.mean = float(n_b), mean_b
+            return self
+        self.n *= self.decay
+        n = self.n + n_b
+        self.mean = self.mean + (mean_b - self.mean) * (n_b / n)
+        self.n = n
+        return self
+
+
+def frechet_distance(mu1, cov1, mu2, cov2):
+    """||mu1 - mu2||^2 + Tr(C1 + C2 - 2(C1 C2)^(1/2))"""
+    mu1, mu2 = mu1.cpu().numpy(), mu2.cpu().numpy()
+    cov1, cov2 = cov1.cpu().numpy(), cov2.cpu().numpy()
+    # Tr((C1 C2)^(1/2)) = Tr((C1^(1/2) C2 C1^(1/2))^(1/2)) (symmetric PSD)
+    eigval, eigvec = np.linalg.eigh(cov1)
+    sqrt_cov1 = (eigvec * np.sqrt(np.clip(eigval, 0, None))).dot(eigvec.T)
+    middle = sqrt_cov1.dot(cov2).dot(sqrt_cov1)
+    tr_covmean = np.sqrt(np.clip(np.linalg.eigvalsh(middle), 0, None)).sum()
+    diff = mu1 - mu2
+    return float(diff.dot(diff) + np.trace(cov1) + np.trace(cov2)
+                 - 2 * tr_covmean)
+
+
+def pairwise_distances(x, y):
+    x_sq = x.pow(2).sum(1, keepdim=True)
+    y_sq = y.pow(2).sum(1, keepdim=True)
+    dist_sq = x_sq + y_sq.t() - 2 * torch.mm(x, y.t())
+    return dist_sq.clamp(min=0).sqrt()
+
+
+def knn_precision_recall(real, fake, k=5):
+    """k-NN based precision & recall (Kynkaanniemi et al., 2019)
+    and density & coverage (Naeem et al., 2020) of a single batch pair."""
+    real, fake = real.detach().float(), fake.detach().float()
+    # radius of each point : distance to its k-th nearest neighbour
+    # (the nearest one is the point itself)
+    dist_rr = pairwise_distances(real, real)
+    dist_ff = pairwise_distances(fake, fake)
+    radius_r = dist_rr.topk(k + 1, dim=1, largest=False)[0][:, -1]
+    radius_f = dist_ff.topk(k + 1, dim=1, largest=False)[0][:, -1]
+
+    dist_rf = pairwise_distances(real, fake)  # [num_real, num_fake]
+    in_real_ball = dist_rf.le(radius_r.unsqueeze(1)).float()
+    in_fake_ball = dist_rf.le(radius_f.unsqueeze(0)).float()
+    return odict(
+        precision=in_real_ball.max(0)[0].mean().item(),
+        recall=in_fake_ball.max(1)[0].mean().item(),
+        density=(in_real_ball.sum(0) / k).mean().item(),
+        coverage=dist_rf.min(1)[0].le(radius_r).float().mean().item(),
+    )
+
+
+class LatentMetrics(object):
+    """Frechet distance & random feature MMD from incremental estimates, and
+    k-NN precision/recall/density/coverage of the latest batches."""
+    def __init__(self, cfg):
+        self.cfg = cfg
+        self.moments_real = RunningMoments(cfg.latent_decay)
+        self.moments_fake = RunningMoments(cfg.latent_decay)
+        self.rff_real = RunningFeatureMean(cfg.latent_decay)
+        self.rff_fake = RunningFeatureMean(cfg.latent_decay)
+        self._rff_w = None
+        self._rff_b = None
+        self._real = None
+        self._fake = None
+
+    def update_real(self, code):
+        self._real = code.detach()
+        self.moments_real.update(code)
+        self.rff_real.update(self._random_features(code))
+
+    def update_fake(self, code):
+        self._fake = code.detach()
+        self.moments_fake.update(code)
+        self.rff_fake.update(self._random_features(code))
+
+    def compute(self):
+        if self._real is None or self._fake is None:
+            raise Exception('Update both real and fake codes first!')
+        mmd_sq = (self.rff_real.mean - self.rff_fake.mean).pow(2).sum()
+        result = odict(
+            frechet=frechet_distance(
+                self.moments_real.mean, self.moments_real.cov,
+                self.moments_fake.mean, self.moments_fake.cov),
+            mmd=math.sqrt(max(mmd_sq.item(), 0.)),
+        )
+        result.update(knn_precision_recall(self._real, self._fake,
+                                           self.cfg.latent_knn))
+        return result
+
+    def _random_features(self, code):
+        code = code.detach().float()
+        if self._rff_w is None:
+            self._init_random_features(code)
+        proj = torch.mm(code, self._rff_w) + self._rff_b
+        return math.sqrt(2. / self._rff_w.size(1)) * torch.cos(proj)
+
+    def _init_random_features(self, code):
+        # kernel bandwidth by the median heuristic on the first batch
+        dist = pairwise_distances(code, code)
+        upper = torch.triu(torch.ones_like(dist), diagonal=1) > 0
+        sigma = max(dist[upper].median().item(), 1e-6)
+        generator = torch.Generator()
+        generator.manual_seed(self.cfg.seed)
+        size = (code.size(1), self.cfg.latent_rff)
+        w = torch.randn(*size, generator=generator) / sigma
+        b = torch.rand(self.cfg.latent_rff, generator=generator) * 2 * math.pi
+        self._rff_w = w.to(code.device)
+        self._rff_b = b.to(code.device)
+        log.info('Latent MMD kernel bandwidth : %f' % sigma)
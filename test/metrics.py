@@ -0,0 +1,229 @@
+"""Corpus-level diversity & novelty metrics over generated token ids.
+
+Every n-gram of token ids is hashed into a single int64 (polynomial hash with
+the vocabulary size as its base, which is exact as long as vocab_size**n fits
+into int64), so that counting, deduplication and lookup can be done with
+numpy sorting instead of python Counters of strings.
+"""
+from collections import OrderedDict
+import logging
+import os
+
+import numpy as np
+
+log = logging.getLogger('main')
+odict = OrderedDict
+
+_NUM_NGRAMS = 4
+_SENT_HASH_PRIME = np.uint64(1099511628211)  # FNV-1 64bit prime
+_CHUNK_SIZE = 100000  # number of lines processed at once
+
+
+def strip_after_eos(ids, eos_id, pad_id=0):
+    """Replaces <eos> and everything after it by <pad>."""
+    ids = np.array(ids, dtype=np.int64)
+    after_eos = np.cumsum(ids == eos_id, axis=1) > 0
+    ids[after_eos] = pad_id
+    return ids
+
+
+def ngram_hashes(ids, n, base, pad_id=0):
+    """Hashes all the n-grams of the id array.
+
+    Args:
+        ids (np.ndarray): [num_sents, max_len] padded token ids
+        n (int): n-gram order
+        base (int): hash base (vocabulary size)
+    Returns:
+        hashes (np.ndarray): [num_sents, max_len - n + 1] int64
+        valid (np.ndarray): [num_sents, max_len - n + 1] bool
+                            (False if the window contains <pad>)
+    """
+    if base ** n >= 2 ** 63:
+        raise ValueError("%d-gram hashes of vocab size %d overflow int64"
+                         % (n, base))
+    num_sents, max_len = ids.shape
+    num_windows = max(max_len - n + 1, 0)
+    hashes = np.zeros([num_sents, num_windows], dtype=np.int64)
+    valid = np.ones([num_sents, num_windows], dtype=bool)
+    for k in range(n):
+        window = ids[:, k:k+num_windows]
+        hashes = hashes * base + window
+        valid &= (window != pad_id)
+    return hashes, valid
+
+
+def sent_hashes(ids, pad_id=0):
+    """64bit rolling hash of each (trailing padded) sentence."""
+    hashes = np.zeros(ids.shape[0], dtype=np.uint64)
+    with np.errstate(over='ignore'):  # wraps around on purpose
+        for column in ids.T:
+            updated = hashes * _SENT_HASH_PRIME + column.astype(np.uint64)
+            hashes = np.where(column != pad_id, updated, hashes)
+    return hashes
+
+
+def distinct_n(ids, n, base):
+    hashes, valid = ngram_hashes(ids, n, base)
+    hashes = hashes[valid]
+    if hashes.size == 0:
+        return 0.0
+    return np.unique(hashes).size / hashes.size
+
+
+def self_bleu(ids, base, num_ngrams=_NUM_NGRAMS):
+    """Self-BLEU : average BLEU of each sentence against all the others.
+
+    BLEU follows test.evaluate.bleu_score, but on token ids (geometric mean
+    over non-zero n-gram precisions, counts clipped by the max count over the
+    references, brevity penalty by the shortest reference). The clipping
+    table is built once over the whole set by sorting n-gram hashes, so the
+    cost is O(T log T) in the total number of n-grams rather than O(N^2).
+    """
+    num_sents = ids.shape[0]
+    if num_sents < 2:
+        return 0.0
+    lengths = (ids != 0).sum(1)
+    shortest = np.sort(lengths)[:2]  # shortest reference excluding itself
+
+    precisions = []
+    for n in range(1, num_ngrams + 1):
+        hashes, valid = ngram_hashes(ids, n, base)
+        sent_idx = np.nonzero(valid)[0]
+        hashes = hashes[valid]
+        # count of each n-gram in each sentence : c(s, h)
+        pairs = np.stack([hashes, sent_idx], 1)
+        pairs, counts = np.unique(pairs, axis=0, return_counts=True)
+        pair_hash, pair_sent = pairs[:, 0], pairs[:, 1]
+        # the two largest counts of each n-gram over the sentences
+        order = np.lexsort((-counts, pair_hash))
+        pair_hash, pair_sent, counts = \
+            pair_hash[order], pair_sent[order], counts[order]
+        _, group_start, group_size = np.unique(
+            pair_hash, return_index=True, return_counts=True)
+        first = counts[group_start]
+        second = np.where(group_size > 1,
+                          counts[np.minimum(group_start + 1, len(counts) - 1)],
+                          0)
+        group_id = np.repeat(np.arange(len(group_start)), group_size)
+        # max count over the other sentences
+        ref_max = np.where(counts == first[group_id],
+                           second[group_id], first[group_id])
+        clipped = np.minimum(counts, ref_max)
+        num_same = np.bincount(pair_sent, weights=clipped,
+                               minlength=num_sents)
+        num_pred = valid.sum(1)
+        precisions.append(np.where(num_pred > 0,
+                                   num_same / np.maximum(num_pred, 1), 0.))
+
+    precisions = np.stack(precisions, 1)  # [num_sents, num_ngrams]
+    any_match = (precisions > 0).any(1)
+    log_prec = np.where(precisions > 0, np.log(np.maximum(precisions, 1e-12)),
+                        0.).sum(1)
+    num_truth = np.where(lengths == shortest[0], shortest[1], shortest[0])
+    penalty = np.where((lengths >= 1) & (lengths <= num_truth),
+                       np.exp(1 - num_truth / np.maximum(lengths, 1)), 1.)
+    bleu = np.where(any_match, np.exp(log_prec / num_ngrams) * penalty, 0.)
+    return bleu.mean()
+
+
+class TrainNgramTable(object):
+    """Sorted unique n-gram hashes (and sentence hashes) of the preprocessed
+    training corpus. Built once and saved next to the preprocessed data."""
+    def __init__(self, ngrams, sents):
+        self.ngrams = ngrams  # list of np.int64 arrays (1 ~ num_ngrams)
+        self.sents = sents  # np.uint64 array
+
+    @classmethod
+    def load_or_build(cls, cfg, vocab, num_ngrams=_NUM_NGRAMS):
+        table_path = os.path.join(cfg.prepro_dir, 'train_ngrams.npz')
+        if (os.path.exists(table_path) and os.path.getmtime(table_path) >=
+                os.path.getmtime(cfg.processed_train_path)):
+            log.info('Loading training n-gram table: %s' % table_path)
+            loaded = np.load(table_path)
+            ngrams = [loaded['ngram_%d' % n]
+                      for n in range(1, num_ngrams + 1)]
+            return cls(ngrams, loaded['sents'])
+
+        log.info('Building training n-gram table: %s' % table_path)
+        table = cls.build(cfg.processed_train_path, len(vocab),
+                          cfg.max_len, num_ngrams)
+        arrays = {'ngram_%d' % (i + 1): ngram
+                  for i, ngram in enumerate(table.ngrams)}
+        # the table can be built by several processes at the same time
+        temp_path = '%s.%d.tmp' % (table_path, os.getpid())
+        with open(temp_path, 'wb') as f:
+            np.savez(f, sents=table.sents, **arrays)
+        os.replace(temp_path, table_path)
+        return table
+
+    @classmethod
+    def build(cls, file_path, base, max_len, num_ngrams=_NUM_NGRAMS):
+        ngrams = [[] for _ in range(num_ngrams)]
+        sents = []
+
+        def process(lines):
+            ids = np.zeros([len(lines), max_len], dtype=np.int64)
+            for i, line in enumerate(lines):
+                line = [int(x.strip(',')) for x in line.strip('[]\n').split()]
+                ids[i, :len(line)] = line[:max_len]
+            for n in range(1, num_ngrams + 1):
+                hashes, valid = ngram_hashes(ids, n, base)
+                ngrams[n-1].append(np.unique(hashes[valid]))
+            sents.append(np.unique(sent_hashes(ids)))
+
+        with open(file_path) as f:
+            lines = []
+            for line in f:
+                lines.append(line)
+                if len(lines) == _CHUNK_SIZE:
+                    process(lines)
+                    lines = []
+            if lines:
+                process(lines)
+
+        ngrams = [np.unique(np.concatenate(ngram)) for ngram in ngrams]
+        sents = np.unique(np.concatenate(sents))
+        return cls(ngrams, sents)
+
+    def novelty(self, ids, n, base):
+        """Fraction of generated n-grams never seen in the training corpus"""
+        hashes, valid = ngram_hashes(ids, n, base)
+        hashes = hashes[valid]
+        if hashes.size == 0:
+            return 0.0
+        return 1. - np.isin(hashes, self.ngrams[n-1]).mean()
+
+    def sent_novelty(self, ids):
+        """Fraction of generated sentences not in the training corpus"""
+        return 1. - np.isin(sent_hashes(ids), self.sents).mean()
+
+
+class DiversityMetrics(object):
+    """Distinct-n, self-BLEU and novelty of generated sentences."""
+    def __init__(self, cfg, vocab):
+        self.cfg = cfg
+        self.vocab = vocab
+        self.base = len(vocab)
+        self._train_table = None
+
+    @property
+    def train_table(self):
+        if self._train_table is None:  # lazy loading
+            self._train_table = TrainNgramTable.load_or_build(
+                self.cfg, self.vocab)
+        return self._train_table
+
+    def compute(self, ids):
+        """Args: ids (np.ndarray): [num_sents, max_len] generated ids"""
+        ids = strip_after_eos(ids, self.vocab.EOS_ID, self.vocab.PAD_ID)
+        ids = ids[(ids != self.vocab.PAD_ID).any(1)]  # drop empty sentences
+        result = odict()
+        for n in range(1, _NUM_NGRAMS + 1):
+            result['distinct_%d' % n] = distinct_n(ids, n, self.base)
+        result['self_bleu'] = float(self_bleu(ids, self.base))
+        for n in range(2, _NUM_NGRAMS + 1):
+            result['novel_%d' % n] = float(
+                self.train_table.novelty(ids, n, self.base))
+        result['novel_sent'] = float(self.train_table.sent_novelty(ids))
+        return result
@@ -0,0 +1,215 @@
+"""ONNX export of the inference graphs, for runtimes other than PyTorch.
+
+Three graphs are written to a directory, with dynamic batch sizes :
+
+    encoder.onnx      : ids [B, max_len + 1], lengths [B] -> code [B, H]
+                        (embed_w -> enc -> reg.without_var)
+    generator.onnx    : noise [B, z] -> code [B, H]
+    decoder_step.onnx : ids [B, 1], code [B, H], h [L, B, H], c [L, B, H]
+                        -> logits [B, V], h_out, c_out
+
+along with meta.json (special ids and sizes) and vocab.txt. The decoding
+loop is left to the runtime : see test.onnx_sampler for a reference one.
+The sequence length of the encoder is static, since torch.export unrolls
+lstm over time steps.
+Needs the onnx and onnxscript packages (onnxruntime for parity checks).
+check_onnx_parity fails unless the graphs give the same outputs as PyTorch
+(within atol) and the same decoded ids : run it on an exported directory
+with --check_onnx DIR.
+"""
+from collections import OrderedDict
+import json
+import logging
+import os
+
+import numpy as np
+import torch
+import torch.nn as nn
+import torch.nn.functional as F
+
+from loader.data import Batch
+from models.decoder import DecoderRNN
+from models.encoder import EncoderRNN
+from test.encode import encode_batch
+
+log = logging.getLogger('main')
+odict = OrderedDict
+
+
+class EncoderGraph(nn.Module):
+    """Same codes as test.encode.encode_batch, without packed sequences.
+    ids are padded to max_len + 1 (<eos>), the longest Batch.enc_src."""
+    def __init__(self, embed_w, enc, reg):
+        super(EncoderGraph, self).__init__()
+        self.embed = embed_w.embed
+        self.enc = enc
+        self.mu_layers = reg.mu_layers
+        self.is_rnn = isinstance(enc, EncoderRNN)
+
+    def forward(self, ids, lengths):
+        embed = self.embed(ids)
+        if self.is_rnn:
+            # output of the last layer at (length - 1) is the last hidden
+            # state the packed sequence would give (the pads after it make
+            # no difference to an unidirectional lstm)
+            output, _ = self.enc.encoder(embed)
+            index = (lengths - 1).view(-1, 1, 1).expand(-1, 1, output.size(2))
+            code = output.gather(1, index).squeeze(1)
+        else:
+            # zero embeddings after the padded length, as
+            # EncoderCNN._append_zero_embeds does for shorter batches
+            positions = torch.arange(ids.size(1), device=ids.device)
+            mask = positions.unsqueeze(0) < lengths.unsqueeze(1)
+            embed = embed * mask.unsqueeze(2).to(embed.dtype)
+            code = self.enc._encode(embed)  # takes max_len ids
+        return self.mu_layers(torch.tanh(code))
+
+
+class DecoderStepGraph(nn.Module):
+    """A step of DecoderRNN with the lstm state as inputs and outputs.
+    logits are the scores the decoder takes argmax and log_softmax of."""
+    def __init__(self, dec):
+        super(DecoderStepGraph, self).__init__()
+        if not isinstance(dec, DecoderRNN):
+            raise Exception('Only the rnn decoder can be exported!')
+        self.embed = dec.embed_w.embed
+        self.decoder = dec.decoder
+        self.linear_w = dec.linear_w
+        self.dec_embed = dec.cfg.dec_embed
+        self.embed_temp = dec.cfg.embed_temp
+        if self.dec_embed:
+            ref_embed = F.normalize(self.embed.weight.detach(), p=2, dim=1)
+            self.register_buffer('ref_embed', ref_embed.t().contiguous())
+
+    def forward(self, ids, code, h, c):
+        input_w = torch.cat([self.embed(ids), code.unsqueeze(1)], 2)
+        output_w, (h, c) = self.decoder(input_w, (h, c))
+        logits = self.linear_w(output_w.squeeze(1))
+        if self.dec_embed:
+            logits = torch.matmul(logits, self.ref_embed) * self.embed_temp
+        return logits, h, c
+
+
+def _example_inputs(cfg, dec, batch_size=4):
+    num_layers = dec.decoder.num_layers
+    seq_len = cfg.max_len + 1
+    state = torch.zeros(num_layers, batch_size, cfg.hidden_size_w)
+    return dict(
+        encoder=(torch.ones(batch_size, seq_len).long(),
+                 torch.full((batch_size,), seq_len).long()),
+        generator=(torch.zeros(batch_size, cfg.z_size),),
+        decoder_step=(torch.ones(batch_size, 1).long(),
+                      torch.zeros(batch_size, cfg.hidden_size_w),
+                      state, state.clone()),
+    )
+
+
+def export_onnx(net, dir_path, decoder='dec', opset=18):
+    try:
+        import onnxscript  # required by torch.onnx.export
+    except ImportError:
+        raise ImportError('ONNX export needs onnx and onnxscript : '
+                          'pip install onnx onnxscript')
+    cfg = net.cfg
+    if cfg.cuda:
+        raise Exception('Export ONNX graphs on CPU! (--cuda false)')
+    dec = getattr(net, decoder)
+    net.set_modules_train_mode(False)  # running statistics of batch norm
+    os.makedirs(dir_path, exist_ok=True)
+
+    batch = torch.export.Dim('batch')
+    graphs = odict(
+        encoder=(EncoderGraph(net.embed_w, net.enc, net.reg),
+                 ['ids', 'lengths'], ['code'],
+                 dict(ids={0: batch}, lengths={0: batch})),
+        generator=(net.gen, ['noise'], ['code'], dict(noise={0: batch})),
+        decoder_step=(DecoderStepGraph(dec), ['ids', 'code', 'h', 'c'],
+                      ['logits', 'h_out', 'c_out'],
+                      dict(ids={0: batch}, code={0: batch}, h={1: batch},
+                           c={1: batch})),
+    )
+    inputs = _example_inputs(cfg, dec)
+    with torch.no_grad():
+        for name, (module, input_names, output_names, dims) in graphs.items():
+            file_path = os.path.join(dir_path, name + '.onnx')
+            torch.onnx.export(module.eval(), inputs[name], file_path,
+                              input_names=input_names,
+                              output_names=output_names,
+                              dynamic_shapes=dims, opset_version=opset,
+                              dynamo=True, verbose=False)
+            log.info('Exported %s graph : %s' % (name, file_path))
+
+    vocab = net.vocab_w
+    meta = odict(
+        pad_id=vocab.PAD_ID, sos_id=vocab.SOS_ID, eos_id=vocab.EOS_ID,
+        unk_id=vocab.UNK_ID, vocab_size=len(vocab), z_size=cfg.z_size,
+        hidden_size=cfg.hidden_size_w, num_layers=dec.decoder.num_layers,
+        max_len=cfg.max_len, enc_type=cfg.enc_type,
+        enc_seq_len=cfg.max_len + 1,
+        # Batch pads sentences to max_len with the cnn decoder
+        pad_to_max_len=cfg.dec_type == 'cnn',
+    )
+    with open(os.path.join(dir_path, 'meta.json'), 'w') as f:
+        json.dump(meta, f, indent=2)
+    with open(os.path.join(dir_path, 'vocab.txt'), 'w') as f:
+        f.write('\n'.join(vocab.idx2word) + '\n')
+    log.info('ONNX graphs have been exported to : %s' % dir_path)
+
+
+def check_onnx_parity(net, dir_path, decoder='dec', batch_size=32,
+                      atol=1e-4):
+    """Max absolute differences between the outputs of onnxruntime and
+    PyTorch for each graph, and the ratio of the same ids decoded by
+    OnnxSampler and DecoderRNN.decode_ids from generated codes. Raises if
+    any difference is over atol or any id differs."""
+    from test.onnx_sampler import OnnxSampler
+    cfg = net.cfg
+    dec = getattr(net, decoder)
+    sampler = OnnxSampler(dir_path)
+    net.set_modules_train_mode(False)
+    rng = np.random.RandomState(cfg.seed)
+
+    def max_diff(a, b):
+        return float(np.abs(a - b.cpu().numpy()).max())
+
+    # encoder (Batch needs sentences sorted by length for packing)
+    lengths = sorted(rng.randint(1, cfg.max_len, batch_size), reverse=True)
+    id_lists = [rng.randint(4, len(net.vocab_w), n).tolist()
+                for n in lengths]
+    torch_code = encode_batch(net, Batch(cfg, net.vocab_w, id_lists,
+                                         list(lengths)))
+    diffs = odict(encoder=max_diff(sampler.encode(id_lists), torch_code))
+
+    # generator
+    noise = rng.normal(0, 1, (batch_size, cfg.z_size)).astype(np.float32)
+    with torch.no_grad():
+        code = net.gen(torch.from_numpy(noise))
+    diffs['generator'] = max_diff(sampler.generate(noise), code)
+
+    # a decoder step from a random state
+    num_layers = dec.decoder.num_layers
+    state = rng.normal(0, 1, (2, num_layers, batch_size, cfg.hidden_size_w))
+    state = state.astype(np.float32)
+    ids = rng.randint(0, len(net.vocab_w), (batch_size, 1))
+    step = DecoderStepGraph(dec).eval()
+    with torch.no_grad():
+        outputs = step(torch.from_numpy(ids), code,
+                       torch.from_numpy(state[0]), torch.from_numpy(state[1]))
+    onnx_outputs = sampler.step(ids, code.numpy(), state[0], state[1])
+    for name, a, b in zip(['logits', 'h', 'c'], onnx_outputs, outputs):
+        diffs['decoder_step_' + name] = max_diff(a, b)
+
+    # the whole greedy decoding
+    ids = sampler.decode(code.numpy(), cfg.max_len)
+    diffs['decode_ids_match'] = float(np.mean(
+        ids == dec.decode_ids(code, cfg.max_len).cpu().numpy()))
+
+    failed = [name for name, value in diffs.items()
+              if (value < 1. if name == 'decode_ids_match' else value > atol)]
+    for name, value in diffs.items():
+        log.info('| ONNX parity | %-20s | %.3e | %s |' % (
+            name, value, 'FAIL' if name in failed else 'ok'))
+    if failed:
+        raise Exception('ONNX graphs in %s differ from PyTorch (atol %g) : %s'
+                        % (dir_path, atol, ', '.join(failed)))
+    return diffs
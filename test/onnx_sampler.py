@@ -0,0 +1,101 @@
+"""Reference runtime of the graphs exported by test.onnx_export.
+
+Only numpy and onnxruntime are needed (not torch), so this module can be
+copied along with the exported directory to serve the model elsewhere.
+
+    sampler = OnnxSampler('path/to/onnx_dir')
+    texts = sampler.ids2text(sampler.sample(8))
+"""
+import json
+import os
+
+import numpy as np
+
+
+class OnnxSampler(object):
+    graphs = ['encoder', 'generator', 'decoder_step']
+
+    def __init__(self, dir_path, providers=('CPUExecutionProvider',)):
+        try:
+            import onnxruntime
+        except ImportError:
+            raise ImportError('OnnxSampler needs onnxruntime : '
+                              'pip install onnxruntime')
+        with open(os.path.join(dir_path, 'meta.json')) as f:
+            self.meta = json.load(f)
+        with open(os.path.join(dir_path, 'vocab.txt')) as f:
+            self.idx2word = f.read().split('\n')[:self.meta['vocab_size']]
+        self.sessions = dict()
+        for name in self.graphs:
+            file_path = os.path.join(dir_path, name + '.onnx')
+            self.sessions[name] = onnxruntime.InferenceSession(
+                file_path, providers=list(providers))
+
+    def _run(self, name, **inputs):
+        session = self.sessions[name]
+        # (inputs unused by a graph, e.g. lengths of cnn, may be dropped)
+        feed = {i.name: inputs[i.name] for i in session.get_inputs()}
+        return session.run(None, feed)
+
+    def encode(self, id_lists):
+        """Codes of sentences given as lists of token ids (without <eos>)"""
+        meta = self.meta
+        seq_len = meta['enc_seq_len']
+        ids = np.full((len(id_lists), seq_len), meta['pad_id'], np.int64)
+        max_len = 0
+        for i, sent in enumerate(id_lists):
+            sent = list(sent)[:seq_len - 1] + [meta['eos_id']]
+            ids[i, :len(sent)] = sent
+            max_len = max(max_len, len(sent))
+        # as loader.data.Batch, where every length is the padded length of
+        # the batch (what the encoder has been trained with)
+        if meta['pad_to_max_len']:
+            max_len = seq_len
+        lengths = np.full(len(id_lists), max_len, np.int64)
+        return self._run('encoder', ids=ids, lengths=lengths)[0]
+
+    def generate(self, noise):
+        return self._run('generator', noise=noise.astype(np.float32))[0]
+
+    def step(self, ids, code, h, c):
+        return self._run('decoder_step', ids=ids.astype(np.int64),
+                         code=code, h=h, c=c)
+
+    def decode(self, code, max_len=None):
+        """Greedy decoding, as DecoderRNN.decode_ids"""
+        meta = self.meta
+        max_len = max_len or meta['max_len']
+        batch_size = code.shape[0]
+        shape = (meta['num_layers'], batch_size, meta['hidden_size'])
+        h = np.zeros(shape, np.float32)
+        c = np.zeros(shape, np.float32)
+        ids = np.full((batch_size, max_len), meta['pad_id'], np.int64)
+        id_w = np.full((batch_size, 1), meta['sos_id'], np.int64)
+        finished = np.zeros((batch_size, 1), bool)
+
+        for i in range(max_len):
+            logits, h, c = self.step(id_w, code, h, c)
+            id_w = logits.argmax(1)[:, None]
+            # pads from <eos> on
+            finished |= id_w == meta['eos_id']
+            id_w[finished] = meta['pad_id']
+            ids[:, i] = id_w[:, 0]
+            if finished.all():
+                break
+        return ids
+
+    def sample(self, num_samples, rng=np.random):
+        noise = rng.normal(0, 1, (num_samples, self.meta['z_size']))
+        return self.decode(self.generate(noise))
+
+    def ids2text(self, ids_batch):
+        stop = {self.meta['eos_id'], self.meta['pad_id']}
+        texts = []
+        for ids in ids_batch:
+            words = []
+            for idx in ids:
+                if idx in stop:
+                    break
+                words.append(self.idx2word[idx])
+            texts.append(' '.join(words))
+        return texts
@@ -0,0 +1,155 @@
+"""Dynamic int8 quantization for CPU inference.
+
+Weights of nn.LSTM and nn.Linear are stored in int8 and activations are
+quantized on the fly, batch by batch. Embeddings, batch norms and the
+cosine similarity of dec_embed stay in fp32.
+"""
+from collections import OrderedDict
+import io
+import json
+import logging
+import os
+import time
+
+import torch
+import torch.nn as nn
+from torch.ao.quantization import quantize_dynamic
+
+from test.encode import encode_batch
+from test.evaluate import evaluate_sents
+from utils.utils import set_random_seed
+
+log = logging.getLogger('main')
+odict = OrderedDict
+
+QUANT_MODULES = ['enc', 'reg', 'dec', 'dec2', 'gen']
+
+
+def quantize_module(module):
+    """Quantizes LSTMs and Linears of the module in place"""
+    before = dict(module.named_modules(remove_duplicate=False))
+    quantize_dynamic(module, {nn.LSTM, nn.Linear}, dtype=torch.qint8,
+                     inplace=True)
+    after = dict(module.named_modules(remove_duplicate=False))
+    # layers kept in plain lists (e.g. Generator.layers) would still point
+    # to the float modules
+    swapped = {id(before[key]): after[key] for key in before
+               if key in after and after[key] is not before[key]}
+    for submodule in module.modules():
+        for value in vars(submodule).values():
+            if isinstance(value, list):
+                value[:] = [swapped.get(id(v), v) for v in value]
+    return module
+
+
+def quantize_network(net, names=QUANT_MODULES):
+    """Quantizes the modules of the network that are built among names.
+    Quantized modules are for inference only and run on CPU only."""
+    if net.cfg.cuda:
+        raise Exception('Quantized modules run on CPU only! (--cuda false)')
+    names = [name for name in names if name in net._modules]
+    for name in names:
+        quantize_module(net._modules[name])
+    log.info('Dynamic int8 quantization : %s (engine: %s)'
+             % (', '.join(names), torch.backends.quantized.engine))
+    return names
+
+
+def state_dict_bytes(module):
+    buffer = io.BytesIO()
+    torch.save(module.state_dict(), buffer)
+    return buffer.tell()
+
+
+class QuantizationReport(object):
+    """Compares int8 modules with fp32 ones on a held-out batch.
+
+    The same test batch is autoencoded and the same noise is decoded by both
+    versions of the network. Reported are the reconstruction accuracy and
+    BLEU of each against the source, the agreement of generated text (BLEU
+    and exact match of int8 against fp32 samples), the cosine similarity
+    of codes, the latency and the checkpoint size. The report is saved to
+    log_dir/quant_report.json as well.
+    """
+    def __init__(self, net):
+        self.net = net
+        self.cfg = cfg = net.cfg
+        net.load_modules()
+        set_random_seed(cfg)
+
+        batch = net.data_eval.next()
+        noise = net.gen.get_noise(cfg.eval_size)
+        names = [name for name in QUANT_MODULES if name in net._modules]
+
+        size_fp32 = sum(state_dict_bytes(net._modules[n]) for n in names)
+        fp32 = self.run(batch, noise)
+        quantize_network(net, names)
+        size_int8 = sum(state_dict_bytes(net._modules[n]) for n in names)
+        int8 = self.run(batch, noise)
+
+        report = self.compare(batch, fp32, int8)
+        report.update(size_mb_fp32=size_fp32 / 2**20,
+                      size_mb_int8=size_int8 / 2**20)
+        for key, value in report.items():
+            log.info('| %-20s | %10.4f |' % (key, value))
+        for i in range(min(cfg.log_nsample, len(fp32['gen_text']))):
+            log.info('[fp32] %s\n[int8] %s'
+                     % (fp32['gen_text'][i], int8['gen_text'][i]))
+
+        report_path = os.path.join(cfg.log_dir, 'quant_report.json')
+        with open(report_path, 'w') as f:
+            json.dump(report, f, indent=2)
+        log.info('Quantization report has been saved to : %s' % report_path)
+
+    def run(self, batch, noise):
+        net = self.net
+        vocab = net.vocab_w
+        net.set_modules_train_mode(False)
+
+        start = time.time()
+        code = encode_batch(net, batch)
+        recon = net.dec.decode_ids(code, batch.enc_src.id.size(1))
+        recon_secs = time.time() - start
+
+        # generator in train mode (batch statistics) as in TextGenerator
+        net.gen.train(True)
+        start = time.time()
+        with torch.no_grad():
+            code_fake = net.gen(noise)
+        gen = net.dec.decode_ids(code_fake, self.cfg.max_len)
+        gen_secs = time.time() - start
+
+        return dict(code=code, code_fake=code_fake, recon=recon, gen=gen,
+                    recon_text=vocab.ids2text_batch(recon.cpu().numpy()),
+                    gen_text=vocab.ids2text_batch(gen.cpu().numpy()),
+                    recon_secs=recon_secs, gen_secs=gen_secs)
+
+    def compare(self, batch, fp32, int8):
+        vocab = self.net.vocab_w
+        target = batch.enc_src.id
+        source = vocab.ids2text_batch(target.cpu().numpy())
+        mask = target.ne(vocab.PAD_ID)
+
+        def recon_acc(out):
+            return out['recon'].eq(target)[mask].float().mean().item()
+
+        def cosine(key):
+            return torch.nn.functional.cosine_similarity(
+                fp32[key], int8[key], dim=1).mean().item()
+
+        gen_eval = evaluate_sents(fp32['gen_text'], int8['gen_text'])
+        return odict(
+            recon_acc_fp32=recon_acc(fp32),
+            recon_acc_int8=recon_acc(int8),
+            recon_bleu_fp32=evaluate_sents(source, fp32['recon_text'])['bleu'],
+            recon_bleu_int8=evaluate_sents(source, int8['recon_text'])['bleu'],
+            gen_bleu_vs_fp32=gen_eval['bleu'],
+            gen_em_vs_fp32=gen_eval['em'],
+            gen_token_agree=fp32['gen'].eq(int8['gen']).float().mean().item(),
+            code_cosine=cosine('code'),
+            code_fake_cosine=cosine('code_fake'),
+            recon_secs_fp32=fp32['recon_secs'],
+            recon_secs_int8=int8['recon_secs'],
+            gen_secs_fp32=fp32['gen_secs'],
+            gen_secs_int8=int8['gen_secs'],
+        )
@@ -0,0 +1,177 @@
+"""noise -> Generator -> greedy decoding exported as a single graph.
+
+The whole pipeline is captured with torch.export, once per batch size, so
+that every program has static shapes : the decoding loop is unrolled over
+max_len steps, cfg.dec_embed branches are resolved at export time and the
+python overhead of per-step module calls is gone. Programs are saved as
+{batch size}.pt2 files in a directory along with a meta.json.
+"""
+from collections import OrderedDict
+import json
+import logging
+import os
+import time
+
+import numpy as np
+import torch
+import torch.nn as nn
+import torch.nn.functional as F
+
+from models.decoder import DecoderRNN
+
+log = logging.getLogger('main')
+odict = OrderedDict
+
+
+def parse_batch_sizes(text):
+    batch_sizes = sorted(set(int(size) for size in text.split(',')))
+    # batch norm with batch statistics (as in TextGenerator)
+    if batch_sizes[0] < 2:
+        raise ValueError('Batch sizes of the sampler must be greater than 1')
+    return batch_sizes
+
+
+class GreedySampler(nn.Module):
+    """Same ids as Generator (in train mode) + DecoderRNN.decode_ids, for a
+    fixed number of steps. Shares the parameters of the given modules."""
+    def __init__(self, gen, dec, max_len):
+        super(GreedySampler, self).__init__()
+        if not isinstance(dec, DecoderRNN):
+            raise Exception('Only the rnn decoder can be exported!')
+        linears = [l for l in gen.layers if isinstance(l, nn.Linear)]
+        self.hidden = nn.ModuleList(linears[:-1])
+        self.norms = nn.ModuleList(
+            [l for l in gen.layers if isinstance(l, nn.BatchNorm1d)])
+        self.out = linears[-1]
+        self.embed = dec.embed_w.embed
+        self.decoder = dec.decoder
+        self.linear_w = dec.linear_w
+        self.dec_embed = dec.cfg.dec_embed
+        if self.dec_embed:
+            ref_embed = F.normalize(self.embed.weight.detach(), p=2, dim=1)
+            self.register_buffer('ref_embed', ref_embed.t().contiguous())
+        self.max_len = max_len
+        self.sos_id = dec.vocab_w.SOS_ID
+        self.eos_id = dec.vocab_w.EOS_ID
+        self.pad_id = dec.vocab_w.PAD_ID
+
+    def forward(self, noise):
+        # Generator (batch statistics, running ones are left untouched)
+        x = noise
+        for linear, norm in zip(self.hidden, self.norms):
+            x = F.batch_norm(linear(x), None, None, norm.weight, norm.bias,
+                             True, 0., norm.eps)
+            x = F.relu(x)
+        code = self.out(x).unsqueeze(1)
+
+        # greedy decoding
+        batch_size = noise.size(0)
+        hidden_size = self.decoder.hidden_size
+        num_layers = self.decoder.num_layers
+        state = (noise.new_zeros(num_layers, batch_size, hidden_size),
+                 noise.new_zeros(num_layers, batch_size, hidden_size))
+        id_w = torch.full((batch_size, 1), self.sos_id, dtype=torch.long,
+                          device=noise.device)
+        finished = torch.zeros(batch_size, 1, dtype=torch.bool,
+                               device=noise.device)
+        all_id_w = []
+        for i in range(self.max_len):
+            input_w = torch.cat([self.embed(id_w), code], 2)
+            output_w, state = self.decoder(input_w, state)
+            score_w = self.linear_w(output_w)
+            if self.dec_embed:
+                score_w = torch.matmul(score_w, self.ref_embed)
+            id_w = score_w.argmax(2)
+            # pads from <eos> on, as DecoderRNN._pad_ids_after_eos
+            finished = finished | id_w.eq(self.eos_id)
+            id_w = id_w.masked_fill(finished, self.pad_id)
+            all_id_w.append(id_w)
+        return torch.cat(all_id_w, 1)
+
+
+def export_sampler(gen, dec, cfg, dir_path, batch_sizes):
+    sampler = GreedySampler(gen, dec, cfg.max_len).eval()
+    os.makedirs(dir_path, exist_ok=True)
+    for batch_size in batch_sizes:
+        start = time.time()
+        noise = torch.zeros(batch_size, cfg.z_size, device=cfg.device)
+        with torch.no_grad():
+            program = torch.export.export(sampler, (noise,))
+        torch.export.save(program, os.path.join(dir_path,
+                                                '%d.pt2' % batch_size))
+        log.info('Exported sampler of batch size %d (%.1f secs)'
+                 % (batch_size, time.time() - start))
+    meta = odict(batch_sizes=list(batch_sizes), z_size=cfg.z_size,
+                 max_len=cfg.max_len, dec_embed=cfg.dec_embed)
+    with open(os.path.join(dir_path, 'meta.json'), 'w') as f:
+        json.dump(meta, f, indent=2)
+    log.info('Sampler has been exported to : %s' % dir_path)
+
+
+class ExportedSampler(object):
+    """Loads the programs of an exported sampler directory. Called with a
+    noise batch, runs the program of its batch size."""
+    def __init__(self, dir_path):
+        with open(os.path.join(dir_path, 'meta.json')) as f:
+            self.meta = json.load(f)
+        self.programs = odict()
+        for batch_size in self.meta['batch_sizes']:
+            file_path = os.path.join(dir_path, '%d.pt2' % batch_size)
+            self.programs[batch_size] = torch.export.load(file_path).module()
+        log.info('Sampler has been loaded from : %s (batch sizes: %s)'
+                 % (dir_path, self.meta['batch_sizes']))
+
+    def __call__(self, noise):
+        program = self.programs.get(noise.size(0))
+        if program is None:
+            raise Exception('Sampler is exported for batch sizes %s only, '
+                            'not %d' % (list(self.programs), noise.size(0)))
+        with torch.no_grad():
+            return program(noise)
+
+
+class SamplerBenchmark(object):
+    """Latency of the exported sampler against the eager path (Generator in
+    train mode + DecoderRNN.decode_ids) for each batch size, and whether
+    they produce the same ids."""
+    def __init__(self, net):
+        self.net = net
+        self.cfg = cfg = net.cfg
+        gen = net.gen
+        dec = getattr(net, cfg.gen_decoder)
+        dec.train(False)
+
+        sampler = GreedySampler(gen, dec, cfg.max_len).eval()
+        log.info('| %5s | %10s | %10s | %7s | %9s |' % (
+            'batch', 'eager(ms)', 'export(ms)', 'speedup', 'ids match'))
+        for batch_size in parse_batch_sizes(cfg.sampler_batch_sizes):
+            noise = gen.get_noise(batch_size)
+            with torch.no_grad():
+                program = torch.export.export(sampler, (noise,)).module()
+
+            def eager():
+                gen.train(True)
+                return dec.decode_ids(gen(noise), cfg.max_len)
+
+            def exported():
+                return program(noise)
+
+            with torch.no_grad():
+                eager_ms, ids_eager = self.measure(eager)
+                export_ms, ids_export = self.measure(exported)
+            match = ids_eager.eq(ids_export).float().mean().item()
+            log.info('| %5d | %10.2f | %10.2f | %6.2fx | %9.4f |' % (
+                batch_size, eager_ms, export_ms, eager_ms / export_ms,
+                match))
+
+    def measure(self, func, num_warmup=2):
+        for _ in range(num_warmup):
+            func()
+        times = []
+        for _ in range(self.cfg.bench_iters):
+            start = time.perf_counter()
+            out = func()
+            if self.cfg.cuda:
+                torch.cuda.synchronize()
+            times.append(time.perf_counter() - start)
+        return float(np.median(times)) * 1000, out
@@ -0,0 +1,281 @@
+"""Local inference server with dynamic batching.
+
+Requests are JSON objects, one per line on stdin (responses on stdout, in
+completion order) or POSTed to http://localhost:{serve_port}/ :
+
+    {"id": 0, "op": "sample", "n": 4}
+    {"id": 1, "op": "interpolate", "n": 10}
+    {"id": 2, "op": "autoencode", "text": "a man is playing a guitar ."}
+    {"id": 3, "op": "stats"}
+
+Requests arriving within serve_max_wait ms of the first waiting one are
+coalesced into a single batch of at most serve_max_batch sentences.
+"""
+from collections import deque, OrderedDict
+from concurrent.futures import Future
+from http.server import BaseHTTPRequestHandler, HTTPServer
+import json
+import logging
+import queue
+from socketserver import ThreadingMixIn
+import sys
+import threading
+import time
+
+import numpy as np
+import torch
+
+from loader.data import Batch
+from test.encode import encode_batch
+from utils.rng import rng
+from utils.utils import set_random_seed
+
+log = logging.getLogger('main')
+odict = OrderedDict
+
+_NUM_LATENCIES = 10000  # latency percentiles over this many last requests
+
+
+class Request(object):
+    def __init__(self, body):
+        self.body = body
+        self.op = body.get('op')
+        self.future = Future()
+        self.time = time.time()
+        if self.op == 'autoencode':
+            self.size = 1
+        else:
+            self.size = int(body.get('n', 1))
+
+
+class InferenceServer(object):
+    """Keeps embed_w, enc, reg, gen and dec loaded and answers autoencode,
+    sample and interpolate requests (the modes of Tester) in batches.
+
+    Unlike Trainer, the generator runs in eval mode (running statistics of
+    batch norm), so that a result doesn't depend on the requests batched
+    along with it.
+    """
+    ops = ('autoencode', 'sample', 'interpolate')
+
+    def __init__(self, net):
+        self.net = net
+        self.cfg = cfg = net.cfg
+        self.vocab = net.vocab_w
+        set_random_seed(cfg)
+        net.set_modules_train_mode(False)
+        import spacy  # slow to import
+        spacy_en = spacy.load('en')
+        self.tokenizer = lambda s: [tok.text for tok in spacy_en.tokenizer(s)]
+
+        self._queue = queue.Queue()
+        self._latencies = deque(maxlen=_NUM_LATENCIES)
+        self._num_batches = 0
+        self._num_rows = 0
+        self._worker = threading.Thread(target=self._batch_loop, daemon=True)
+        self._worker.start()
+
+        log.info('Inference server start! (%s)' % cfg.serve)
+        if cfg.serve == 'stdio':
+            self.serve_stdio()
+        else:
+            self.serve_http()
+        log.info(self.stats())
+
+    def submit(self, body):
+        """Returns a Future of the response of a request dict."""
+        try:
+            request = Request(body)
+        except (AttributeError, TypeError, ValueError) as e:
+            return _done(dict(error='Invalid request : %s' % e))
+        if request.op == 'stats':
+            request.future.set_result(self._response(request, self.stats()))
+        elif request.op not in self.ops:
+            request.future.set_result(self._response(
+                request, dict(error='Unknown op : %s' % request.op)))
+        elif not 0 < request.size <= self.cfg.serve_max_batch:
+            request.future.set_result(self._response(request, dict(
+                error='n must be in 1 ~ %d' % self.cfg.serve_max_batch)))
+        else:
+            self._queue.put(request)
+        return request.future
+
+    def stats(self):
+        latencies = np.array(self._latencies) * 1000
+        if latencies.size == 0:
+            latencies = np.zeros(1)
+        num_batches = max(self._num_batches, 1)
+        return odict(
+            num_batches=self._num_batches,
+            latency_p50_ms=float(np.percentile(latencies, 50)),
+            latency_p99_ms=float(np.percentile(latencies, 99)),
+            batch_rows=float(self._num_rows / num_batches),
+            batch_fill=float(self._num_rows / num_batches /
+                             self.cfg.serve_max_batch),
+        )
+
+    def serve_stdio(self):
+        lock = threading.Lock()
+        pending = []
+
+        def write(response):
+            with lock:
+                sys.stdout.write(json.dumps(response) + '\n')
+                sys.stdout.flush()
+
+        def write_when_done(future):
+            written = threading.Event()
+
+            def callback(future):
+                write(future.result())
+                written.set()
+
+            future.add_done_callback(callback)
+            return written
+
+        for line in sys.stdin:
+            if not line.strip():
+                continue
+            try:
+                body = json.loads(line)
+            except ValueError as e:
+                write(dict(error='Invalid json : %s' % e))
+                continue
+            pending.append(write_when_done(self.submit(body)))
+            pending = [written for written in pending
+                       if not written.is_set()]
+        for written in pending:  # EOF : wait for the pending responses
+            written.wait()
+
+    def serve_http(self):
+        server = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_POST(self):
+                length = int(self.headers.get('Content-Length', 0))
+                try:
+                    body = json.loads(self.rfile.read(length).decode())
+                    response = server.submit(body).result()
+                except ValueError as e:
+                    response = dict(error='Invalid json : %s' % e)
+                data = json.dumps(response).encode()
+                self.send_response(200)
+                self.send_header('Content-Type', 'application/json')
+                self.send_header('Content-Length', str(len(data)))
+                self.end_headers()
+                self.wfile.write(data)
+
+            def log_message(self, format, *args):
+                log.debug(format % args)
+
+        httpd = ThreadingHTTPServer(('localhost', self.cfg.serve_port),
+                                    Handler)
+        log.info('Listening on http://localhost:%d/' % self.cfg.serve_port)
+        try:
+            httpd.serve_forever()
+        except KeyboardInterrupt:
+            pass
+        httpd.server_close()
+
+    def _batch_loop(self):
+        pending = None
+        while True:
+            requests = [pending or self._queue.get()]
+            pending = None
+            num_rows = requests[0].size
+            deadline = requests[0].time + self.cfg.serve_max_wait / 1000.
+            # coalesce requests until the batch is full or time is up
+            while num_rows < self.cfg.serve_max_batch:
+                try:
+                    timeout = max(deadline - time.time(), 0)
+                    request = self._queue.get(timeout=timeout)
+                except queue.Empty:
+                    break
+                if num_rows + request.size > self.cfg.serve_max_batch:
+                    pending = request  # goes to the next batch
+                    break
+                requests.append(request)
+                num_rows += request.size
+            self._run_batch(requests, num_rows)
+
+    def _run_batch(self, requests, num_rows):
+        self._num_batches += 1
+        self._num_rows += num_rows
+        try:
+            with torch.no_grad():
+                for op in self.ops:
+                    same_op = [r for r in requests if r.op == op]
+                    if same_op:
+                        results = getattr(self, '_' + op)(same_op)
+                        for request, text in zip(same_op, results):
+                            self._finish(request, dict(text=text))
+        except Exception as e:
+            log.info('Failed to run a batch! (%s)' % e)
+            for request in requests:
+                if not request.future.done():
+                    self._finish(request, dict(error=str(e)))
+
+        if self._num_batches % self.cfg.log_interval == 0:
+            log.info('| Serve |' + ''.join(' %s : %.4f |' % (k, v)
+                     for k, v in self.stats().items()))
+
+    def _finish(self, request, response):
+        self._latencies.append(time.time() - request.time)
+        request.future.set_result(self._response(request, response))
+
+    def _response(self, request, response):
+        if 'id' in request.body:
+            response = dict(response, id=request.body['id'])
+        return response
+
+    def _decode_to_text(self, code, sizes):
+        ids = self.net.dec.decode_ids(code, self.cfg.max_len).cpu().numpy()
+        texts = self.vocab.ids2text_batch(ids)
+        offsets = np.cumsum([0] + sizes)
+        return [texts[s:e] for s, e in zip(offsets[:-1], offsets[1:])]
+
+    def _sample(self, requests):
+        sizes = [r.size for r in requests]
+        noise = self.net.gen.get_noise(sum(sizes))
+        return self._decode_to_text(self.net.gen(noise), sizes)
+
+    def _interpolate(self, requests):
+        # same as Tester._get_interpolated_z, for each request
+        sizes = [r.size for r in requests]
+        z = []
+        for size in sizes:
+            z_a, z_b = rng.normal('interp', (2, 1, self.cfg.z_size),
+                                  device=self.cfg.device,
+                                  dtype=self.cfg.dtype)
+            offset = (z_b - z_a) / size
+            z.extend([z_a + offset * i for i in range(size)])
+        z = torch.cat(z)
+        return self._decode_to_text(self.net.gen(z), sizes)
+
+    def _autoencode(self, requests):
+        ids = []
+        for request in requests:
+            tokens = self.tokenizer(request.body.get('text', ''))
+            tokens = tokens[:self.cfg.max_len - 1] or ['<unk>']  # + <eos>
+            ids.append(self.vocab.words2ids(tokens))
+        # Batch has to be sorted by length for the rnn encoder
+        order = sorted(range(len(ids)), key=lambda i: -len(ids[i]))
+        sorted_ids = [ids[i] for i in order]
+        batch = Batch(self.cfg, self.vocab, sorted_ids,
+                      [len(x) for x in sorted_ids])
+        texts = self._decode_to_text(encode_batch(self.net, batch),
+                                     [1] * len(ids))
+        results = [None] * len(ids)
+        for i, text in zip(order, texts):
+            results[i] = text
+        return results
+
+
+class ThreadingHTTPServer(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+
+
+def _done(result):
+    future = Future()
+    future.set_result(result)
+    return future
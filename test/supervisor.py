@@ -7,6 +7,8 @@ from tqdm import tqdm
 
 import torch
 
+from train.checkpoint import latest_checkpoint, load_checkpoint_header
+
 log = logging.getLogger('main')
 
 
@@ -38,19 +40,26 @@ class TestingSupervisor(object):
         self.result.initialize_embedding()
 
     def _load_snapshot(self):
+        ckpt_path = latest_checkpoint(self.cfg.log_dir)
         log_dir = listdir(self.cfg.log_dir)
         #import pdb; pdb.set_trace()
-        if not any(fname.endswith(('.ckpt', '.pickle')) for fname in log_dir):
+        if ckpt_path is not None:
+            self._set_global_step(load_checkpoint_header(ckpt_path)['step'])
+            self.net.load_modules()  # (modules of the checkpoint)
+        elif not any(fname.endswith(('.ckpt', '.pickle'))
+                     for fname in log_dir):
             raise Exception("Can't find model.ckpt files in %s"
                             ""% self.cfg.log_dir)
         else:
             self._load_global_step()
             #self.net.load_batch_schedulers()
-            self.net.load_modules()
+            self.net.load_modules(self.cfg.log_dir)
 
     def _load_global_step(self):
         with open(self.global_step_fname, 'r') as f:
-            load_dict = json.load(f)
+            self._set_global_step(json.load(f))
+
+    def _set_global_step(self, load_dict):
         log.info(load_dict)
         self.global_step = load_dict['global_step']
         self.global_maxstep = load_dict['global_maxstep']
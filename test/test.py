@@ -4,16 +4,17 @@ import time
 from collections import OrderedDict
 from enum import Enum, auto, unique
 from test.evaluate import evaluate_sents
+from test.quantize import quantize_network
 from test.supervisor import TestingSupervisor
 
 import numpy as np
-import spacy
 import torch
 import torch.nn as nn
 import torch.nn.functional as F
 from loader.data import Batch
 from torch.autograd import Variable
-from train.train_helper import load_test_data, mask_output_target
+from train.train_helper import load_test_index, mask_output_target
+from utils.rng import rng
 from utils.utils import set_random_seed, to_gpu
 from utils.writer import ResultWriter
 
@@ -43,16 +44,19 @@ class Tester(object):
         self.cfg = net.cfg
         #self.fixed_noise = net.gen.make_noise_size_of(net.cfg.eval_size)
 
-        self.test_sents = load_test_data(net.cfg)
-        self.pos_one = to_gpu(net.cfg.cuda, torch.FloatTensor([1]))
+        self.test_index = load_test_index(net.cfg)
+        self.pos_one = torch.ones((), device=net.cfg.device)
         self.neg_one = self.pos_one * (-1)
 
         self.result = ResultWriter(net.cfg)
         self.sv = TestingSupervisor(net, self.result)
+        if self.cfg.quantize:  # after the modules are loaded
+            quantize_network(net)
         #self.sv.interval_func_train.update({net.enc.decay_noise_radius: 200})
 
         self.num_sample = 10
         self.max_sample = 64
+        import spacy  # slow to import, only when testing
         spacy_en = spacy.load('en')
         self.tokenizer = lambda s: [tok.text for tok in spacy_en.tokenizer(s)]
 
@@ -88,7 +92,7 @@ class Tester(object):
 
         elif input_ == TestMode.SAMPLE.value:
             log.info(TestMode.SAMPLE.start_msg)
-            z = np.random.normal(0, 1, (cfg.batch_size, cfg.z_size))
+            z = self.net.gen.get_noise(cfg.batch_size)
             decoded = self._decode_from_z(z)
             text = decoded.get_text(self.num_sample)
 
@@ -160,12 +164,12 @@ class Tester(object):
 
     def _get_interpolated_z(self, num_samples):
         # sample 2 points and compute the distance btwn them
-        z_a = np.random.normal(0, 1, (1, self.cfg.z_size))
-        z_b = np.random.normal(0, 1, (1, self.cfg.z_size))
-        dist = np.sqrt(np.sum((z_a - z_b)**2))
+        z_a, z_b = rng.normal('interp', (2, 1, self.cfg.z_size),
+                              device=self.cfg.device, dtype=self.cfg.dtype)
+        dist = (z_a - z_b).norm().item()
         # get intermediate points by interpolation
         offset = (z_b - z_a) / num_samples
-        z = np.vstack([z_a + offset * i for i in range(num_samples)])
+        z = torch.cat([z_a + offset * i for i in range(num_samples)])
         return z, dist
 
     def _autoencode_from_text(self, batch, decode_mode):
@@ -176,9 +180,9 @@ class Tester(object):
         #code_var = self.net.reg.with_var(code)
         #cos_sim = F.cosine_similarity(code, code_var, dim=1).mean()
         if decode_mode == 'tf':
-            decoded = self.net.dec.teacher_forcing(code, batch)
+            decoded = self.net.dec(code, batch=batch)
         elif decode_mode == 'fr':
-            decoded = self.net.dec.free_running(code, max(batch.enc_src.len))
+            decoded = self.net.dec(code, max_len=max(batch.enc_src.len))
         else:
             raise Exception("Unknown decode_mode type!")
         return decoded
@@ -186,8 +190,6 @@ class Tester(object):
     def _decode_from_z(self, z):
         self.net.set_modules_train_mode(True)
         # Build graph
-        z = Variable(torch.FloatTensor(z))
-        z = to_gpu(self.cfg.cuda, z)
         code_fake = self.net.gen(z)
-        decoded = self.net.dec.free_running(code_fake, self.cfg.max_len)
+        decoded = self.net.dec(code_fake, max_len=self.cfg.max_len)
         return decoded
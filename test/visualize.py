@@ -5,19 +5,14 @@ from collections import OrderedDict
 from enum import Enum, auto, unique
 from random import randint
 from test.evaluate import evaluate_sents
+from test.quantize import quantize_network
 from test.supervisor import TestingSupervisor
 
-import matplotlib
-matplotlib.use('Agg')
-import matplotlib.pyplot as plt
 import numpy as np
-import scipy.io as sio
-import spacy
 import torch
 import torch.nn as nn
 import torch.nn.functional as F
 from loader.data import Batch
-from sklearn.manifold import TSNE
 from torch.autograd import Variable
 from train.train_helper import load_test_data, mask_output_target
 from utils.utils import set_random_seed, to_gpu
@@ -51,6 +46,8 @@ class Visualizer(object):
 
         self.result = ResultWriter(net.cfg)
         self.sv = TestingSupervisor(net, self.result)
+        if self.cfg.quantize:  # after the modules are loaded
+            quantize_network(net)
         #self.sv.interval_func_train.update({net.enc.decay_noise_radius: 200})
 
         self.n_real = net.cfg.eval_size
@@ -63,6 +60,12 @@ class Visualizer(object):
 
     def sample_loop(self, cfg, net, sv):
         """Main test loop"""
+        # heavy & used only here
+        import matplotlib
+        matplotlib.use('Agg')
+        import matplotlib.pyplot as plt
+        from sklearn.manifold import TSNE
+
         # encode real
         code = list()
         batch = self.net.data_eval.next()
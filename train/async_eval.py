@@ -0,0 +1,211 @@
+from collections import OrderedDict
+from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, wait
+from copy import copy
+import logging
+
+import numpy as np
+import torch
+import torch.multiprocessing as mp
+
+from loader.data import Batch
+from models.encoder import VariationalRegularizer
+from models.generator import Generator
+from nn.embedding import Embedding
+from test.kenlm import train_kenlm
+from test.metrics import DiversityMetrics
+from train.network import encoder_class, decoder_class
+from train.train_helper import mask_output_target
+from utils.utils import set_device, set_random_seed
+
+log = logging.getLogger('main')
+odict = OrderedDict
+
+_context = None  # evaluation context of each worker process
+
+
+class AsyncEvaluator(object):
+    """Runs expensive evaluations in a separate process pool.
+
+    Parameters are snapshotted to CPU memory on the training thread and the
+    workers rebuild the modules they need from them, so the training loop
+    goes on while samples are generated and language models are trained.
+    Results are written to ResultWriter tagged with the originating step.
+    At most async_eval_workers * 2 jobs are in flight : if evaluation falls
+    behind, the oldest job still waiting in the queue is dropped (with its
+    snapshot) rather than letting snapshots pile up in memory.
+    """
+    def __init__(self, net, result_writer):
+        self.net = net
+        self.cfg = net.cfg
+        self.result = result_writer
+        self._pending = []
+        self._max_pending = self.cfg.async_eval_workers * 2
+
+        cfg_eval = copy(net.cfg)
+        cfg_eval.cuda = False  # workers always run on CPU
+        set_device(cfg_eval)
+        self._pool = ProcessPoolExecutor(
+            max_workers=self.cfg.async_eval_workers,
+            mp_context=mp.get_context('spawn'),
+            initializer=_init_worker,
+            initargs=(cfg_eval, net.vocab_w))
+
+    def submit_reverse_ppl(self, step, dec_name, label):
+        states = self._snapshot('embed_w', 'gen', dec_name)
+        self._submit(_reverse_ppl_job, step, states, dec_name, label)
+
+    def submit_eval_autoencoder(self, step, batch, label='AE_eval'):
+        states = self._snapshot('embed_w', 'enc', 'reg', 'dec')
+        self._submit(_eval_autoencoder_job, step, states,
+                     batch.batch, batch.lengths, label)
+
+    def submit_generate_text(self, step, label='Generated'):
+        states = self._snapshot('embed_w', 'gen', 'dec', 'dec2')
+        self._submit(_generate_text_job, step, states, label)
+
+    def collect(self, wait=False):
+        """Write the results of finished jobs. Never blocks unless wait."""
+        pending = []
+        for future in self._pending:
+            if not (wait or future.done()):
+                pending.append(future)
+                continue
+            try:
+                step, label, result_dict = future.result()
+            except Exception as e:
+                log.info("Async evaluation failed! (%s)" % e)
+                continue
+            self.result.add_at(step, label, result_dict)
+        self._pending = pending
+
+    def close(self):
+        self.collect(wait=True)
+        self._pool.shutdown(wait=True)
+
+    def _submit(self, fn, *args):
+        self.collect()
+        while len(self._pending) >= self._max_pending:
+            self._drop_oldest()
+        self._pending.append(self._pool.submit(fn, *args))
+
+    def _drop_oldest(self):
+        for future in self._pending:
+            if future.cancel():
+                self._pending.remove(future)
+                log.warning('Async evaluation is falling behind! Dropped the '
+                            'oldest queued job (%d in flight)'
+                            % len(self._pending))
+                return
+        # all of them started already
+        wait(self._pending, return_when=FIRST_COMPLETED)
+        self.collect()
+
+    def _snapshot(self, *names):
+        states = dict()
+        for name in names:
+            module = self.net._modules[name]
+            states[name] = {key: value.detach().cpu().clone()
+                            for key, value in module.state_dict().items()}
+        return states
+
+
+class _EvalContext(object):
+    """Minimal CPU copy of Network living in a worker process. Exposes the
+    same attributes as Network so that helpers like train_kenlm work."""
+    def __init__(self, cfg, vocab):
+        self.cfg = cfg
+        self.vocab_w = vocab
+        self.embed_w = Embedding(cfg, vocab)
+        self.enc = encoder_class(cfg)(cfg)
+        self.reg = VariationalRegularizer(cfg)
+        self.dec = decoder_class(cfg)(cfg, self.embed_w)
+        self.dec2 = decoder_class(cfg)(cfg, self.embed_w)
+        self.gen = Generator(cfg)
+        self.diversity = DiversityMetrics(cfg, vocab)
+
+    def load_states(self, states):
+        for name, state_dict in states.items():
+            getattr(self, name).load_state_dict(state_dict)
+
+
+def _init_worker(cfg, vocab):
+    global _context
+    torch.set_num_threads(cfg.async_eval_threads)
+    set_random_seed(cfg)  # noise streams of the worker
+    _context = _EvalContext(cfg, vocab)
+
+
+def _reverse_ppl_job(step, states, dec_name, label):
+    ctx = _context
+    ctx.load_states(states)
+    ctx.gen.train(True)  # same as Trainer._reverse_ppl
+    dec = getattr(ctx, dec_name).train(False)
+
+    decoded_text = []
+    decoded_ids = []
+    with torch.no_grad():
+        # generate 100 x 1000 samples
+        for i in range(100):
+            code_fake = ctx.gen(ctx.gen.get_noise(1000))
+            decoded = dec(code_fake, max_len=ctx.cfg.max_len)
+            decoded_text.append(decoded.get_text_batch())
+            decoded_ids.append(decoded.id.ids_array)
+
+    decoded_text = np.concatenate(decoded_text, axis=0)
+    result_dict = ctx.diversity.compute(np.concatenate(decoded_ids, axis=0))
+    try:
+        ppl = train_kenlm(ctx, decoded_text, step, label)
+        result_dict.update(ppl=ppl)
+    except:
+        log.info("Failed to train kenlm!")
+    return step, label, result_dict
+
+
+def _eval_autoencoder_job(step, states, ids, lengths, label):
+    ctx = _context
+    ctx.load_states(states)
+    for module in (ctx.embed_w, ctx.enc, ctx.reg, ctx.dec):
+        module.train(False)
+    batch = Batch(ctx.cfg, ctx.vocab_w, ids, lengths)
+
+    with torch.no_grad():
+        embed = ctx.embed_w(batch.enc_src.id)
+        enc_h = ctx.enc(embed, batch.enc_src.len)
+        code = ctx.reg.without_var(enc_h)
+        decoded = ctx.dec(code, max_len=ctx.cfg.max_len)
+
+    # Compute word prediction loss and accuracy
+    #   (same as Trainer._eval_autoencoder)
+    bsz = ctx.cfg.batch_size
+    maxlen = max(batch.enc_src.len)
+    vocab_size = len(ctx.vocab_w)
+    target = batch.dec_tar.id[:bsz*maxlen]
+    output = decoded.prob[:bsz].contiguous().view(-1, vocab_size)
+    output, target = mask_output_target(output, target, vocab_size)
+    loss_recon = ctx.dec.criterion_nll(output, target)
+    _, max_ids = torch.max(output, 1)
+    acc = torch.mean(max_ids.eq(target).float())
+
+    return step, label, odict(
+        loss_recon=loss_recon.item(),
+        acc=acc.item(),
+        text_real=decoded.get_text_with_pair(batch.enc_src.id),
+    )
+
+
+def _generate_text_job(step, states, label):
+    ctx = _context
+    ctx.load_states(states)
+    ctx.gen.train(True)  # same as Trainer._generate_text
+    ctx.dec.train(False)
+    ctx.dec2.train(False)
+
+    with torch.no_grad():
+        code_fake = ctx.gen.for_eval()
+        decoded1 = ctx.dec(code_fake, max_len=ctx.cfg.max_len)
+        decoded2 = ctx.dec2(code_fake, max_len=ctx.cfg.max_len)
+
+    return step, label, odict(
+        txt_word1=decoded1.get_text(),
+        txt_word2=decoded2.get_text(),
+    )
@@ -0,0 +1,86 @@
+"""Inference bundle : vocabulary, model configs and module weights in a
+single memory-mappable file (see utils.tensor_file), loaded without any
+dataset, optimizer or checkpoint directory."""
+from collections import OrderedDict
+from copy import copy
+import logging
+import time
+
+from train.network import InferenceNetwork
+from utils.tensor_file import load_tensors, save_tensors
+from utils.utils import Config
+
+log = logging.getLogger('main')
+
+BUNDLE_FORMAT = 'arae_bundle'
+BUNDLE_MODULES = ['embed_w', 'enc', 'reg', 'gen', 'dec']
+# configs the modules are built from. (the others are given at runtime)
+MODEL_CFG_KEYS = ['vocab_size_w', 'embed_size_w', 'hidden_size_w', 'nlayers',
+                  'z_size', 'arch_g', 'arch_d', 'arch_cnn', 'enc_type',
+                  'dec_type', 'dec_embed', 'embed_temp', 'max_len', 'dropout',
+                  'code_norm', 'noise_radius', 'pos_tag', 'fix_embed']
+# defaults of runtime configs when loaded without command line arguments
+RUNTIME_CFG = dict(cuda=False, seed=1111, batch_size=64, eval_size=500,
+                   log_nsample=4, clip=1)
+
+
+def export_bundle(net, file_path, names=BUNDLE_MODULES):
+    vocab = copy(net.vocab_w)
+    vocab._embed = None  # same as embed_w weights, restored when loaded
+    header = OrderedDict(
+        format=BUNDLE_FORMAT,
+        cfg={key: getattr(net.cfg, key) for key in MODEL_CFG_KEYS},
+        vocab=vocab,
+        modules=list(names),
+        aliases=OrderedDict(),
+    )
+    # tensors shared between modules (e.g. decoders have embed_w in them)
+    # are saved only once
+    tensors = OrderedDict()
+    saved = dict()
+    for name in names:
+        for key, tensor in net._modules[name].state_dict().items():
+            full_key = '%s.%s' % (name, key)
+            ptr = (tensor.data_ptr(), tuple(tensor.size()))
+            if ptr in saved:
+                header['aliases'][full_key] = saved[ptr]
+            else:
+                saved[ptr] = full_key
+                tensors[full_key] = tensor
+    save_tensors(file_path, header, tensors)
+    log.info('Inference bundle has been saved to : %s' % file_path)
+
+
+def load_bundle(file_path, cfg=None, names=None, mmap=True):
+    """Returns InferenceNetwork of the bundle.
+
+    Args:
+        cfg (Config): runtime configs (cuda, seed, ...). Model configs are
+            always taken from the bundle.
+        names (list): modules to build (default: all in the bundle)
+    """
+    start = time.time()
+    header, tensors = load_tensors(file_path, mmap=mmap)
+    if not isinstance(header, dict) or header.get('format') != BUNDLE_FORMAT:
+        raise Exception('Not an inference bundle : %s' % file_path)
+    for alias, key in header['aliases'].items():
+        tensors[alias] = tensors[key]
+
+    cfg = Config(RUNTIME_CFG) if cfg is None else copy(cfg)
+    cfg.update(header['cfg'])
+    vocab = header['vocab']
+    vocab._embed = tensors['embed_w.embed.weight'].numpy()
+
+    names = header['modules'] if names is None else names
+    for name in names:
+        if name not in header['modules']:
+            raise Exception("Module %s is not in the bundle : %s"
+                            % (name, file_path))
+    states = OrderedDict()
+    for full_key, tensor in tensors.items():
+        name, key = full_key.split('.', 1)
+        states.setdefault(name, OrderedDict())[key] = tensor
+    net = InferenceNetwork(cfg, vocab, names, states)
+    log.info('Inference bundle has been loaded from : %s (%.3f secs)'
+             % (file_path, time.time() - start))
+    return net
@@ -0,0 +1,372 @@
+"""Checkpoints of the whole training state, written off the training thread.
+
+A checkpoint is a single memory-mappable file (see utils.tensor_file),
+log_dir/checkpoints/step_<global step>.ckpt, holding
+    - parameters & buffers of the modules : 'module.<name>.<key>'
+    - optimizer states (e.g. Adam moments) : 'optim.<name>.<index>.<key>'
+    - in the header : the rest of the optimizer states, batch schedulers
+      (pickled, with the indices left in their epoch), random states of
+      utils.rng & the global generators, the loss scale of fp16 training,
+      global_step and a hash of the configs it was trained with.
+Tensors shared between modules (e.g. embed_w in decoders) are saved once.
+
+The training thread only snapshots the state to CPU memory; a background
+thread serializes it into a temp file renamed once complete, so that a
+crash in the middle of a save never leaves a broken checkpoint behind, and
+only the last --ckpt_keep checkpoints are kept. Save latencies go to
+results as 'Checkpoint' : snapshot (on the training thread), wait (for the
+previous save, if still running) and write.
+
+load_checkpoint reads the modules only (all or some, e.g. gen & dec for
+inference) from the mapped file, restore_checkpoint the whole state for
+resuming. archive_checkpoint makes an fp16 copy for archival.
+"""
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+import hashlib
+import json
+import logging
+import os
+import pickle
+import random
+import re
+import time
+
+import numpy as np
+import torch
+
+from train.bundle import MODEL_CFG_KEYS
+from utils.rng import rng
+from utils.tensor_file import load_header, load_tensors, save_tensors
+
+log = logging.getLogger('main')
+odict = OrderedDict
+
+CKPT_FORMAT = 'arae_checkpoint'
+CKPT_DIR = 'checkpoints'
+_STEP_FILE = re.compile(r'^step_(\d+)\.ckpt$')
+# configs a resumed run is expected to share with its checkpoint : those
+# the modules are built from (see train.bundle) & training hyperparameters
+TRAIN_CFG_KEYS = ['data_name', 'min_len', 'batch_size', 'epochs', 'niter_ae',
+                  'niter_gan_d', 'niter_gan_g', 'niter_gan_schedule',
+                  'lr_ae', 'lr_gan_g', 'lr_gan_d', 'beta1', 'clip',
+                  'gan_clamp', 'gan_to_enc', 'gan_to_dec', 'kl_term',
+                  'precision', 'seed']
+
+
+def hashed_configs(cfg):
+    return odict((key, getattr(cfg, key, None))
+                 for key in MODEL_CFG_KEYS + TRAIN_CFG_KEYS)
+
+
+def config_hash(configs):
+    dumped = json.dumps(configs, sort_keys=True, default=str)
+    return hashlib.sha1(dumped.encode()).hexdigest()[:16]
+
+
+def checkpoint_paths(log_dir):
+    """Complete checkpoints in log_dir, from the oldest"""
+    ckpt_root = os.path.join(log_dir, CKPT_DIR)
+    if not os.path.isdir(ckpt_root):
+        return []
+    paths = []
+    for fname in os.listdir(ckpt_root):
+        match = _STEP_FILE.match(fname)
+        if match:
+            paths.append((int(match.group(1)),
+                          os.path.join(ckpt_root, fname)))
+    return [file_path for _, file_path in sorted(paths)]
+
+
+def latest_checkpoint(log_dir):
+    paths = checkpoint_paths(log_dir)
+    return paths[-1] if paths else None
+
+
+def saved_module_names(log_dir):
+    """Modules in the latest checkpoint, or in name.ckpt files of log_dir
+    (saved before checkpoints/)"""
+    file_path = latest_checkpoint(log_dir)
+    if file_path is not None:
+        return list(load_checkpoint_header(file_path)['modules'])
+    if not os.path.isdir(log_dir):
+        return []
+    return [fname[:-len('.ckpt')] for fname in sorted(os.listdir(log_dir))
+            if fname.endswith('.ckpt')]
+
+
+def load_checkpoint_header(file_path):
+    """Header only, e.g. for global_step (the tensors aren't read)"""
+    header = load_header(file_path)[0]
+    _check_format(header, file_path)
+    return header
+
+
+def snapshot_network(net, step_dict):
+    """Header & CPU copies of the tensors of the training state"""
+    tensors = odict()
+    aliases = odict()
+    copied = dict()
+
+    def add(key, tensor):
+        ptr = (tensor.data_ptr(), tensor.dtype, tuple(tensor.size()),
+               tensor.stride())
+        if ptr in copied:
+            aliases[key] = copied[ptr]
+        else:
+            copied[ptr] = key
+            tensors[key] = tensor.detach().to('cpu', copy=True)
+
+    module_keys = odict()
+    for name, module in net.registered_modules():
+        state_dict = module.state_dict()
+        module_keys[name] = list(state_dict.keys())
+        for key, tensor in state_dict.items():
+            add('module.%s.%s' % (name, key), tensor)
+
+    optimizers = odict()
+    for name, optim_state in net.optimizers.state_dict().items():
+        state = odict()
+        for i, param_state in optim_state['state'].items():
+            state[i] = odict()
+            for key, value in param_state.items():
+                if torch.is_tensor(value):
+                    add('optim.%s.%d.%s' % (name, i, key), value)
+                else:
+                    state[i][key] = value
+        optimizers[name] = dict(state=state,
+                                param_groups=optim_state['param_groups'])
+
+    configs = hashed_configs(net.cfg)
+    loss_scaler = net.optimizers.loss_scaler
+    header = odict(
+        format=CKPT_FORMAT,
+        step=step_dict,
+        config_hash=config_hash(configs),
+        configs=configs,
+        modules=module_keys,
+        optimizers=optimizers,
+        schedulers=odict((name, pickle.dumps(scheduler)) for name, scheduler
+                         in net.registered_batch_schedulers()),
+        rng=_random_states(net.cfg),
+        loss_scaler=None if loss_scaler is None else loss_scaler.state_dict(),
+        aliases=aliases,
+        dtypes=odict(),  # key -> dtype saved in, if other (see archive)
+    )
+    return header, tensors
+
+
+def load_checkpoint(file_path, names=None, mmap=True):
+    """Returns the header and module name -> state dict, of the named
+    modules only if given. With mmap, tensors are views of the mapped file
+    (unless archived in fp16, cast back to their own types)."""
+    header, tensors = _load_checkpoint_tensors(file_path, names, mmap)
+    names = list(header['modules']) if names is None else names
+    states = odict()
+    for name in names:
+        if name not in header['modules']:
+            raise Exception("Module %s is not in the checkpoint : %s"
+                            % (name, file_path))
+        states[name] = odict(
+            (key, tensors['module.%s.%s' % (name, key)])
+            for key in header['modules'][name])
+    return header, states
+
+
+def load_optimizer_states(file_path, names):
+    """Optimizer states of the named modules (as OptimizerManager.state_dict
+    gives them), copied out of the file"""
+    header, tensors = _load_checkpoint_tensors(file_path, names,
+                                               prefix='optim')
+    return _optimizer_states(header, tensors, names)
+
+
+def restore_checkpoint(net, file_path):
+    """Loads everything snapshot_network saved into net (and the global
+    random states) for resuming. Returns the header."""
+    start = time.time()
+    header, tensors = _load_checkpoint_tensors(file_path, mmap=True)
+    cfg = net.cfg
+    if header['config_hash'] != config_hash(hashed_configs(cfg)):
+        configs = hashed_configs(cfg)
+        log.warning('Configs differ from the checkpoint : %s' % ', '.join(
+            '%s (%s -> %s)' % (key, value, configs.get(key))
+            for key, value in header['configs'].items()
+            if value != configs.get(key)))
+
+    for name, module in net.registered_modules():
+        module.load_state_dict(odict(
+            (key, tensors['module.%s.%s' % (name, key)])
+            for key in header['modules'][name]))
+
+    net.optimizers.load_state_dict(_optimizer_states(header, tensors))
+
+    for name, scheduler in net.registered_batch_schedulers():
+        scheduler.load_from_bytes(header['schedulers'][name])
+    if net.optimizers.loss_scaler is not None and \
+            header['loss_scaler'] is not None:
+        net.optimizers.loss_scaler.load_state_dict(header['loss_scaler'])
+    if cfg.rank == 0:  # other ranks of --distributed keep their own noise
+        _set_random_states(cfg, header['rng'])
+    log.info('Checkpoint has been loaded from : %s (%.3f secs)'
+             % (file_path, time.time() - start))
+    return header
+
+
+def archive_checkpoint(src_path, dst_path):
+    """Copy of a checkpoint with floating point tensors (weights & optimizer
+    moments, not scalars like Adam steps) in fp16. It loads as the others,
+    cast back to the types they were trained in."""
+    header, tensors = load_tensors(src_path, mmap=True)
+    _check_format(header, src_path)
+    for key, tensor in tensors.items():
+        if tensor.is_floating_point() and tensor.dim() > 0 and \
+                tensor.dtype != torch.float16:
+            header['dtypes'][key] = str(tensor.dtype).replace('torch.', '')
+            tensors[key] = tensor.half()
+    save_tensors(dst_path, header, tensors)
+    log.info('Archived checkpoint (fp16) has been saved to : %s (%.1f MB -> '
+             '%.1f MB)' % (dst_path, os.path.getsize(src_path) / 2**20,
+                           os.path.getsize(dst_path) / 2**20))
+
+
+class CheckpointWriter(object):
+    def __init__(self, net, result_writer):
+        self.net = net
+        self.cfg = net.cfg
+        self.result = result_writer
+        self.ckpt_root = os.path.join(self.cfg.log_dir, CKPT_DIR)
+        os.makedirs(self.ckpt_root, exist_ok=True)
+        self._remove_incomplete()
+        self._pool = None  # saves on the training thread
+        if self.cfg.ckpt_async:
+            self._pool = ThreadPoolExecutor(max_workers=1)
+        self._pending = None  # (step, future, latencies)
+
+    def save(self, global_step, step_dict):
+        """Snapshots the network and writes it in the background. Blocks
+        only while the previous save is still being written."""
+        start = time.time()
+        self.collect(wait=True)  # one save at a time
+        wait_secs = time.time() - start
+        header, tensors = snapshot_network(self.net, step_dict)
+        latencies = odict(snapshot_secs=time.time() - start - wait_secs,
+                          wait_secs=wait_secs)
+        if self._pool is None:
+            latencies.update(self._write(global_step, header, tensors))
+            self.result.add_at(global_step, 'Checkpoint', latencies)
+        else:
+            future = self._pool.submit(self._write, global_step, header,
+                                       tensors)
+            self._pending = (global_step, future, latencies)
+
+    def collect(self, wait=False):
+        """Reports the save in the background once it is written. Never
+        blocks unless wait."""
+        if self._pending is None:
+            return
+        step, future, latencies = self._pending
+        if not (wait or future.done()):
+            return
+        self._pending = None
+        try:
+            latencies.update(future.result())
+        except Exception as e:
+            log.warning('Failed to save the checkpoint of step %d! (%s)'
+                        % (step, e))
+            return
+        self.result.add_at(step, 'Checkpoint', latencies)
+
+    def close(self):
+        self.collect(wait=True)
+        if self._pool is not None:
+            self._pool.shutdown(wait=True)
+
+    def _write(self, global_step, header, tensors):
+        start = time.time()
+        file_path = os.path.join(self.ckpt_root,
+                                 'step_%08d.ckpt' % global_step)
+        save_tensors(file_path, header, tensors)  # temp file & rename
+        self._remove_old()
+        return odict(write_secs=time.time() - start,
+                     mbytes=os.path.getsize(file_path) / 2**20)
+
+    def _remove_old(self):
+        paths = checkpoint_paths(self.cfg.log_dir)
+        for file_path in paths[:-max(1, self.cfg.ckpt_keep)]:
+            os.remove(file_path)
+
+    def _remove_incomplete(self):
+        # temp files left by a crash while writing
+        for fname in os.listdir(self.ckpt_root):
+            if fname.endswith('.tmp'):
+                os.remove(os.path.join(self.ckpt_root, fname))
+
+
+def _check_format(header, file_path):
+    if not isinstance(header, dict) or header.get('format') != CKPT_FORMAT:
+        raise Exception('Not a checkpoint : %s' % file_path)
+
+
+def _load_checkpoint_tensors(file_path, names=None, mmap=True,
+                             prefix='module'):
+    """Header & tensors (with aliases), only those of the named modules
+    ('<prefix>.<name>.<key>') if given"""
+    header, layout, _ = load_header(file_path)
+    _check_format(header, file_path)
+    keys = None
+    if names is not None:
+        prefixes = tuple('%s.%s.' % (prefix, name) for name in names)
+        keys = set(key for key in list(layout) + list(header['aliases'])
+                   if key.startswith(prefixes))
+        keys |= set(header['aliases'][key] for key in keys
+                    if key in header['aliases'])
+    header, tensors = load_tensors(file_path, keys, mmap)
+    for key, dtype in header['dtypes'].items():
+        if key in tensors:
+            tensors[key] = tensors[key].to(getattr(torch, dtype))
+    for key, saved in header['aliases'].items():
+        if saved in tensors and (keys is None or key in keys):
+            tensors[key] = tensors[saved]
+    return header, tensors
+
+
+def _optimizer_states(header, tensors, names=None):
+    optim_states = odict()
+    for name, optim_state in header['optimizers'].items():
+        if names is not None and name not in names:
+            continue
+        state = dict()
+        for i, param_state in optim_state['state'].items():
+            state[i] = dict(param_state)
+        optim_states[name] = dict(state=state,
+                                  param_groups=optim_state['param_groups'])
+    for key, tensor in tensors.items():
+        if key.startswith('optim.'):
+            _, name, i, state_key = key.split('.', 3)
+            if name in optim_states:
+                # copied out of the mapped file, being updated in place
+                optim_states[name]['state'][int(i)][state_key] = \
+                    tensor.clone()
+    return optim_states
+
+
+def _random_states(cfg):
+    states = odict(
+        streams=rng.state_dict(),
+        torch=torch.get_rng_state(),
+        numpy=np.random.get_state(),
+        random=random.getstate(),
+    )
+    if cfg.cuda and torch.cuda.is_available():
+        states['cuda'] = torch.cuda.get_rng_state_all()
+    return states
+
+
+def _set_random_states(cfg, states):
+    rng.load_state_dict(states['streams'])
+    torch.set_rng_state(states['torch'])
+    np.random.set_state(states['numpy'])
+    random.setstate(states['random'])
+    if 'cuda' in states and cfg.cuda and torch.cuda.is_available():
+        torch.cuda.set_rng_state_all(states['cuda'])
@@ -0,0 +1,296 @@
+"""Distillation of a trained rnn decoder (dec or dec2) into a smaller one.
+
+The student (models.decoder.StudentDecoder) is trained on the codes the
+teacher decodes at test time : codes of the generator and codes of corpus
+sentences given by the encoder, half a batch each. The teacher greedily
+decodes every code and its sentence is fed to both decoders (teacher
+forcing). The student then learns either
+
+    token : the distributions of the teacher at every step (KL divergence,
+            softened by --distill_temp)
+    seq   : the sentence of the teacher itself (NLL of the teacher's greedy
+            output, the mode of the sequence level distribution)
+
+With a shortlist, distributions of the teacher are renormalized over it and
+target words out of it are mapped to <unk>.
+
+Saved to log_dir are student.ckpt, student.json (to rebuild the student, see
+build_student) and distill_report.json.
+"""
+from collections import OrderedDict
+import json
+import logging
+import os
+import time
+
+import numpy as np
+import torch
+import torch.nn.functional as F
+import torch.optim as optim
+
+from models.decoder import DecoderRNN, StudentDecoder
+from test.encode import encode_batch
+from test.evaluate import evaluate_sents
+from test.kenlm import train_kenlm
+from train.train_helper import load_test_index
+from utils.utils import set_random_seed
+
+log = logging.getLogger('main')
+odict = OrderedDict
+
+STUDENT_CONFIG = 'student.json'
+SHORTLIST_BATCHES = 100  # teacher outputs counted to build the shortlist
+REPORT_BATCHES = 100  # x 1000 samples, as Trainer._reverse_ppl
+
+
+def load_student_config(cfg):
+    file_path = os.path.join(cfg.log_dir, STUDENT_CONFIG)
+    if not os.path.exists(file_path):
+        raise Exception("Can't find a distilled decoder in %s! "
+                        "(train one with --distill)" % cfg.log_dir)
+    with open(file_path) as f:
+        return json.load(f)
+
+
+def build_student(cfg, embed_w, config):
+    """Student of the given config. The shortlist is a placeholder to be
+    filled by load_state_dict."""
+    shortlist = None
+    if config['shortlist_size'] > 0:
+        shortlist = torch.zeros(config['shortlist_size']).long()
+    return StudentDecoder(cfg, embed_w, config['hidden_size'], shortlist)
+
+
+class Distiller(object):
+    def __init__(self, net):
+        self.net = net
+        self.cfg = cfg = net.cfg
+        if cfg.dec_type != 'rnn':
+            raise Exception('Only the rnn decoder can be distilled!')
+        net.load_modules()
+        set_random_seed(cfg)
+        net.set_modules_train_mode(False)
+        self.teacher = getattr(net, cfg.distill_teacher)
+        assert isinstance(self.teacher, DecoderRNN)
+
+        self.config = odict(
+            teacher=cfg.distill_teacher,
+            hidden_size=cfg.student_hidden or cfg.hidden_size_w,
+            shortlist_size=min(cfg.student_vocab, len(net.vocab_w)),
+            loss=cfg.distill_loss,
+        )
+        shortlist = None
+        if self.config['shortlist_size'] > 0:
+            shortlist = self.build_shortlist(self.config['shortlist_size'])
+        self.student = StudentDecoder(cfg, net.embed_w,
+                                      self.config['hidden_size'], shortlist)
+        self.student = self.student.to(cfg.device)
+        if shortlist is not None:
+            # target words out of the shortlist -> <unk>
+            shortlist = self.student.shortlist
+            unk_id = (shortlist == net.vocab_w.UNK_ID).nonzero()[0, 0]
+            self.full_to_short = unk_id.repeat(len(net.vocab_w))
+            self.full_to_short[shortlist] = torch.arange(
+                len(shortlist), device=shortlist.device)
+
+        # embed_w is shared with the teacher and left as it is
+        self.params = [p for name, p in self.student.named_parameters()
+                       if not name.startswith('embed_w.')]
+        self.optimizer = optim.Adam(self.params, lr=cfg.distill_lr)
+        log.info('Distilling %s (hidden %d, vocab %d) into a student '
+                 '(hidden %d, vocab %s) with %s level loss' % (
+                     cfg.distill_teacher, cfg.hidden_size_w, len(net.vocab_w),
+                     self.config['hidden_size'],
+                     self.config['shortlist_size'] or len(net.vocab_w),
+                     cfg.distill_loss))
+
+        self.train()
+        self.save()
+        self.report()
+
+    def sample_codes(self, batch_size=None):
+        """Generated codes and codes of a training batch, half and half"""
+        net = self.net
+        batch_size = batch_size or self.cfg.batch_size
+        num_fake = batch_size // 2
+        with torch.no_grad():
+            # generator in train mode (batch statistics) as in TextGenerator
+            net.gen.train(True)
+            code_fake = net.gen(net.gen.get_noise(num_fake))
+            net.gen.train(False)
+            code_real = encode_batch(net, net.data_ae.next())
+        return torch.cat([code_fake, code_real[:batch_size - num_fake]], 0)
+
+    def build_shortlist(self, size):
+        """The most frequent words of the teacher's outputs, along with the
+        special tokens"""
+        vocab = self.net.vocab_w
+        counts = 0
+        for _ in range(SHORTLIST_BATCHES):
+            code = self.sample_codes()
+            ids = self.teacher.decode_ids(code, self.cfg.max_len)
+            counts = counts + torch.bincount(ids.view(-1),
+                                             minlength=len(vocab)).float()
+        ranks = counts.clone()
+        for idx in [vocab.PAD_ID, vocab.SOS_ID, vocab.EOS_ID, vocab.UNK_ID]:
+            ranks[idx] = float('inf')
+        shortlist = ranks.topk(size)[1].sort()[0]
+        log.info('Shortlist of %d words covers %.2f%% of the teacher outputs'
+                 % (size, 100 * counts[shortlist].sum() / counts.sum()))
+        return shortlist.cpu()
+
+    def teacher_sentences(self, code):
+        """Greedy outputs of the teacher for teacher forcing of both
+        decoders : <sos> w1 .. wn (inputs) and w1 .. wn <eos> (targets)"""
+        vocab = self.net.vocab_w
+        ids = self.teacher.decode_ids(code, self.cfg.max_len)
+        # pads from <eos> (or a pad the teacher emitted) on
+        lengths = ids.ne(vocab.PAD_ID).long().cumprod(1).sum(1)
+        max_len = int(lengths.max()) + 1
+        positions = torch.arange(max_len, device=ids.device).unsqueeze(0)
+        targets = ids.new_full((ids.size(0), max_len), vocab.PAD_ID)
+        num_ids = min(max_len, ids.size(1))
+        targets[:, :num_ids] = ids[:, :num_ids]
+        targets = targets.masked_fill(positions >= lengths.unsqueeze(1),
+                                      vocab.PAD_ID)
+        # <eos> right after the last word
+        targets.scatter_(1, lengths.unsqueeze(1), vocab.EOS_ID)
+        sos = ids.new_full((ids.size(0), 1), vocab.SOS_ID)
+        inputs = torch.cat([sos, targets[:, :-1]], 1)
+        mask = positions <= lengths.unsqueeze(1)
+        return inputs, targets, mask
+
+    def distill_loss(self, code, inputs, targets, mask):
+        lengths = [inputs.size(1)] * inputs.size(0)  # as Batch does
+        with torch.no_grad():
+            prob_t = self.teacher._decode_teacher_force(
+                code, inputs, lengths).prob
+        prob_s = self.student._decode_teacher_force(code, inputs, lengths).prob
+
+        shortlist = self.student.shortlist
+        if shortlist is not None:
+            # student's are already normalized over the shortlist
+            prob_s = prob_s[..., shortlist]
+            prob_t = F.log_softmax(prob_t[..., shortlist], 2)
+            targets = self.full_to_short[targets]
+
+        if self.cfg.distill_loss == 'token':
+            temp = self.cfg.distill_temp
+            prob_t = F.log_softmax(prob_t / temp, 2)
+            prob_s = F.log_softmax(prob_s / temp, 2)
+            loss = (prob_t.exp() * (prob_t - prob_s)).sum(2) * temp ** 2
+        else:
+            loss = -prob_s.gather(2, targets.unsqueeze(2)).squeeze(2)
+        return loss[mask].mean()
+
+    def train(self):
+        cfg = self.cfg
+        self.student.train(True)
+        start_time = time.time()
+        total_loss = 0
+        for step in range(1, cfg.distill_steps + 1):
+            code = self.sample_codes()
+            inputs, targets, mask = self.teacher_sentences(code)
+            loss = self.distill_loss(code, inputs, targets, mask)
+
+            self.optimizer.zero_grad()
+            loss.backward()
+            torch.nn.utils.clip_grad_norm_(self.params, cfg.clip)
+            self.optimizer.step()
+
+            total_loss += loss.item()
+            if step % cfg.log_interval == 0:
+                log.info('| Distill | step %d/%d | loss %.4f | %.1f '
+                         'steps/sec |' % (step, cfg.distill_steps,
+                                          total_loss / cfg.log_interval,
+                                          step / (time.time() - start_time)))
+                total_loss = 0
+        self.student.train(False)
+
+    def save(self):
+        cfg = self.cfg
+        fname = os.path.join(cfg.log_dir, 'student.ckpt')
+        with open(fname, 'wb') as f:
+            torch.save(self.student.state_dict(), f)
+        with open(os.path.join(cfg.log_dir, STUDENT_CONFIG), 'w') as f:
+            json.dump(self.config, f, indent=2)
+        log.info('Student decoder has been saved to : %s' % fname)
+
+    def decode(self, dec, codes):
+        """Texts & ids of the codes, and the secs decoding took"""
+        texts, ids, secs = [], [], 0
+        for code in codes:
+            start = time.perf_counter()
+            ids_batch = dec.decode_ids(code, self.cfg.max_len)
+            if self.cfg.cuda:
+                torch.cuda.synchronize()
+            secs += time.perf_counter() - start
+            ids_batch = ids_batch.cpu().numpy()
+            texts.extend(self.net.vocab_w.ids2text_batch(ids_batch))
+            ids.append(ids_batch)
+        return texts, np.concatenate(ids, 0), secs
+
+    def report(self):
+        """Speedup of the student against its BLEU & reverse PPL deltas.
+
+        Both decoders decode the same generated codes (100 x 1000, as in
+        Trainer._reverse_ppl). BLEU is computed against test sentences as
+        in Trainer, over the first eval_size samples."""
+        cfg = self.cfg
+        net = self.net
+        test_index = load_test_index(cfg)
+        codes = []
+        with torch.no_grad():
+            net.gen.train(True)
+            for _ in range(REPORT_BATCHES):
+                codes.append(net.gen(net.gen.get_noise(1000)))
+            net.gen.train(False)
+
+        def num_params(dec):
+            return sum(p.numel() for name, p in dec.named_parameters()
+                       if not name.startswith('embed_w.'))
+
+        results = odict()
+        ids = odict()
+        for name, dec in [('teacher', self.teacher),
+                          ('student', self.student)]:
+            texts, ids[name], secs = self.decode(dec, codes)
+            bleu = evaluate_sents(test_index, texts[:cfg.eval_size])['bleu']
+            try:
+                ppl = train_kenlm(net, texts, 0, 'distill_' + name)
+            except Exception:
+                log.info('Failed to train kenlm!')
+                ppl = None
+            results[name] = odict(params=num_params(dec), decode_secs=secs,
+                                  bleu=bleu, reverse_ppl=ppl)
+
+        teacher, student = results['teacher'], results['student']
+        results['speedup'] = teacher['decode_secs'] / student['decode_secs']
+        results['bleu_delta'] = student['bleu'] - teacher['bleu']
+        if teacher['reverse_ppl'] is not None and \
+                student['reverse_ppl'] is not None:
+            results['reverse_ppl_delta'] = \
+                student['reverse_ppl'] - teacher['reverse_ppl']
+        results['token_agree'] = float(np.mean(
+            ids['teacher'] == ids['student']))
+        results['config'] = self.config
+
+        log.info('| %-7s | %10s | %10s | %8s | %11s |' % (
+            '', 'params', 'decode(s)', 'bleu', 'reverse ppl'))
+        for name in ['teacher', 'student']:
+            r = results[name]
+            log.info('| %-7s | %10d | %10.2f | %8.4f | %11s |' % (
+                name, r['params'], r['decode_secs'], r['bleu'],
+                '-' if r['reverse_ppl'] is None else
+                '%.2f' % r['reverse_ppl']))
+        log.info('| speedup %.2fx | bleu delta %+.4f | reverse ppl delta %s '
+                 '| token agreement %.4f |' % (
+                     results['speedup'], results['bleu_delta'],
+                     '%+.2f' % results['reverse_ppl_delta']
+                     if 'reverse_ppl_delta' in results else '-',
+                     results['token_agree']))
+
+        report_path = os.path.join(cfg.log_dir, 'distill_report.json')
+        with open(report_path, 'w') as f:
+            json.dump(results, f, indent=2)
+        log.info('Distillation report has been saved to : %s' % report_path)
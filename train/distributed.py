@@ -0,0 +1,156 @@
+"""Data-parallel training over processes with the gloo backend (--distributed)
+on CPUs of one machine or several. Launch one process per rank with
+launch_ddp.sh (torchrun), which sets RANK, WORLD_SIZE, LOCAL_WORLD_SIZE,
+MASTER_ADDR & MASTER_PORT.
+
+Every rank trains the same network on its own shard of the training set
+(data_ae & data_gan, see Network._build_dataset), and gradients of the
+modules are averaged over the ranks by OptimizerManager before they are
+clipped or stepped, so the ranks stay in sync. Modules are not wrapped by
+DistributedDataParallel : a phase runs modules several times (e.g. disc on
+real & fake codes) and backprops into modules it doesn't step, which its
+hooks aren't made for. Batch norm uses the statistics of each rank's batch.
+
+Results, evaluation and checkpoints are left to rank 0 (the main process).
+"""
+import json
+import logging
+import os
+import time
+
+import torch
+import torch.distributed as dist
+from torch._utils import _flatten_dense_tensors, _unflatten_dense_tensors
+
+log = logging.getLogger('main')
+
+
+def init_distributed(cfg):
+    if cfg.cuda:
+        raise Exception('--distributed trains on CPU only! (--cuda false)')
+    dist.init_process_group('gloo')
+    cfg.update(dict(rank=dist.get_rank(), world_size=dist.get_world_size()))
+    # intra-op threads shared by the ranks of a machine
+    local_world_size = int(os.environ.get('LOCAL_WORLD_SIZE',
+                                          cfg.world_size))
+    num_threads = cfg.num_threads or max(
+        1, (os.cpu_count() or 1) // local_world_size)
+    torch.set_num_threads(num_threads)
+    return cfg
+
+
+def broadcast_modules(net, src=0):
+    """Parameters & buffers of rank src for every rank (e.g. initial weights
+    drawn with different seeds, or a snapshot only src could load)"""
+    for name, module in net.registered_modules():
+        if name in net.frozen:  # the same stage file everywhere
+            continue
+        for tensor in module.state_dict().values():
+            dist.broadcast(tensor, src)
+
+
+def broadcast_optimizers(net, src=0):
+    """Optimizer states (e.g. Adam moments & steps) and the loss scale of
+    rank src for every rank, as broadcast_modules does for the modules (e.g.
+    restored from a checkpoint other nodes can't see)"""
+    optimizers = net.optimizers
+    loss_scaler = optimizers.loss_scaler
+    states = None
+    if dist.get_rank() == src:
+        states = (optimizers.state_dict(),
+                  None if loss_scaler is None else loss_scaler.state_dict())
+    optim_states, scaler_state = broadcast_object(states, src)
+    if dist.get_rank() != src:
+        optimizers.load_state_dict(optim_states)
+        if loss_scaler is not None and scaler_state is not None:
+            loss_scaler.load_state_dict(scaler_state)
+
+
+def broadcast_object(obj, src=0):
+    """obj (picklable) of rank src for every rank"""
+    objects = [obj]
+    dist.broadcast_object_list(objects, src)
+    return objects[0]
+
+
+class GradientReducer(object):
+    """Averages gradients over the ranks, with one all-reduce of a flat
+    buffer per call (see OptimizerManager.set_grad_reducer)"""
+    def __init__(self, world_size):
+        self.world_size = world_size
+
+    def all_reduce_(self, grads):
+        if not grads:
+            return
+        buffer = _flatten_dense_tensors(grads)
+        dist.all_reduce(buffer)
+        buffer.div_(self.world_size)
+        for grad, reduced in zip(
+                grads, _unflatten_dense_tensors(buffer, grads)):
+            grad.copy_(reduced)
+
+
+class ScalingBenchmark(object):
+    """Training throughput over --bench_steps steps (the first tenth being
+    a warm-up), added to log_dir/scaling.json by the world size. Run it
+    with each number of ranks : launch_ddp.sh scaling [args]
+
+    Steps are counted from the one the run starts at, which is not 0 when
+    it resumed from a checkpoint."""
+    def __init__(self, cfg):
+        self.cfg = cfg
+        self.warmup_steps = max(1, cfg.bench_steps // 10)
+        self.first_step = None
+        self.start_step = None
+        self.start_time = None
+
+    def is_done(self, global_step):
+        if self.first_step is None:
+            self.first_step = global_step
+        num_steps = global_step - self.first_step
+        if self.start_time is None and num_steps >= self.warmup_steps:
+            self.start_step = global_step
+            self.start_time = time.time()
+        if num_steps < self.cfg.bench_steps:
+            return False
+        self.report(global_step - self.start_step,
+                    time.time() - self.start_time)
+        return True
+
+    def report(self, num_steps, secs):
+        cfg = self.cfg
+        if cfg.distributed:  # the slowest rank
+            secs = torch.tensor(secs)
+            dist.all_reduce(secs, op=dist.ReduceOp.MAX)
+            secs = secs.item()
+        if cfg.rank != 0:
+            return
+        result = dict(
+            world_size=cfg.world_size,
+            num_threads=torch.get_num_threads(),
+            batch_size=cfg.batch_size,
+            steps_per_sec=num_steps / secs,
+            # autoencoder samples of all the ranks
+            samples_per_sec=num_steps * cfg.batch_size * cfg.world_size /
+            secs)
+        file_path = os.path.join(cfg.log_dir, 'scaling.json')
+        results = dict()
+        if os.path.exists(file_path):
+            with open(file_path) as f:
+                results = json.load(f)
+        results[str(cfg.world_size)] = result
+        base = results.get('1')
+        for value in results.values():
+            if base is not None:
+                value['speedup'] = \
+                    value['samples_per_sec'] / base['samples_per_sec']
+        with open(file_path, 'w') as f:
+            json.dump(results, f, indent=2)
+
+        log.info('| Scaling | %s |' % ' | '.join(
+            '%s : %.4f' % (k, v) for k, v in result.items()))
+        for value in sorted(results.values(), key=lambda v: v['world_size']):
+            log.info('| ranks %3d | %10.1f samples/sec | speedup %s |' % (
+                value['world_size'], value['samples_per_sec'],
+                '%.2fx' % value['speedup'] if 'speedup' in value else '-'))
+        log.info('Scaling numbers have been saved to : %s' % file_path)
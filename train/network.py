@@ -1,11 +1,12 @@
 from collections import OrderedDict
+import inspect
 import logging
 from os import path
 
 import torch
 import torch.optim as optim
 import torch.nn as nn
-from torch.utils.data import Dataset, DataLoader
+from torch.utils.data import Dataset, DataLoader, DistributedSampler
 
 from loader.data import (BatchCollator, POSBatchCollator, DataScheduler,
                          MyDataLoader)
@@ -18,22 +19,276 @@ from models.disc_code import CodeDiscriminator
 from models.generator import Generator, ReversedGenerator
 from models.disc_sample import SampleDiscriminator
 from nn.embedding import Embedding
+from utils.utils import set_device
 
 log = logging.getLogger('main')
 
 
+def encoder_class(cfg):
+    if cfg.enc_type == 'cnn':
+        return EncoderCNN
+    elif cfg.enc_type == 'rnn':
+        return EncoderRNN
+    else:
+        raise ValueError('Unknown encoder type!')
+
+
+def decoder_class(cfg):
+    if cfg.dec_type == 'cnn':
+        return DecoderCNN
+    elif cfg.dec_type == 'rnn':
+        return DecoderRNN
+    else:
+        raise ValueError('Unknown decoder type!')
+
+
+class OptimizerManager(object):
+    """Optimizers of named modules, grouped by type & hyperparameters.
+
+    Modules of the same optimizer type & hyperparameters get a param group
+    each in a single optimizer, which updates them with fused (on gpu) or
+    foreach kernels. Stepping some of them takes one step of each optimizer
+    over their groups, and clipping their gradients takes one multi-tensor
+    norm.
+
+    Parameters shared by modules (e.g. embed_w of the decoders) belong to the
+    group of the module added first, which is stepped along with each of the
+    others, as many times as their own optimizers would have done.
+    """
+    def __init__(self, cfg):
+        self.cfg = cfg
+        self._optimizers = OrderedDict()  # (type, hyperparameters) -> optim
+        self._groups = OrderedDict()  # name -> (optimizer key, param group)
+        self._params = OrderedDict()  # name -> parameters of the module
+        self._owners = OrderedDict()  # name -> names of groups to step
+        self._owner_of = dict()  # parameter -> name of its group
+        self._step_post_hooks = OrderedDict()  # name -> [hook()]
+        self._clip_plans = dict()
+        self.loss_scaler = None  # see set_loss_scaler
+        self.grad_reducer = None  # see set_grad_reducer
+        self._prepared = set()  # ids of parameters prepared since a step
+
+    def add(self, name, module, optim_class, **hyperparams):
+        if name in self._params:
+            raise ValueError("Optimizer name %s already exists" % name)
+        key = (optim_class, tuple(sorted(hyperparams.items())))
+        params = list(module.parameters())
+        own = [p for p in params if p not in self._owner_of]
+
+        owners = [name] if own else []
+        for p in params:
+            owner = self._owner_of.get(p, name)
+            if owner not in owners:
+                owners.append(owner)
+        for owner in owners[1 if own else 0:]:
+            if self._groups[owner][0] != key:
+                raise ValueError("%s shares parameters with %s of another "
+                                 "optimizer type or hyperparameters" %
+                                 (name, owner))
+            param_ids = set(id(p) for p in params)
+            if any(id(p) not in param_ids
+                   for p in self._params_of_group(owner)):
+                raise ValueError("%s shares a part of the parameters of %s" %
+                                 (name, owner))
+
+        if own:
+            optimizer = self._optimizers.get(key)
+            group = dict(params=own, name=name)
+            if optimizer is None:
+                kwargs = dict(hyperparams, **self._update_kwargs(optim_class))
+                optimizer = optim_class([group], **kwargs)
+                self._optimizers[key] = optimizer
+            else:
+                optimizer.add_param_group(group)
+            self._groups[name] = (key, optimizer.param_groups[-1])
+            for p in own:
+                self._owner_of[p] = name
+        self._params[name] = params
+        self._owners[name] = owners
+        return NamedOptimizer(self, name)
+
+    def _update_kwargs(self, optim_class):
+        # fused kernels on gpu if the optimizer has them, foreach otherwise
+        signature = inspect.signature(optim_class)
+        if self.cfg.cuda and 'fused' in signature.parameters:
+            return dict(fused=True)
+        return dict(foreach=True)
+
+    def _params_of_group(self, name):
+        return self._groups[name][1]['params']
+
+    def names(self):
+        return list(self._params.keys())
+
+    def own_parameters(self, name):
+        """Parameters of the module, but those of the modules added before
+        (e.g. embed_w of decoders)"""
+        if name not in self._groups:
+            return []
+        return list(self._params_of_group(name))
+
+    def param_groups(self, name):
+        return [self._groups[owner][1] for owner in self._owners[name]]
+
+    def register_step_post_hook(self, name, hook):
+        """hook() is called after every step of the named module"""
+        if name not in self._params:
+            raise ValueError("Can't find optimizer name of %s" % name)
+        self._step_post_hooks.setdefault(name, []).append(hook)
+
+    def set_loss_scaler(self, loss_scaler):
+        """Gradients are scaled by loss_scaler (train.precision.LossScaler) :
+        they are unscaled before clipping or stepping, and steps are skipped
+        when any of them has inf/nan."""
+        self.loss_scaler = loss_scaler
+
+    def set_grad_reducer(self, grad_reducer):
+        """Gradients are averaged over processes by grad_reducer
+        (train.distributed.GradientReducer) before clipping or stepping"""
+        self.grad_reducer = grad_reducer
+
+    def _prepare_grads(self, names):
+        # all-reduced & unscaled once, before the first clipping or step
+        if self.loss_scaler is None and self.grad_reducer is None:
+            return
+        grads = []
+        for name in names:
+            for p in self._params[name]:
+                if p.grad is not None and id(p) not in self._prepared:
+                    self._prepared.add(id(p))
+                    grads.append(p.grad)
+        if self.grad_reducer is not None:
+            self.grad_reducer.all_reduce_(grads)
+        if self.loss_scaler is not None:
+            self.loss_scaler.unscale_(grads)
+
+    def step(self, *names):
+        """Same as the step of each module's own optimizer in turn"""
+        self._prepare_grads(names)
+        self._prepared.clear()
+        if self.loss_scaler is not None and not self.loss_scaler.update():
+            return  # inf/nan gradients
+        groups = OrderedDict()  # optimizer key -> param groups to step
+        for name in names:
+            for owner in self._owners[name]:
+                key, group = self._groups[owner]
+                groups.setdefault(key, []).append(group)
+        for key, param_groups in groups.items():
+            optimizer = self._optimizers[key]
+            all_groups = optimizer.param_groups
+            optimizer.param_groups = param_groups
+            try:
+                optimizer.step()
+            finally:
+                optimizer.param_groups = all_groups
+        for name in names:
+            for hook in self._step_post_hooks.get(name, []):
+                hook()
+
+    def clip_grad_norm_(self, *names):
+        """Same as clip_grad_norm_ of each module in turn (by cfg.clip), from
+        a single multi-tensor norm of the gradients : as scaling gradients
+        scales their norms, clipping of a module is a scale factor per
+        gradient, which is applied to later modules' norms and, in the end,
+        to the gradients at once."""
+        self._prepare_grads(names)
+        grads, indices = self._clip_plan(names)
+        if not grads:
+            return
+        device = grads[0].device
+        norms = torch.stack([norm.to(device)
+                             for norm in torch._foreach_norm(grads)])
+        scales = torch.ones_like(norms)
+        for index in indices:
+            total_norm = (norms[index] * scales[index]).norm()
+            clip_coef = (self.cfg.clip / (total_norm + 1e-6)).clamp(max=1.)
+            scales[index] = scales[index] * clip_coef
+        torch._foreach_mul_(grads, list(scales.unbind()))
+
+    def _clip_plan(self, names):
+        # (parameters with gradients, their indices per module) are made once
+        # for the same names & parameters without gradients
+        params = [p for name in names for p in self._params[name]]
+        plan_key = (names, tuple(p.grad is None for p in params))
+        plan = self._clip_plans.get(plan_key)
+        if plan is None:
+            position = OrderedDict()
+            for p in params:
+                if p.grad is not None and p not in position:
+                    position[p] = len(position)
+            indices = []
+            for name in names:
+                index = [position[p] for p in self._params[name]
+                         if p in position]
+                if index:
+                    indices.append(torch.tensor(index, device=self.cfg.device))
+            plan = self._clip_plans[plan_key] = (list(position), indices)
+        params, indices = plan
+        return [p.grad for p in params], indices
+
+    def state_dict(self):
+        """Per module, the state dict its own optimizer would have had"""
+        state_dict = OrderedDict()
+        for name, params in self._params.items():
+            optimizer = self._optimizers[self._groups[
+                self._owners[name][0]][0]]
+            hyperparams = {k: v for k, v in self.param_groups(name)[0].items()
+                           if k not in ['params', 'name']}
+            state_dict[name] = dict(
+                state={i: optimizer.state[p] for i, p in enumerate(params)
+                       if p in optimizer.state},
+                param_groups=[dict(hyperparams,
+                                   params=list(range(len(params))))])
+        return state_dict
+
+    def load_state_dict(self, state_dict):
+        for name, optim_state in state_dict.items():
+            if name not in self._params:
+                raise ValueError("Can't find optimizer name of %s" % name)
+            params = self._params[name]
+            optimizer = self._optimizers[self._groups[
+                self._owners[name][0]][0]]
+            on_device = optimizer.defaults.get('fused') or \
+                optimizer.defaults.get('capturable')
+            for i, state in optim_state['state'].items():
+                p = params[i]
+                # 'step' stays on cpu unless fused or capturable (as torch)
+                optimizer.state[p] = {
+                    k: v.to(p.device if k != 'step' or on_device else 'cpu')
+                    if torch.is_tensor(v) else v for k, v in state.items()}
+            if name in self._groups:
+                saved = optim_state['param_groups'][0]
+                self._groups[name][1].update(
+                    {k: v for k, v in saved.items() if k != 'params'})
+
+
+class NamedOptimizer(object):
+    """Optimizer of a module (optim_<name> of Network) in OptimizerManager"""
+    def __init__(self, manager, name):
+        self.manager = manager
+        self.name = name
+
+    @property
+    def param_groups(self):
+        return self.manager.param_groups(self.name)
+
+    def step(self):
+        self.manager.step(self.name)
+
+
 class Network(object):
     """Instances of specific classes set as attributes in Network class
     will automatically be updated to the dictionaries as below:
 
     torch.nn.Module -> self._modules
-    optim.Optimizer -> self._optimizers
+    optim.Optimizer, NamedOptimizer -> self._optimizers (without 'optim_')
     loader.corpus DataScheduler -> self._batch_schedulers
 
     """
     def __init__(self, cfg, corpus_train, corpus_test, vocab_word,
                  vocab_tag=None):
-        self.cfg = cfg
+        self.cfg = set_device(cfg)
+        self.device = cfg.device
         self.corpus_train = corpus_train
         self.corpus_test = corpus_test
         self.vocab_w = vocab_word
@@ -43,6 +298,7 @@ class Network(object):
         self._modules = OrderedDict()
         self._optimizers = OrderedDict()
         self._batch_schedulers = OrderedDict()
+        self.frozen = set()  # names of modules (see freeze_modules)
 
         self._build_dataset()
         self._build_network()
@@ -55,10 +311,9 @@ class Network(object):
             self._check_init_by_name('_modules')
             self._modules[name] = value
 
-        if isinstance(value, optim.Optimizer):
+        if isinstance(value, (optim.Optimizer, NamedOptimizer)):
             self._check_init_by_name('_optimizers')
-            name.replace('optim_', '')
-            self._optimizers[name] = value
+            self._optimizers[name.replace('optim_', '', 1)] = value
 
         if isinstance(value, DataScheduler):
             self._check_init_by_name('_batch_schedulers')
@@ -76,7 +331,16 @@ class Network(object):
         else:
             collator = BatchCollator(cfg, vocab_word)
 
-        self.data_train = MyDataLoader(c_train, cfg.batch_size, shuffle=True,
+        # a shard of the training set per rank with --distributed (the same
+        # permutation everywhere, reshuffled by DataScheduler every epoch)
+        sampler = None
+        if cfg.distributed:
+            sampler = DistributedSampler(c_train, cfg.world_size, cfg.rank,
+                                         shuffle=True, seed=cfg.seed,
+                                         drop_last=True)
+        self.data_train = MyDataLoader(c_train, cfg.batch_size,
+                                       shuffle=sampler is None,
+                                       sampler=sampler,
                                        num_workers=0, collate_fn=collator,
                                        drop_last=True, pin_memory=True)
         self.data_eval = MyDataLoader(c_test, cfg.eval_size, shuffle=True,
@@ -90,20 +354,8 @@ class Network(object):
 
     def _build_network(self):
         cfg = self.cfg
-
-        if cfg.enc_type == 'cnn':
-            Encoder = EncoderCNN
-        elif cfg.enc_type == 'rnn':
-            Encoder = EncoderRNN
-        else:
-            raise ValueError('Unknown encoder type!')
-
-        if cfg.dec_type == 'cnn':
-            Decoder = DecoderCNN
-        elif cfg.dec_type == 'rnn':
-            Decoder = DecoderRNN
-        else:
-            raise ValueError('Unknown decoder type!')
+        Encoder = encoder_class(cfg)
+        Decoder = decoder_class(cfg)
 
         # NOTE remove later!
         self.embed_w = Embedding(cfg, self.vocab_w)  # Word embedding
@@ -122,27 +374,31 @@ class Network(object):
             self._upload_modules_to_gpu()
 
     def _build_optimizer(self):
-        optim_ae = lambda module : optim.SGD(module.parameters(),
-                                             lr=self.cfg.lr_ae)
-        optim_gen = lambda module : optim.Adam(module.parameters(),
-                                               lr=self.cfg.lr_gan_g,
-                                               betas=(self.cfg.beta1, 0.999))
-        optim_disc = lambda module : optim.Adam(module.parameters(),
-                                                lr=self.cfg.lr_gan_d,
-                                                betas=(self.cfg.beta1, 0.999))
-        # Optimizers
-        self.optim_embed_w = optim_ae(self.embed_w)
-        self.optim_enc = optim_ae(self.enc)
-        self.optim_dec = optim_ae(self.dec)
-        self.optim_dec2 = optim_ae(self.dec2)
-        self.optim_reg = optim_ae(self.reg)
+        cfg = self.cfg
+        self.optimizers = OptimizerManager(cfg)
+        add = lambda name, *args, **kwargs : self.optimizers.add(
+            name, self._modules[name], *args, **kwargs)
+        optim_ae = lambda name : add(name, optim.SGD, lr=cfg.lr_ae)
+        optim_gen = lambda name : add(name, optim.Adam, lr=cfg.lr_gan_g,
+                                      betas=(cfg.beta1, 0.999))
+        optim_disc = lambda name : add(name, optim.Adam, lr=cfg.lr_gan_d,
+                                       betas=(cfg.beta1, 0.999))
+        # Optimizers (embed_w first, as the decoders share it)
+        self.optim_embed_w = optim_ae('embed_w')
+        self.optim_enc = optim_ae('enc')
+        self.optim_dec = optim_ae('dec')
+        self.optim_dec2 = optim_ae('dec2')
+        self.optim_reg = optim_ae('reg')
         #self.optim_reg_mu = optim_ae(self.reg.mu_layers)
         #self.optim_reg_sigma_ae = optim_ae(self.reg.sigma_layers)
         #self.optim_reg_sigma_gen = optim_gen(self.reg.sigma_layers)
         #self.optim_reg_gen = optim_gen(self.reg)
-        self.optim_gen = optim_gen(self.gen)
-        self.optim_rev = optim_gen(self.rev)
-        self.optim_disc = optim_disc(self.disc)
+        self.optim_gen = optim_gen('gen')
+        self.optim_rev = optim_gen('rev')
+        self.optim_disc = optim_disc('disc')
+        if cfg.gan_clamp_after_step:
+            self.optimizers.register_step_post_hook(
+                'disc', self.disc.clamp_weights_)
 
     def _print_modules_info(self):
         for name, module in self.registered_modules():
@@ -164,54 +420,186 @@ class Network(object):
 
     def clip_grad_norm__by_names(self, *names):
         for name in names:
-            module = self._modules.get(name, None)
-            if module is None:
+            if name not in self._modules:
                 raise ValueError("Can't find module name %s" % name)
-            module.clip_grad_norm_()
+        self.optimizers.clip_grad_norm_(*names)
 
     def step_optimizers_by_names(self, *names):
+        # 'optim_dec' or 'dec'
+        names = tuple(name.replace('optim_', '', 1) for name in names)
         for name in names:
-            optim = self._optimizers.get(name, None)
-            if optim is None:
+            if name not in self._optimizers:
                 raise ValueError("Can't find optimizer name of %s" % name)
-            optim.step()
+        self.optimizers.step(*names)
 
-    def save_modules(self):
+    def save_modules(self, dir_path=None):
         self._check_init_by_name('_modules')
         for name, module in self.registered_modules():
-            fname = path.join(self.cfg.log_dir, name + '.ckpt')
+            fname = path.join(dir_path or self.cfg.log_dir, name + '.ckpt')
             with open(fname, 'wb') as f:
                 torch.save(module.state_dict(), f)
 
-    def load_modules(self):
+    def load_modules(self, dir_path=None):
+        """From the latest checkpoint in log_dir (see train.checkpoint), or
+        name.ckpt files in dir_path if given (saved before checkpoints/)"""
         self._check_init_by_name('_modules')
+        from train.checkpoint import latest_checkpoint, load_checkpoint
+        ckpt_path = None if dir_path else latest_checkpoint(self.cfg.log_dir)
+        if ckpt_path is not None:
+            # only the modules of the network, copied from the mapped file
+            _, states = load_checkpoint(ckpt_path, list(self._modules))
+            for name, module in self.registered_modules():
+                module.load_state_dict(states[name])
+            log.info('Modules have been loaded from : %s' % ckpt_path)
+            return
         for name, module in self.registered_modules():
-            fname = path.join(self.cfg.log_dir, name + '.ckpt')
-            module.load_state_dict(torch.load(fname))
+            fname = path.join(dir_path or self.cfg.log_dir, name + '.ckpt')
+            if self.cfg.cuda:
+                state_dict = torch.load(fname)
+            else:  # checkpoints saved from gpu
+                state_dict = torch.load(fname, map_location='cpu')
+            module.load_state_dict(state_dict)
             log.info('Module has been loaded from : %s' % fname)
 
-    def save_batch_schedulers(self):
+    def save_batch_schedulers(self, dir_path=None):
         self._check_init_by_name('_batch_schedulers')
         for name, scheduler in self.registered_batch_schedulers():
-            fname = path.join(self.cfg.log_dir, name + '.pickle')
+            fname = path.join(dir_path or self.cfg.log_dir, name + '.pickle')
             scheduler.save_as_pickle(fname)
 
-    def load_batch_schedulers(self):
+    def load_batch_schedulers(self, dir_path=None):
         self._check_init_by_name('_batch_schedulers')
         for name, scheduler in self.registered_batch_schedulers():
-            fname = path.join(self.cfg.log_dir, name + '.pickle')
+            fname = path.join(dir_path or self.cfg.log_dir, name + '.pickle')
             scheduler.load_from_pickle(fname)
             log.info('BatchIterator has been loaded from : %s' % fname)
 
     def set_modules_train_mode(self, train_mode):
+        """Switches only the modules not in the mode yet (as their training
+        flags tell). Gradients are left as they are : each phase zeroes the
+        modules it backprops into by zero_grad_by_names. Frozen modules stay
+        in evaluation mode."""
         self._check_init_by_name('_modules')
         for name, module in self.registered_modules():
-            if train_mode:
-                module = module.trainer
-            else:
-                module = module.tester
+            if name in self.frozen:
+                continue
+            if module.training != train_mode:
+                module.train(train_mode)
+        for name in self.frozen:  # (e.g. embed_w switched along with dec)
+            if self._modules[name].training:
+                self._modules[name].train(False)
+
+    def freeze_modules(self, *names):
+        """Fixes the weights of the modules (as --fix_embed does for the
+        embedding) : parameters of their own (not those of the modules they
+        share, e.g. embed_w of decoders) get no gradients, and the modules
+        are kept in evaluation mode, not to update their buffers either."""
+        for name in names:
+            if name not in self._modules:
+                raise ValueError("Can't find module name %s" % name)
+            for p in self.optimizers.own_parameters(name):
+                p.requires_grad_(False)
+            self._modules[name].train(False)
+            self.frozen.add(name)
+
+    def assign_states(self, states, names=None):
+        """Makes parameters & buffers point to the given tensors (e.g. views
+        of a memory-mapped file) instead of copying them.
+
+        Args:
+            states (dict): module name -> state dict
+            names (list): modules to assign (default: all)
+        """
+        for name in names or self._modules:
+            module = self._modules[name]
+            state_dict = states[name]
+            own = OrderedDict(module.named_parameters())
+            own.update(module.named_buffers())
+            if set(own.keys()) != set(state_dict.keys()):
+                raise Exception("State dict keys mismatch of module %s : %s"
+                                % (name, set(own) ^ set(state_dict)))
+            for key, tensor in state_dict.items():
+                if own[key].size() != tensor.size():
+                    raise Exception("Size mismatch of %s.%s" % (name, key))
+                own[key].data = tensor
+
+    def zero_grad_by_names(self, *names):
+        for name in names:
+            module = self._modules.get(name, None)
+            if module is None:
+                raise ValueError("Can't find module name %s" % name)
+            module.zero_grad(set_to_none=True)
 
     def _check_init_by_name(self, name):
         if not name in self.__dict__:
             raise AttributeError(
                 "Cannot assign modules before Network.__init__() call")
+
+
+class InferenceNetwork(Network):
+    """Builds only the named modules and loads them from log_dir, without
+    datasets and optimizers. (decoders bring embed_w along with them)"""
+    module_names = ['embed_w', 'enc', 'reg', 'dec', 'dec2', 'student', 'gen']
+
+    def __init__(self, cfg, vocab_word, names, states=None):
+        self.cfg = set_device(cfg)
+        self.device = cfg.device
+        self.vocab_w = vocab_word
+        self.vocab_t = None
+        self.ntokens = len(vocab_word)
+
+        self._modules = OrderedDict()
+        self._optimizers = OrderedDict()
+        self._batch_schedulers = OrderedDict()
+        self.frozen = set()  # names of modules (see freeze_modules)
+
+        self._build_modules(names)
+        if states is None:
+            states = self._load_saved_states()
+        self.assign_states(states)
+        if cfg.cuda:
+            self._upload_modules_to_gpu()
+
+    def _load_saved_states(self):
+        """Views of the modules in the latest checkpoint of log_dir (mapped),
+        the others (e.g. student of train.distill) from name.ckpt files"""
+        from train.checkpoint import (latest_checkpoint, load_checkpoint,
+                                      saved_module_names)
+        states = OrderedDict()
+        ckpt_path = latest_checkpoint(self.cfg.log_dir)
+        if ckpt_path is not None:
+            saved = saved_module_names(self.cfg.log_dir)
+            _, states = load_checkpoint(
+                ckpt_path, [name for name in self._modules if name in saved])
+            log.info('Modules have been loaded from : %s' % ckpt_path)
+        for name in self._modules:
+            if name not in states:
+                fname = path.join(self.cfg.log_dir, name + '.ckpt')
+                states[name] = torch.load(fname, map_location='cpu')
+                log.info('Module has been loaded from : %s' % fname)
+        return states
+
+    def _build_modules(self, names):
+        cfg = self.cfg
+        for name in names:
+            if name not in self.module_names:
+                raise ValueError("Can't find module name %s" % name)
+        if set(names) & {'dec', 'dec2', 'student'}:
+            names = ['embed_w'] + list(names)
+
+        if 'embed_w' in names:
+            self.embed_w = Embedding(cfg, self.vocab_w)
+        if 'enc' in names:
+            self.enc = encoder_class(cfg)(cfg)
+        if 'reg' in names:
+            self.reg = VariationalRegularizer(cfg)
+        if 'dec' in names:
+            self.dec = decoder_class(cfg)(cfg, self.embed_w)
+        if 'dec2' in names:
+            self.dec2 = decoder_class(cfg)(cfg, self.embed_w)
+        if 'student' in names:  # distilled decoder (see train.distill)
+            from train.distill import build_student, load_student_config
+            self.student = build_student(cfg, self.embed_w,
+                                         load_student_config(cfg))
+        if 'gen' in names:
+            self.gen = Generator(cfg)
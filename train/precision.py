@@ -0,0 +1,106 @@
+"""Mixed precision training (--precision) : forward passes under autocast
+and, for fp16, dynamic loss scaling.
+
+    with trainer.precision.autocast():
+        loss = ...                                # bf16/fp16 matmuls
+        trainer.precision.backward(loss)          # or (disc_real, pos_one)
+        net.clip_grad_norm__by_names('dec')       # unscaled gradients
+        net.step_optimizers_by_names('dec')       # skipped on inf/nan
+
+Parameters, gradients and optimizer states stay in fp32, and so do the ops
+the trainer keeps out of reduced precision (KL, log_softmax of decoders,
+clamping of critic weights).
+"""
+import logging
+
+import torch
+
+log = logging.getLogger('main')
+
+DTYPES = dict(fp32=torch.float32, bf16=torch.bfloat16, fp16=torch.float16)
+
+
+class LossScaler(object):
+    """Dynamic loss scale (as torch.amp.GradScaler) : halved when gradients
+    have inf/nan (and the step is skipped), doubled after growth_interval
+    steps without."""
+    def __init__(self, device, init_scale=2.**16, growth_factor=2.,
+                 backoff_factor=.5, growth_interval=2000):
+        self.growth_factor = growth_factor
+        self.backoff_factor = backoff_factor
+        self.growth_interval = growth_interval
+        self._scale = torch.full((), init_scale, device=device)
+        self._growth_tracker = torch.zeros((), dtype=torch.int32,
+                                           device=device)
+        self._found_inf = torch.zeros((), device=device)
+        self.num_skipped = 0
+
+    @property
+    def scale(self):
+        return self._scale.item()
+
+    def scale_(self, tensor):
+        return tensor * self._scale
+
+    def unscale_(self, grads):
+        """Unscales gradients in place, recording any inf/nan among them"""
+        if grads:
+            inv_scale = self._scale.double().reciprocal().float()
+            torch._amp_foreach_non_finite_check_and_unscale_(
+                grads, self._found_inf, inv_scale)
+
+    def update(self):
+        """Whether the unscaled gradients can be stepped, then updates the
+        scale"""
+        found_inf = self._found_inf.item() > 0
+        torch._amp_update_scale_(self._scale, self._growth_tracker,
+                                 self._found_inf, self.growth_factor,
+                                 self.backoff_factor, self.growth_interval)
+        self._found_inf.zero_()
+        if found_inf:
+            self.num_skipped += 1
+        return not found_inf
+
+    def state_dict(self):
+        return dict(scale=self._scale.item(),
+                    growth_tracker=self._growth_tracker.item(),
+                    num_skipped=self.num_skipped)
+
+    def load_state_dict(self, state_dict):
+        self._scale.fill_(state_dict['scale'])
+        self._growth_tracker.fill_(state_dict['growth_tracker'])
+        self.num_skipped = state_dict['num_skipped']
+
+
+class Precision(object):
+    def __init__(self, cfg):
+        self.cfg = cfg
+        if cfg.precision == 'fp16' and cfg.device.type != 'cuda':
+            # (lstm of oneDNN has no fp16 kernels)
+            raise Exception('fp16 training needs cuda! (--precision bf16 '
+                            'on cpu)')
+        self.dtype = DTYPES[cfg.precision]
+        self.enabled = self.dtype != torch.float32
+        self.scaler = None
+        if self.dtype == torch.float16:
+            self.scaler = LossScaler(cfg.device)
+        if self.enabled:
+            log.info('Mixed precision training : %s autocast%s' % (
+                cfg.precision, ' & dynamic loss scaling'
+                if self.scaler is not None else ''))
+
+    def autocast(self):
+        return torch.autocast(self.cfg.device.type, dtype=self.dtype,
+                              enabled=self.enabled)
+
+    def backward(self, output, gradient=None):
+        """output.backward(gradient), out of autocast. With loss scaling,
+        the gradient (e.g. pos_one/neg_one of WGAN) is scaled instead of
+        the output."""
+        output = output.float()
+        if self.scaler is not None:
+            if gradient is None:
+                gradient = torch.ones_like(output)
+            gradient = self.scaler.scale_(gradient)
+        with torch.autocast(self.cfg.device.type, enabled=False):
+            output.backward(gradient)
@@ -0,0 +1,150 @@
+"""Stage-wise reuse of checkpoints : an autoencoder trained once, many GAN
+runs started from it.
+
+    main.py --name ae --ae_only true                  # autoencoder only
+    main.py --name ae --export_ae nli_ae              # out_dir/stages/
+    main.py --name gan --init_from nli_ae --fork 4    # gan_0, ..., gan_3
+
+A stage is a checkpoint (see train.checkpoint) of some modules only, with
+their optimizer states. --init_from loads --init_modules of a stage into a
+new run : those in --init_freeze are fixed (no gradients, evaluation mode,
+as --fix_embed does for the embedding) and the others go on training. The
+weights of frozen modules are views of the mapped stage file, so runs of
+the same stage share them in memory (pages of the page cache, never written
+to) instead of holding a copy each.
+"""
+from collections import OrderedDict
+import logging
+import os
+import subprocess
+import sys
+
+from train.bundle import MODEL_CFG_KEYS
+from train.checkpoint import (latest_checkpoint, load_checkpoint,
+                              load_checkpoint_header, load_optimizer_states)
+from utils.tensor_file import load_tensors, save_tensors
+
+log = logging.getLogger('main')
+odict = OrderedDict
+
+AE_MODULES = ['embed_w', 'enc', 'reg', 'dec']
+STAGE_DIR = 'stages'
+
+
+def stage_path(cfg, name_or_path):
+    """A file path as it is, a stage name in out_dir/stages otherwise"""
+    if os.path.exists(name_or_path) or os.sep in name_or_path:
+        return name_or_path
+    return os.path.join(cfg.out_dir, STAGE_DIR, name_or_path + '.ckpt')
+
+
+def parse_names(names):
+    return [name for name in names.split(',') if name]
+
+
+def export_stage(cfg, name, names=AE_MODULES):
+    """Saves the named modules of the latest checkpoint in log_dir (and
+    their optimizer states) as a stage"""
+    ckpt_path = latest_checkpoint(cfg.log_dir)
+    if ckpt_path is None:
+        raise Exception("Can't find checkpoints in %s" % cfg.log_dir)
+    header, tensors = load_tensors(ckpt_path, mmap=True)
+    prefixes = tuple('%s.%s.' % (prefix, name)
+                     for prefix in ['module', 'optim'] for name in names)
+    aliases = odict((key, saved) for key, saved in header['aliases'].items()
+                    if key.startswith(prefixes))
+    keep = set(aliases.values())  # (e.g. embed_w weights of dec)
+    tensors = odict((key, tensor) for key, tensor in tensors.items()
+                    if key.startswith(prefixes) or key in keep)
+    header.update(
+        modules=odict((name, header['modules'][name]) for name in names),
+        optimizers=odict((name, header['optimizers'][name])
+                         for name in names if name in header['optimizers']),
+        schedulers=odict(),
+        rng=None,
+        loss_scaler=None,
+        aliases=aliases,
+        stage=name,
+        source=ckpt_path,
+    )
+    file_path = stage_path(cfg, name)
+    if os.path.dirname(file_path):
+        os.makedirs(os.path.dirname(file_path), exist_ok=True)
+    save_tensors(file_path, header, tensors)
+    log.info('Stage %s (%s of step %d) has been saved to : %s' % (
+        name, ', '.join(names), header['step']['global_step'], file_path))
+    return file_path
+
+
+def init_from_stage(net, resumed=False):
+    """Loads --init_modules of --init_from into net. Frozen ones are loaded
+    even when resumed from a checkpoint of the run, to be shared again."""
+    cfg = net.cfg
+    file_path = stage_path(cfg, cfg.init_from)
+    names = parse_names(cfg.init_modules)
+    frozen = parse_names(cfg.init_freeze)
+    for name in frozen:
+        if name not in names:
+            raise Exception('--init_freeze %s is not in --init_modules!'
+                            % name)
+
+    header = load_checkpoint_header(file_path)
+    differ = [key for key in MODEL_CFG_KEYS
+              if header['configs'].get(key) != getattr(cfg, key, None)]
+    if differ:
+        log.warning('Model configs differ from the stage : %s' % ', '.join(
+            '%s (%s -> %s)' % (key, header['configs'].get(key),
+                               getattr(cfg, key, None)) for key in differ))
+
+    if frozen:
+        # views of the mapped file (copied only to another device or type)
+        _, states = load_checkpoint(file_path, frozen, mmap=True)
+        for state_dict in states.values():
+            for key, tensor in state_dict.items():
+                state_dict[key] = tensor.to(cfg.device, cfg.dtype) \
+                    if tensor.is_floating_point() else tensor.to(cfg.device)
+        net.assign_states(states, frozen)
+        net.freeze_modules(*frozen)
+
+    trained = [name for name in names if name not in frozen]
+    if trained and not resumed:
+        _, states = load_checkpoint(file_path, trained)
+        # but tensors of frozen modules (e.g. embed_w of dec), not to write
+        # the same values into the mapped file
+        frozen_ptrs = set(tensor.data_ptr() for name in frozen
+                          for tensor in net._modules[name].state_dict()
+                          .values())
+        for name in trained:
+            module = net._modules[name]
+            own = module.state_dict()
+            module.load_state_dict(odict(
+                (key, tensor) for key, tensor in states[name].items()
+                if own[key].data_ptr() not in frozen_ptrs), strict=False)
+        net.optimizers.load_state_dict(
+            load_optimizer_states(file_path, trained))
+
+    log.info('Initialized from stage : %s (frozen : %s, trained : %s)' % (
+        file_path, ', '.join(frozen) or '-',
+        ', '.join(trained) if not resumed else '- (resumed)'))
+
+
+def fork_runs(cfg, argv):
+    """Runs --fork copies of the command (argv) in parallel processes, as
+    <name>_<i> with seed + i, and waits for them"""
+    if not cfg.init_from:
+        raise Exception('--fork needs a stage to start from! (--init_from)')
+    # intra-op threads shared by the runs (read before torch is imported)
+    num_threads = cfg.num_threads or max(1, (os.cpu_count() or 1) // cfg.fork)
+    env = dict(os.environ, OMP_NUM_THREADS=str(num_threads))
+    processes = []
+    for i in range(cfg.fork):
+        name = '%s_%d' % (cfg.name, i)
+        args = [sys.executable, sys.argv[0]] + list(argv) + [
+            '--fork', '0', '--name', name, '--seed', str(cfg.seed + i)]
+        processes.append((name, subprocess.Popen(args, env=env)))
+        log.info('Forked %s from stage %s (pid %d)'
+                 % (name, cfg.init_from, processes[-1][1].pid))
+    failed = [name for name, process in processes if process.wait() != 0]
+    if failed:
+        raise Exception('Forked runs failed : %s' % ', '.join(failed))
+    log.info('All %d forked runs are done.' % cfg.fork)
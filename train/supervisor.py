@@ -7,6 +7,10 @@ from tqdm import tqdm
 
 import torch
 
+from train.checkpoint import (CheckpointWriter, latest_checkpoint,
+                              restore_checkpoint)
+from train.distributed import broadcast_object
+
 log = logging.getLogger('main')
 
 
@@ -38,21 +42,36 @@ class TrainingSupervisor(object):
         self.interval_func_global = {
         }
 
+        if self.cfg.rank != 0:
+            # results, evaluation & checkpoints of the main process only
+            # (ranks of --distributed)
+            self.interval_func_train = dict()
+            self.interval_func_eval = dict()
+
         self._gan_schedule = self._init_gan_schedule()
 
         self.global_step = 0
         self.global_maxstep = math.ceil(  # a bit dirty
             (len(net.data_train)*net.cfg.epochs) / net.cfg.niter_ae)
-        self.global_step_fname = path.join(self.cfg.log_dir, 'step.json')
 
         self._progress_bar = tqdm(initial=self.global_step,
-                                  total=self.global_maxstep)
+                                  total=self.global_maxstep,
+                                  disable=self.cfg.rank != 0)
+
+        self.checkpoint = None
+        if self.cfg.rank == 0:
+            self.checkpoint = CheckpointWriter(net, result_writer)
 
         self._load_snapshot_if_available()
 
     def __del__(self):
         self._progress_bar.close()
 
+    def close(self):
+        # waits for the checkpoint being written
+        if self.checkpoint is not None:
+            self.checkpoint.close()
+
     @contextmanager
     def training_context(self):
         yield  # training procedure
@@ -81,6 +100,8 @@ class TrainingSupervisor(object):
             if self.global_step % step == 0: function()
         self.global_step += 1
         self._update_progress_bar()
+        if self.checkpoint is not None:
+            self.checkpoint.collect()
         return self.global_step > self.global_maxstep
 
     def is_evaluation(self):
@@ -105,33 +126,61 @@ class TrainingSupervisor(object):
         self.result.initialize_embedding()
 
     def _save_data_and_module(self):
-        self._save_global_step()
-        self.net.save_batch_schedulers()
-        self.net.save_modules()
+        # snapshot now, written in the background (see train.checkpoint)
+        self.checkpoint.save(self.global_step, dict(
+            global_step=self.global_step,
+            global_maxstep=self.global_maxstep,
+            ))
         #log.debug("Model saved.")
 
     def _load_snapshot_if_available(self):
+        ckpt_path = latest_checkpoint(self.cfg.log_dir)
+        if self.cfg.distributed:
+            self._load_snapshot_of_main_process(ckpt_path)
+            return
         log_dir = listdir(self.cfg.log_dir)
         #import pdb; pdb.set_trace()
-        if not any(fname.endswith(('.ckpt', '.pickle')) for fname in log_dir):
+        if ckpt_path is not None:
+            # modules, optimizers, batch schedulers & random states
+            header = restore_checkpoint(self.net, ckpt_path)
+            self._set_global_step(header['step'])
+        elif not any(fname.endswith(('.ckpt', '.pickle'))
+                     for fname in log_dir):
             log.info("Can't find model.ckpt files. "
                      "Training begins from the scratch!")
-        else:
+        else:  # files in log_dir, saved before log_dir/checkpoints
             self._load_global_step()
-            self.net.load_batch_schedulers()
-            self.net.load_modules()
-
-    def _save_global_step(self):
-        with open(self.global_step_fname, 'w') as f:
-            dump_dict = dict(
-                global_step=self.global_step,
-                global_maxstep=self.global_maxstep,
-                )
-            json.dump(dump_dict, f, indent=4)
+            self.net.load_batch_schedulers(self.cfg.log_dir)
+            self.net.load_modules(self.cfg.log_dir)
+
+    def _load_snapshot_of_main_process(self, ckpt_path):
+        # rank 0 restores the checkpoint (other nodes may not see it) and the
+        # other ranks take its global step and move their own shards to the
+        # positions of its batch schedulers (whose pickles hold the indices
+        # of rank 0's shard). Modules & optimizer states are broadcast by
+        # Trainer.
+        resumed = None
+        if self.cfg.rank == 0 and ckpt_path is not None:
+            header = restore_checkpoint(self.net, ckpt_path)
+            resumed = (header['step'], dict(
+                (name, (scheduler.step.epoch, scheduler.step.batch))
+                for name, scheduler in self.net.registered_batch_schedulers()))
+        resumed = broadcast_object(resumed)
+        if resumed is None:
+            log.info("Can't find checkpoints. "
+                     "Training begins from the scratch!")
+            return
+        step_dict, positions = resumed
+        self._set_global_step(step_dict)
+        if self.cfg.rank != 0:
+            for name, scheduler in self.net.registered_batch_schedulers():
+                scheduler.seek(*positions[name])
 
     def _load_global_step(self):
-        with open(self.global_step_fname, 'r') as f:
-            load_dict = json.load(f)
+        with open(path.join(self.cfg.log_dir, 'step.json'), 'r') as f:
+            self._set_global_step(json.load(f))
+
+    def _set_global_step(self, load_dict):
         log.info(load_dict)
         self.global_step = load_dict['global_step']
         self.global_maxstep = load_dict['global_maxstep']
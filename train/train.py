@@ -10,10 +10,18 @@ import torch.nn as nn
 import torch.nn.functional as F
 from models.decoder import DecoderRNN
 from torch.autograd import Variable
+from train.async_eval import AsyncEvaluator
+from train.distributed import (broadcast_modules, broadcast_optimizers,
+                               GradientReducer, ScalingBenchmark)
+from train.precision import Precision
+from train.stage import AE_MODULES, init_from_stage
 from train.supervisor import TrainingSupervisor
 from train.train_helper import (GradientScalingHook, GradientTransferHook,
-                                load_test_data, mask_output_target, SigmaHook)
+                                load_test_index, mask_output_target, SigmaHook)
 from test.kenlm import train_kenlm
+from test.latent_metrics import LatentMetrics
+from test.metrics import DiversityMetrics
+from utils.rng import rng
 from utils.utils import set_random_seed, to_gpu
 from utils.writer import ResultWriter
 
@@ -24,17 +32,33 @@ odict = OrderedDict
 class Trainer(object):
     def __init__(self, net):
         log.info("Training start!")
-        # set_random_seed(net.cfg)
+        set_random_seed(net.cfg)
         self.net = net
         self.cfg = net.cfg
         #self.fixed_noise = net.gen.make_noise_size_of(net.cfg.eval_size)
 
-        self.test_sents = load_test_data(net.cfg)
-        self.pos_one = to_gpu(net.cfg.cuda, torch.FloatTensor([1]))
+        self.test_index = load_test_index(net.cfg)
+        self.diversity = DiversityMetrics(net.cfg, net.vocab_w)
+        self.latent = LatentMetrics(net.cfg)
+        self.pos_one = torch.ones((), device=net.cfg.device)
         self.neg_one = self.pos_one * (-1)
+        self.precision = Precision(net.cfg)
+        if self.precision.scaler is not None:
+            net.optimizers.set_loss_scaler(self.precision.scaler)
 
         self.result = ResultWriter(net.cfg)
         self.sv = TrainingSupervisor(net, self.result)
+        if net.cfg.init_from:  # a stage (e.g. a pretrained autoencoder)
+            init_from_stage(net, resumed=self.sv.global_step > 0)
+        # nothing to train in the autoencoder phase
+        self.ae_frozen = set(AE_MODULES) <= net.frozen
+        if net.cfg.distributed:
+            # the same weights & optimizer states (initial or loaded) and
+            # averaged gradients
+            broadcast_modules(net)
+            broadcast_optimizers(net)
+            net.optimizers.set_grad_reducer(
+                GradientReducer(net.cfg.world_size))
         #self.sv.interval_func_train.update({net.enc.decay_noise_radius: 200})
 
         self.enc_h_hook = GradientScalingHook()
@@ -43,8 +67,21 @@ class Trainer(object):
         self.noise = 0.8
         #self.noise = net.cfg.noise_radius
 
+        if (self.cfg.async_eval or self.cfg.async_eval_text) and \
+                self.cfg.rank == 0:
+            self.async_eval = AsyncEvaluator(net, self.result)
+        else:
+            self.async_eval = None
+
+        bench = ScalingBenchmark(self.cfg) if self.cfg.bench_steps else None
         while not self.sv.is_end_of_training():
             self.train_loop(self.cfg, self.net, self.sv)
+            if bench is not None and bench.is_done(self.sv.global_step):
+                break
+
+        self.sv.close()
+        if self.async_eval is not None:
+            self.async_eval.close()
 
     def train_loop(self, cfg, net, sv):
         """Main training loop"""
@@ -56,39 +93,62 @@ class Trainer(object):
                 if net.data_ae.step.is_end_of_step():
                     break
                 batch = net.data_ae.next()
-                self._train_autoencoder(batch)
+                if self.ae_frozen:
+                    continue
+                with self.precision.autocast():
+                    self._train_autoencoder(batch)
 
-            # train gan
-            for k in range(sv.niter_gan):  # epc0=1, epc2=2, epc4=3, epc6=4
+            # train gan (not when pretraining the autoencoder, --ae_only)
+            niter_gan = 0 if cfg.ae_only else sv.niter_gan
+            for k in range(niter_gan):  # epc0=1, epc2=2, epc4=3, epc6=4
 
                 # train discriminator/critic (at a ratio of 5:1)
                 for i in range(cfg.niter_gan_d):  # default: 5
                     batch = net.data_gan.next()
-                    self._train_discriminator(batch)
+                    with self.precision.autocast():
+                        self._train_discriminator(batch)
                     #self._train_code_vae(batch)
 
                 # train generator(with disc) / decoder(with disc_s)
                 for i in range(cfg.niter_gan_g):  # default: 1
-                    self._train_generator()
+                    with self.precision.autocast():
+                        self._train_generator()
                     #self._train_dec2(batch)
 
-            self._train_regularizer(batch)
+            if not cfg.ae_only:
+                with self.precision.autocast():
+                    self._train_regularizer(batch)
 
         if sv.is_evaluation():
             with sv.evaluation_context():
                 batch = net.data_eval.next()
                 #self._generate_text2()
                 #self._eval_autoencoder(batch, 'tf')
-                self._eval_autoencoder(batch)
-                self._generate_text()
-
-        if sv.global_step % 5000 == 0:
-            self._reverse_ppl(self.net.dec, 'dec1_ppl')
-            self._reverse_ppl(self.net.dec2, 'dec2_ppl')
+                if cfg.async_eval_text:
+                    step = sv.global_step
+                    self.async_eval.submit_eval_autoencoder(step, batch)
+                    self.async_eval.submit_generate_text(step)
+                    self._eval_latent(batch)
+                else:
+                    self._eval_autoencoder(batch)
+                    self._generate_text()
+
+        if sv.global_step % 5000 == 0 and cfg.rank == 0:
+            if cfg.async_eval:
+                step = sv.global_step
+                self.async_eval.submit_reverse_ppl(step, 'dec', 'dec1_ppl')
+                self.async_eval.submit_reverse_ppl(step, 'dec2', 'dec2_ppl')
+            else:
+                self._reverse_ppl(self.net.dec, 'dec1_ppl')
+                self._reverse_ppl(self.net.dec2, 'dec2_ppl')
+
+        if self.async_eval is not None:
+            self.async_eval.collect()
 
     def _reverse_ppl(self, dec, name='Reversed_PPL'):
         self.net.set_modules_train_mode(True)
         decoded_text = []
+        decoded_ids = []
         with torch.no_grad():
             # generate 100 x 1000 samples
             for i in range(100):
@@ -97,16 +157,21 @@ class Trainer(object):
                 decoded = dec.tester(code_fake,
                                               max_len=self.cfg.max_len)
                 decoded_text.append(decoded.get_text_batch())
+                decoded_ids.append(decoded.id.ids_array)
 
         decoded_text = np.concatenate(decoded_text, axis=0)
+        result_dict = self.diversity.compute(
+            np.concatenate(decoded_ids, axis=0))
         try:
             ppl = train_kenlm(self.net, decoded_text, self.sv.global_step)
-            self.result.add(name, odict(ppl=ppl))
+            result_dict.update(ppl=ppl)
         except:
             log.info("Failed to train kenlm!")
+        self.result.add(name, result_dict)
 
     def _train_autoencoder(self, batch, name='AE_train'):
         self.net.set_modules_train_mode(True)
+        self.net.zero_grad_by_names('embed_w', 'enc', 'reg', 'dec')
         # Build graph
         embed = self.net.embed_w(batch.enc_src.id)
         enc_h = self.net.enc(embed, batch.enc_src.len)
@@ -126,7 +191,7 @@ class Trainer(object):
             self.net.reg.mu, self.net.reg.logvar).mean() * self.cfg.kl_term
         #loss_reg = self._compute_reg_loss(self.net.reg.logvar) * self.cfg.kl_term
         loss = loss_recon + loss_kl
-        loss.backward()
+        self.precision.backward(loss)
 
         # with torch.no_grad():
         #     code_ = self._add_noise_to(code, 1.0)
@@ -139,18 +204,12 @@ class Trainer(object):
         # #loss_denoise.backward()
 
         # to prevent exploding gradient in RNNs
-        self.net.embed_w.clip_grad_norm_()
-        self.net.enc.clip_grad_norm_()
-        self.net.reg.clip_grad_norm_()
-        self.net.dec.clip_grad_norm_()
+        self.net.clip_grad_norm__by_names('embed_w', 'enc', 'reg', 'dec')
 
         # optimize
-        self.net.optim_embed_w.step()
-        self.net.optim_enc.step()
-        self.net.optim_reg.step()
+        self.net.step_optimizers_by_names('embed_w', 'enc', 'reg', 'dec')
         #self.net.optim_reg_mu.step()
         #self.net.optim_reg_sigma_ae.step()
-        self.net.optim_dec.step()
 
         self.result.add(name, odict(
             text=decoded.get_text_with_pair(batch.enc_src.id),
@@ -168,9 +227,7 @@ class Trainer(object):
 
     def _add_noise_to(self, code, std):
         if std > 0:
-            noise = torch.normal(mean=torch.zeros(code.size()), std=std)
-            noise = to_gpu(self.cfg.cuda, Variable(noise))
-            code = code + noise
+            code = code + rng.normal_like('ae_noise', code, std)
         return code
 
     def _eval_autoencoder(self, batch, name='AE_eval'):
@@ -206,6 +263,7 @@ class Trainer(object):
             #code_var = self.net.reg.with_var(code)
             #cos_sim = F.cosine_similarity(code, code_var, dim=1).mean()
             assert len(code_list) > 0
+            self.latent.update_real(code_list[0])
         log.info(self.net.reg.sigma.mean(1))
         log.info(self.net.reg.sigma[0])
         # Compute word prediction loss and accuracy
@@ -282,6 +340,7 @@ class Trainer(object):
 
     def _compute_kl_div_loss(self, mu, logvar):
         #return 0.5 * torch.sum(mu**2 + sigma**2 - torch.log(sigma**2) - 1)
+        mu, logvar = mu.float(), logvar.float()  # fp32 under autocast too
         return 0.5 * torch.sum(mu**2 + logvar.exp() - logvar - 1, 1)
 
 
@@ -292,6 +351,7 @@ class Trainer(object):
 
     def _train_regularizer(self, batch, name="Reg_train"):
         self.net.set_modules_train_mode(True)
+        self.net.zero_grad_by_names('gen')
 
         # Build graph
         with torch.no_grad():
@@ -321,10 +381,10 @@ class Trainer(object):
         code_rev = self.net.gen(noise.detach())
         rev_dist = F.pairwise_distance(code_rev, code_real_var.detach(),
                                        p=2).mean() # NOTE code_real_var?
-        rev_dist.backward()
+        self.precision.backward(rev_dist)
         self.net.optim_gen.step()
 
-        self.net.set_modules_train_mode(True)
+        self.net.zero_grad_by_names('dec2')
         with torch.no_grad():
             embed = self.net.embed_w(batch.enc_src.id)
             code_real = self.net.enc.with_noise(embed, batch.enc_src.len)
@@ -335,7 +395,7 @@ class Trainer(object):
         gen_fake, gen_acc = self._recon_loss_and_acc_for_rnn(
             decoded.prob, batch.dec_tar.id, len(self.net.vocab_w))
 
-        gen_fake.backward()
+        self.precision.backward(gen_fake)
         self.net.optim_dec2.step()
 
         # code_enc_var = self.net.reg.with_directional_var(code_enc, code_diff)
@@ -353,13 +413,14 @@ class Trainer(object):
 
     def _train_generator(self, name="Gen_train"):
         self.net.set_modules_train_mode(True)
+        self.net.zero_grad_by_names('gen', 'disc')
 
         # Build graph
         noise = self.net.gen.get_noise()
         code_fake = self.net.gen(noise)
         self.net.disc.clamp_weights()
         disc_fake = self.net.disc(code_fake)
-        disc_fake.backward(self.pos_one)
+        self.precision.backward(disc_fake, self.pos_one)
         self.net.optim_gen.step()
 
         # noise_recon = self.net.rev(code_fake.detach())
@@ -374,6 +435,7 @@ class Trainer(object):
 
     def _train_code_vae(self, batch, name="Code_VAE_train"):
         self.net.set_modules_train_mode(True)
+        self.net.zero_grad_by_names('rev', 'gen')
 
         with torch.no_grad():
             embed = self.net.embed_w(batch.enc_src.id)
@@ -392,8 +454,7 @@ class Trainer(object):
         loss = loss_recon + loss_kl # * 0.01
         loss.backward()
 
-        self.net.optim_rev.step()
-        self.net.optim_gen.step()
+        self.net.step_optimizers_by_names('rev', 'gen')
 
         self.result.add(name, odict(
             loss_total=loss.item(),
@@ -405,6 +466,7 @@ class Trainer(object):
 
     def _train_dec2(self, batch, name="Dec2_train"):
         self.net.set_modules_train_mode(True)
+        self.net.zero_grad_by_names('dec2')
 
         with torch.no_grad():
             embed = self.net.embed_w(batch.enc_src.id)
@@ -417,7 +479,7 @@ class Trainer(object):
             decoded.prob, batch.dec_tar.id, len(self.net.vocab_w))
 
         gen_fake.backward()
-        self.net.dec2.clip_grad_norm_()
+        self.net.clip_grad_norm__by_names('dec2')
         self.net.optim_dec2.step()
 
         self.result.add(name, odict(
@@ -428,6 +490,7 @@ class Trainer(object):
 
     def _train_regularizer2(self, batch, name="Reg_train"):
         self.net.set_modules_train_mode(True)
+        self.net.zero_grad_by_names('embed_w', 'enc', 'reg', 'disc')
 
         embed = self.net.embed_w(batch.enc_src.id)
         enc_h = self.net.enc(embed, batch.enc_src.len)
@@ -446,6 +509,7 @@ class Trainer(object):
 
     def _train_discriminator(self, batch, name="Disc_train"):
         self.net.set_modules_train_mode(True)
+        self.net.zero_grad_by_names('disc')
 
         # Code generation
         embed = self.net.embed_w(batch.enc_src.id)
@@ -470,8 +534,8 @@ class Trainer(object):
         #code_neg.register_hook(self.hook_pos.pass_smaller_abs_grad)
 
         # WGAN backward
-        disc_real.backward(self.pos_one)
-        disc_fake.backward(self.neg_one)
+        self.precision.backward(disc_real, self.pos_one)
+        self.precision.backward(disc_fake, self.neg_one)
         # loss_total.backward()
         #self.net.optim_reg_ae.step()
         self.net.optim_disc.step()
@@ -513,7 +577,7 @@ class Trainer(object):
         ))
 
         # Evaluation
-        scores = evaluate_sents(self.test_sents, decoded.get_text())
+        scores = evaluate_sents(self.test_index, decoded.get_text())
         self.result.add("Evaluation", scores)
 
 
@@ -561,16 +625,32 @@ class Trainer(object):
             txt_word1=decoded1.get_text(),
             txt_word2=decoded2.get_text(),
         ))
+        self.result.add(name + '_diversity',
+                        self.diversity.compute(decoded1.id.ids_array))
+
+        self.latent.update_fake(code_fake)
+        self.result.add('Latent', self.latent.compute())
 
         # Evaluation
-        #scores = evaluate_sents(self.test_sents, decoded.get_text())
+        #scores = evaluate_sents(self.test_index, decoded.get_text())
         #self.result.add("Evaluation", scores)
 
+    def _eval_latent(self, batch, name='Latent'):
+        """Latent metrics only, when text evaluation runs asynchronously
+        (same modes as _eval_autoencoder and _generate_text)"""
+        with torch.no_grad():
+            self.net.set_modules_train_mode(False)
+            embed = self.net.embed_w(batch.enc_src.id)
+            enc_h = self.net.enc(embed, batch.enc_src.len)
+            self.latent.update_real(self.net.reg.with_var(enc_h))
+            self.net.set_modules_train_mode(True)
+            self.latent.update_fake(self.net.gen.for_eval())
+        self.result.add(name, self.latent.compute())
+
     def _get_interpolated_z(self, num_samples):
         # sample 2 points and compute the distance btwn them
-        z_a = np.random.normal(0, 1, (1, self.cfg.z_size))
-        z_b = np.random.normal(0, 1, (1, self.cfg.z_size))
+        z_a, z_b = rng.normal('interp', (2, 1, self.cfg.z_size),
+                              device=self.cfg.device, dtype=self.cfg.dtype)
         # get intermediate points by interpolation
         offset = (z_b - z_a) / num_samples
-        z = np.vstack([z_a + offset * i for i in range(num_samples)])
-        return to_gpu(self.cfg.cuda, Variable(torch.FloatTensor(z)))
+        return torch.cat([z_a + offset * i for i in range(num_samples)])
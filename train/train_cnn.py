@@ -11,7 +11,7 @@ from torch.autograd import Variable
 
 from models.decoder import WordIdTranscriber
 from test.evaluate import evaluate_sents
-from train.train_helper import load_test_data, mask_output_target
+from train.train_helper import load_test_index, mask_output_target
 from train.supervisor import TrainingSupervisor
 from utils.writer import ResultWriter
 from utils.utils import set_random_seed, to_gpu
@@ -29,7 +29,7 @@ class Trainer(object):
         self.cfg = net.cfg
         #self.fixed_noise = net.gen.make_noise_size_of(net.cfg.eval_size)
 
-        self.test_sents = load_test_data(net.cfg)
+        self.test_index = load_test_index(net.cfg)
         self.pos_one = to_gpu(net.cfg.cuda, torch.FloatTensor([1]))
         self.neg_one = self.pos_one * (-1)
 
@@ -236,5 +236,5 @@ class Trainer(object):
             ))
 
         # Evaluation
-        scores = evaluate_sents(self.test_sents, decoded.get_text())
+        scores = evaluate_sents(self.test_index, decoded.get_text())
         self.result.add("Evaluation", scores)
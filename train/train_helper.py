@@ -5,6 +5,7 @@ import os
 import torch
 from torch.autograd import Variable
 
+from test.evaluate import ReferenceIndex
 from utils.utils import to_gpu
 
 log = logging.getLogger('main')
@@ -52,7 +53,7 @@ class GradientTransferHook(object):
 
     def stash_grad(self, grad):
         self._saved_grad = grad
-        return Variable(torch.zeros(*grad.size())).cuda()
+        return torch.zeros_like(grad)
 
     def transfer_grad(self, grad):
         return self._saved_grad
@@ -79,7 +80,7 @@ class SigmaHook(object):
 
     def stash_grad(self, grad):
         self._grad = grad.detach()#.abs()
-        return Variable(torch.zeros(*grad.size())).cuda()
+        return torch.zeros_like(grad)
 
     def compare_grad_with_stashed(self, grad):
         grad_a_pos = self._grad.gt(0)
@@ -294,6 +295,11 @@ def load_test_data(cfg):
             test_sents.append(line.strip())
     return test_sents
 
+def load_test_index(cfg):
+    """Test sentences normalized & counted once (see ReferenceIndex), to be
+    passed to evaluate_sents instead of the sentences"""
+    return ReferenceIndex.from_file(os.path.join(cfg.data_dir, 'test.txt'))
+
 def mask_sequence_with_n_inf(seqs, seq_lens):
     max_seq_len = seqs.size(1)
     masks = seqs.data.new(*seqs.size()).zero_()
@@ -307,12 +313,9 @@ def mask_sequence_with_n_inf(seqs, seq_lens):
 def to_one_hot(cfg, indices, num_class):
     size = indices.size()
     dim = len(size)
-    indices = torch.unsqueeze(indices.data, dim)
-    one_hot = torch.FloatTensor(*size, num_class).zero_()
-    if isinstance(indices, Variable):
-        one_hot = Variable(one_hot, requires_grad=False)
-    if cfg.cuda:
-        one_hot = to_gpu(cfg.cuda, one_hot)
+    indices = torch.unsqueeze(indices.detach(), dim)
+    # on the device of indices, rather than on CPU and then copied
+    one_hot = torch.zeros(*size, num_class, device=indices.device)
     one_hot.scatter_(dim, indices, 1.)
     return one_hot
 
@@ -133,6 +133,9 @@ parser.add_argument('--clip', type=float, default=1,
                     help='gradient clipping, max norm')
 parser.add_argument('--gan_clamp', type=float, default=0.01,
                     help='WGAN clamp')
+parser.add_argument('--gan_clamp_after_step', type=str2bool, default=False,
+                    help='clamp critic weights after its optimizer steps '
+                         'instead of before every forward')
 parser.add_argument('--backprop_gen', type=str2bool, default=False,
                     help='enable backpropagation gradient from disc_s to gen')
 parser.add_argument('--disc_s_hold', type=int, default=15,
@@ -155,6 +158,41 @@ parser.add_argument('--N', type=int, default=5,
                     help='N-gram order for training n-gram language model')
 parser.add_argument('--log_interval', type=int, default=50,
                     help='interval to log autoencoder training results')
+parser.add_argument('--latent_decay', type=float, default=0.9,
+                    help='weight decay of older batches in the incremental '
+                         'estimates of latent metrics (1 for cumulative)')
+parser.add_argument('--latent_knn', type=int, default=5,
+                    help='k of k-NN precision/recall in the code space')
+parser.add_argument('--latent_rff', type=int, default=1024,
+                    help='number of random fourier features for latent MMD')
+parser.add_argument('--async_eval', type=str2bool, default=False,
+                    help='run reverse PPL evaluation in background processes')
+parser.add_argument('--async_eval_text', type=str2bool, default=False,
+                    help='run periodic autoencoder evaluation and text '
+                         'generation in background processes as well')
+parser.add_argument('--async_eval_workers', type=int, default=2,
+                    help='number of background evaluation processes')
+parser.add_argument('--async_eval_threads', type=int, default=1,
+                    help='number of torch threads per evaluation process')
+parser.add_argument('--ckpt_async', type=str2bool, default=True,
+                    help='write checkpoints in a background thread')
+parser.add_argument('--ckpt_keep', type=int, default=3,
+                    help='number of the latest checkpoints kept in '
+                         'log_dir/checkpoints')
+parser.add_argument('--ae_only', type=str2bool, default=False,
+                    help='train the autoencoder only (to be saved as a '
+                         'stage by --export_ae)')
+parser.add_argument('--init_from', type=str, default=None,
+                    metavar='STAGE', help='start training from a stage of '
+                    '--export_ae (name in out_dir/stages, or a file path)')
+parser.add_argument('--init_modules', type=str, default='embed_w,enc,reg,dec',
+                    help='modules loaded from --init_from')
+parser.add_argument('--init_freeze', type=str, default='embed_w,enc',
+                    help='modules of --init_modules kept fixed (shared '
+                         'between runs in memory), the others go on training')
+parser.add_argument('--fork', type=int, default=0, metavar='N',
+                    help='run N trainings from --init_from in parallel, as '
+                         '<name>_<i> with seed + i')
 
 # Test Arguments
 #parser.add_argument('--test', type=bool, default=False, help='pass True to enter test session')
@@ -165,7 +203,140 @@ parser.add_argument('--log_level', type=str, default='debug')
 parser.add_argument('--seed', type=int, default=1111,
                     help='random seed')
 parser.add_argument('--cuda', type=str2bool, default=True, help='use CUDA')
+parser.add_argument('--precision', type=str, default='fp32',
+                    choices=['fp32', 'bf16', 'fp16'],
+                    help='precision of training phases (autocast, with '
+                         'dynamic loss scaling for fp16)')
+parser.add_argument('--distributed', type=str2bool, default=False,
+                    help='data-parallel training over processes with gloo '
+                         '(launch with launch_ddp.sh)')
+parser.add_argument('--num_threads', type=int, default=0,
+                    help='intra-op threads per rank of --distributed '
+                         '(0: cores of the machine / its ranks)')
+parser.add_argument('--bench_steps', type=int, default=0,
+                    help='train this many steps only and add the throughput '
+                         'to log_dir/scaling.json (see launch_ddp.sh)')
 parser.add_argument('--log_nsample', type=int, default=4)
 parser.add_argument('--test', action='store_true', help='run test mode')
 parser.add_argument('--visualize', action='store_true',
                     help='run visualize mode')
+parser.add_argument('--quantize', type=str2bool, default=False,
+                    help='dynamic int8 quantization of LSTM & Linear layers '
+                         'for CPU inference (--generate, --serve, --test, '
+                         '--visualize)')
+parser.add_argument('--quant_report', action='store_true',
+                    help='compare int8 quantized modules with fp32 ones on '
+                         'a held-out batch')
+parser.add_argument('--profile_startup', action='store_true',
+                    help='log import & initialization time of each phase '
+                         'of startup')
+parser.add_argument('--encode', type=str, default=None,
+                    choices=['train', 'test'],
+                    help='encode the whole corpus into a memory-mapped '
+                         'code file in log_dir')
+parser.add_argument('--encode_batch_size', type=int, default=1024,
+                    help='batch size of corpus encoding')
+parser.add_argument('--encode_workers', type=int, default=4,
+                    help='number of data loading processes for encoding')
+parser.add_argument('--encode_fp16', type=str2bool, default=False,
+                    help='store encoded codes as float16')
+parser.add_argument('--export_bundle', type=str, default=None,
+                    metavar='PATH', help='save vocab, configs and weights in '
+                                         'log_dir as a single inference file')
+parser.add_argument('--export_ae', type=str, default=None, metavar='NAME',
+                    help='save the autoencoder of the latest checkpoint in '
+                         'log_dir as a stage (out_dir/stages/NAME.ckpt)')
+parser.add_argument('--archive_ckpt', type=str, default=None,
+                    metavar='PATH', help='save the latest checkpoint in '
+                                         'log_dir with fp16 tensors')
+parser.add_argument('--bundle', type=str, default=None, metavar='PATH',
+                    help='load --generate/--serve models from this bundle '
+                         'instead of log_dir and prepro_dir')
+parser.add_argument('--generate', type=int, default=0, metavar='N',
+                    help='generate N sentences to a text file and exit')
+parser.add_argument('--out', type=str, default=None,
+                    help='output file of --generate '
+                         '(default: log_dir/generated.txt)')
+parser.add_argument('--gen_batch_size', type=int, default=1000,
+                    help='batch size of --generate')
+parser.add_argument('--gen_threads', type=int, default=0,
+                    help='number of torch threads of --generate '
+                         '(0 for torch default)')
+parser.add_argument('--gen_decoder', type=str, default='dec',
+                    choices=['dec', 'dec2', 'student'],
+                    help='decoder used by --generate')
+parser.add_argument('--distill', action='store_true',
+                    help='distill a trained decoder into a smaller student '
+                         'and report its speedup and quality deltas')
+parser.add_argument('--distill_teacher', type=str, default='dec',
+                    choices=['dec', 'dec2'], help='decoder to distill')
+parser.add_argument('--student_hidden', type=int, default=0,
+                    help='hidden size of the student decoder '
+                         '(0 for hidden_size_w)')
+parser.add_argument('--student_vocab', type=int, default=0,
+                    help='size of the shortlisted vocabulary of the student '
+                         '(0 for the whole vocabulary)')
+parser.add_argument('--distill_loss', type=str, default='token',
+                    choices=['token', 'seq'],
+                    help='token level KL or sequence level (NLL of the '
+                         'greedy outputs of the teacher)')
+parser.add_argument('--distill_temp', type=float, default=1.0,
+                    help='softmax temperature of the token level KL')
+parser.add_argument('--distill_steps', type=int, default=20000,
+                    help='number of distillation steps')
+parser.add_argument('--distill_lr', type=float, default=1e-03,
+                    help='learning rate of the student')
+parser.add_argument('--export_sampler', type=str, default=None,
+                    metavar='DIR', help='export noise -> generator -> greedy '
+                                        'decoding as static graphs to DIR')
+parser.add_argument('--sampler', type=str, default=None, metavar='DIR',
+                    help='use the sampler exported to DIR in --generate')
+parser.add_argument('--sampler_batch_sizes', type=str,
+                    default='16,64,256,1000',
+                    help='comma separated batch sizes to export the sampler '
+                         'for (include --gen_batch_size)')
+parser.add_argument('--sampler_bench', action='store_true',
+                    help='benchmark the exported sampler against eager '
+                         'decoding for each of --sampler_batch_sizes')
+parser.add_argument('--bench_iters', type=int, default=20,
+                    help='number of timed runs per benchmark case')
+parser.add_argument('--export_onnx', type=str, default=None, metavar='DIR',
+                    help='export encoder, generator and a decoder step as '
+                         'ONNX graphs to DIR and check their parity')
+parser.add_argument('--onnx_opset', type=int, default=18,
+                    help='ONNX opset version of --export_onnx')
+parser.add_argument('--check_onnx', type=str, default=None, metavar='DIR',
+                    help='check parity of ONNX graphs exported to DIR with '
+                         'the model (fails over --onnx_atol)')
+parser.add_argument('--onnx_parity', type=str2bool, default=True,
+                    help='check parity after --export_onnx (needs '
+                         'onnxruntime)')
+parser.add_argument('--onnx_atol', type=float, default=1e-4,
+                    help='max absolute difference of ONNX graph outputs '
+                         'from PyTorch (decoded ids must be the same)')
+parser.add_argument('--serve', type=str, default=None,
+                    choices=['stdio', 'http'],
+                    help='serve autoencode/sample/interpolate requests '
+                         'as json lines on stdin or http on localhost')
+parser.add_argument('--serve_port', type=int, default=8000,
+                    help='port of --serve http')
+parser.add_argument('--serve_max_batch', type=int, default=256,
+                    help='max number of sentences in a served batch')
+parser.add_argument('--serve_max_wait', type=float, default=5,
+                    help='max milliseconds a request waits to be batched')
+parser.add_argument('--nn_audit', action='store_true',
+                    help='find nearest training sentences of generated codes '
+                         '(needs codes from --encode train)')
+parser.add_argument('--index_type', type=str, default='ivfpq',
+                    choices=['exact', 'ivfpq'],
+                    help='nearest neighbour index over encoded codes')
+parser.add_argument('--index_nlist', type=int, default=1024,
+                    help='number of k-means clusters of ivfpq index')
+parser.add_argument('--index_nprobe', type=int, default=16,
+                    help='number of clusters scanned per ivfpq query')
+parser.add_argument('--index_pq_m', type=int, default=30,
+                    help='number of product quantizer subspaces '
+                         '(must divide hidden_size_w)')
+parser.add_argument('--index_rerank', type=int, default=10,
+                    help='re-rank k times this many ivfpq candidates with '
+                         'exact distances (0 to use PQ distances only)')
@@ -0,0 +1,72 @@
+"""Named random streams drawing noise directly on the device.
+
+Each noise source has a stream of its own (a torch.Generator per device),
+seeded from the global seed and the name of the stream. So noise is made
+where it is used, without host transfers, and a stream draws the same
+numbers however much the others have drawn (e.g. an extra evaluation
+doesn't shift the noise of training).
+
+    from utils.rng import rng
+    noise = rng.normal('gen', (batch_size, z_size), device=cfg.device)
+
+rng is seeded by utils.utils.set_random_seed. Until then, streams are
+seeded randomly.
+"""
+import zlib
+
+import torch
+
+
+class RandomStreams(object):
+    def __init__(self, seed=None):
+        self._seed = seed
+        self._generators = dict()
+
+    def seed(self, seed):
+        """Reseeds every stream (those already made start over)"""
+        self._seed = seed
+        self._generators.clear()
+
+    def generator(self, name, device='cpu'):
+        device = torch.device(device)
+        if device.type == 'cuda' and device.index is None:
+            device = torch.device('cuda', torch.cuda.current_device())
+        key = (name, str(device))
+        generator = self._generators.get(key)
+        if generator is None:
+            generator = torch.Generator(device=device)
+            if self._seed is None:
+                generator.seed()
+            else:
+                generator.manual_seed(self._stream_seed(name))
+            self._generators[key] = generator
+        return generator
+
+    def _stream_seed(self, name):
+        # crc32 rather than hash(), which is salted per process
+        return (self._seed * 1000003 + zlib.crc32(name.encode())) % 2**63
+
+    def normal(self, name, size, std=1., device='cpu', dtype=torch.float32):
+        noise = torch.randn(size, generator=self.generator(name, device),
+                            device=device, dtype=dtype)
+        if std != 1.:
+            noise.mul_(std)
+        return noise
+
+    def normal_like(self, name, tensor, std=1.):
+        return self.normal(name, tensor.size(), std, tensor.device,
+                           tensor.dtype)
+
+    def state_dict(self):
+        """Seed & states of the streams made so far (e.g. for checkpoints)"""
+        return dict(seed=self._seed, states={
+            key: generator.get_state()
+            for key, generator in self._generators.items()})
+
+    def load_state_dict(self, state_dict):
+        self.seed(state_dict['seed'])
+        for (name, device), state in state_dict['states'].items():
+            self.generator(name, device).set_state(state)
+
+
+rng = RandomStreams()
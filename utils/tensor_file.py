@@ -0,0 +1,105 @@
+"""Single file container of named tensors that can be memory-mapped.
+
+Layout : magic | header length (uint64) | pickled header | arrays.
+The header holds any picklable object given by the caller along with the
+dtype, shape and offset of each array. Arrays are aligned to 64 bytes, so
+that loading only maps the file and makes views into it.
+"""
+from collections import OrderedDict
+import os
+import pickle
+import struct
+
+import numpy as np
+import torch
+
+_MAGIC = b'ARAETNSR'
+_ALIGN = 64
+
+
+def _aligned(offset):
+    return (offset + _ALIGN - 1) // _ALIGN * _ALIGN
+
+
+def save_tensors(file_path, header, tensors):
+    """Args:
+        header: picklable object returned as it is by load_tensors
+        tensors (OrderedDict): name -> torch.Tensor or np.ndarray
+    """
+    arrays = OrderedDict()
+    for name, tensor in tensors.items():
+        if torch.is_tensor(tensor):
+            tensor = tensor.detach().cpu().numpy()
+        # (ascontiguousarray makes 0-d arrays 1-d)
+        arrays[name] = np.ascontiguousarray(tensor).reshape(tensor.shape)
+
+    layout = OrderedDict()
+    offset = 0
+    for name, array in arrays.items():
+        layout[name] = (array.dtype.str, array.shape, offset)
+        offset = _aligned(offset + array.nbytes)
+    header_bytes = pickle.dumps(dict(header=header, layout=layout),
+                                protocol=pickle.HIGHEST_PROTOCOL)
+    data_start = _aligned(len(_MAGIC) + 8 + len(header_bytes))
+
+    # temp file synced to disk & renamed, not to leave a broken file behind
+    # (even after a power loss)
+    temp_path = '%s.%d.tmp' % (file_path, os.getpid())
+    with open(temp_path, 'wb') as f:
+        f.write(_MAGIC)
+        f.write(struct.pack('<Q', len(header_bytes)))
+        f.write(header_bytes)
+        for name, array in arrays.items():
+            f.seek(data_start + layout[name][2])
+            f.write(array.tobytes())
+        f.truncate(data_start + offset)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(temp_path, file_path)
+    _fsync_dir(os.path.dirname(file_path))
+
+
+def _fsync_dir(dir_path):
+    # the rename itself is durable once its directory is synced
+    if not hasattr(os, 'O_DIRECTORY'):  # posix only
+        return
+    fd = os.open(dir_path or '.', os.O_RDONLY | os.O_DIRECTORY)
+    try:
+        os.fsync(fd)
+    finally:
+        os.close(fd)
+
+
+def load_header(file_path):
+    with open(file_path, 'rb') as f:
+        if f.read(len(_MAGIC)) != _MAGIC:
+            raise Exception('Not a tensor file : %s' % file_path)
+        header_len, = struct.unpack('<Q', f.read(8))
+        loaded = pickle.loads(f.read(header_len))
+    data_start = _aligned(len(_MAGIC) + 8 + header_len)
+    return loaded['header'], loaded['layout'], data_start
+
+
+def load_tensors(file_path, names=None, mmap=True):
+    """Returns the header and an OrderedDict of torch.Tensors.
+
+    With mmap, tensors are copy-on-write views of the mapped file : pages
+    are read from disk when touched and never written back.
+    names (optional) selects the tensors to load.
+    """
+    header, layout, data_start = load_header(file_path)
+    if mmap:
+        data = np.memmap(file_path, dtype=np.uint8, mode='c')
+    else:
+        data = np.fromfile(file_path, dtype=np.uint8)
+
+    tensors = OrderedDict()
+    for name, (dtype, shape, offset) in layout.items():
+        if names is not None and name not in names:
+            continue
+        dtype = np.dtype(dtype)
+        start = data_start + offset
+        count = int(np.prod(shape))
+        array = data[start:start+count*dtype.itemsize].view(dtype)
+        tensors[name] = torch.from_numpy(array.reshape(shape))
+    return header, tensors
@@ -1,7 +1,9 @@
+from contextlib import contextmanager
 import logging
 import numpy as np
 import os
 import random
+import sys
 from time import time, strftime, gmtime
 
 import torch
@@ -48,6 +50,45 @@ class StopWatch(object):
         log.info(msg + hms)
 
 
+class StartupProfiler(object):
+    """Times the startup of main.py phase by phase (--profile_startup).
+
+    mark(name) closes the phase started at the previous mark (or at start)
+    and records its duration and the number of modules imported during it.
+    """
+    # optional heavy dependencies worth knowing whether they were loaded
+    watched = ['spacy', 'tensorboardX', 'matplotlib', 'sklearn', 'scipy']
+
+    def __init__(self, enabled, start=None):
+        """start (optional): (time, len(sys.modules)) at the start"""
+        self.enabled = enabled
+        self.phases = []
+        if start is None:
+            start = (time(), len(sys.modules))
+        self._start, self._num_modules = start
+        self._last = self._start
+
+    def mark(self, name):
+        now = time()
+        num_modules = len(sys.modules)
+        self.phases.append((name, now - self._last,
+                            num_modules - self._num_modules))
+        self._last = now
+        self._num_modules = num_modules
+
+    def report(self):
+        if not self.enabled:
+            return
+        log.info('Startup profile :')
+        for name, seconds, num_modules in self.phases:
+            log.info('| %-20s | %8.3f secs | %5d modules |'
+                     % (name, seconds, num_modules))
+        log.info('| %-20s | %8.3f secs | %5d modules |'
+                 % ('total', self._last - self._start, len(sys.modules)))
+        loaded = [name for name in self.watched if name in sys.modules]
+        log.info('Loaded heavy modules : %s' % (', '.join(loaded) or 'none'))
+
+
 class Config(object):
     def __init__(self, init=None):
         if init is None:
@@ -60,7 +101,9 @@ class Config(object):
         architect = ConvnetArchitect(cfg)
         arch = architect.design_model_of(ConvnetType.AUTOENCODER)
         cfg.update(dict(arch_cnn=Config(arch)))
-        return cfg
+        # set by train.distributed.init_distributed with --distributed
+        cfg.update(dict(rank=0, world_size=1))
+        return set_device(cfg)
 
     def update(self, new_config):
         self.__dict__.update(new_config)
@@ -109,10 +152,16 @@ def set_logger(cfg):
     log_level = levels.get(cfg.log_level)
 
 
+    # only the main process of --distributed writes logs
+    if cfg.rank != 0:
+        log_level = logging.WARNING
+
     # setup file handler
-    file_handler = logging.FileHandler(cfg.log_path)
-    file_handler.setFormatter(formatter)
-    file_handler.setLevel(log_level)
+    file_handler = None
+    if cfg.rank == 0:
+        file_handler = logging.FileHandler(cfg.log_path)
+        file_handler.setFormatter(formatter)
+        file_handler.setLevel(log_level)
 
     # setup stdio handler
     stream_handler = logging.StreamHandler()
@@ -124,7 +173,8 @@ def set_logger(cfg):
     logger.setLevel(log_level)
 
     # add file & stdio handler to logger
-    logger.addHandler(file_handler)
+    if file_handler is not None:
+        logger.addHandler(file_handler)
     logger.addHandler(stream_handler)
 
 
@@ -179,17 +229,20 @@ def prepare_paths(cfg):
         cfg.pos_vocab_path = os.path.join(cfg.prepro_dir, "vocab_pos.pickle")
         
     # make dirs if not exists
-    if not os.path.exists(cfg.data_dir):
+    # (models loaded from a bundle need neither of them)
+    if not os.path.exists(cfg.data_dir) and not cfg.bundle:
         raise Exception("can't find data_dir: %s" % cfg.data_dir)
 
-    if not os.path.exists(cfg.glove_dir) and load_glove:
+    if (not os.path.exists(cfg.glove_dir) and cfg.load_glove
+            and not cfg.bundle):
         raise Exception("cant't find glove_dir: %s" % cfg.glove_dir)
 
+    # (exist_ok : ranks of --distributed make them at the same time)
     if not os.path.exists(cfg.log_dir): # this includes out_dir
-        os.makedirs(cfg.log_dir)
+        os.makedirs(cfg.log_dir, exist_ok=True)
 
     if not os.path.exists(cfg.prepro_dir):
-        os.makedirs(cfg.prepro_dir)
+        os.makedirs(cfg.prepro_dir, exist_ok=True)
 
 def sanity_check(cfg, strict=False):
 
@@ -203,11 +256,35 @@ def sanity_check(cfg, strict=False):
         inform_fn('cfg.load_glove is False, but trying fix_embed.')
 
 def set_random_seed(cfg):
-    random.seed(cfg.seed)
-    np.random.seed(cfg.seed)
-    torch.manual_seed(cfg.seed)
+    # ranks of --distributed draw different noise (and initial weights,
+    # which are broadcast from rank 0 afterwards)
+    from utils.rng import rng
+    seed = cfg.seed + cfg.rank
+    random.seed(seed)
+    np.random.seed(seed)
+    torch.manual_seed(seed)
+    rng.seed(seed)
     if cfg.cuda and torch.cuda.is_available():
-        torch.cuda.manual_seed(cfg.seed)
+        torch.cuda.manual_seed(seed)
+
+
+@contextmanager
+def main_process_first(cfg):
+    """Other ranks of --distributed wait until the main process is done
+    (e.g. with preprocessing, to reuse its files)"""
+    if cfg.world_size > 1 and cfg.rank != 0:
+        torch.distributed.barrier()
+    yield
+    if cfg.world_size > 1 and cfg.rank == 0:
+        torch.distributed.barrier()
+
+
+def set_device(cfg):
+    """cfg.device & cfg.dtype : where and in which type modules allocate
+    their tensors, directly instead of on CPU and then copied"""
+    device = torch.device('cuda' if cfg.cuda else 'cpu')
+    cfg.update(dict(device=device, dtype=torch.float32))
+    return cfg
 
 
 def to_gpu(gpu, var):
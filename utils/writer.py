@@ -2,8 +2,6 @@ from collections import OrderedDict, namedtuple
 import logging
 import os
 
-from tensorboardX import SummaryWriter
-from tensorboardX.embedding import make_sprite
 import torch
 
 log = logging.getLogger('main')
@@ -14,7 +12,9 @@ class ResultWriter(object):
 
     def __init__(self, cfg):
         filename = os.path.join(cfg.log_dir, 'tf_events')
-        self._writer = MySummaryWriter(filename)
+        self._writer = None  # other ranks of --distributed don't write
+        if cfg.rank == 0:
+            self._writer = _my_summary_writer_class()(filename)
         self.initialize_scalar_text()
         self.initialize_embedding()
 
@@ -39,6 +39,18 @@ class ResultWriter(object):
                 raise Exception('Unknown type : %s' % type(value))
         self._scalar_text.update({label: scalar_text_pack})
 
+    def add_at(self, step, label, dict_):
+        """Log & save results that were computed apart from the current step
+        (e.g. by asynchronous workers) tagged with their originating step."""
+        pack = ScalarTextPack()
+        pack.add(dict_)
+        header = "| %s (step %d) |" % (label, step)
+        log.info(header + self._str_scalar_in_pack(pack))
+        for name, scalar in pack.named_scalar():
+            self._writer.add_scalar("%s/%s" % (label, name), scalar, step)
+        for name, text in pack.named_text():
+            self._writer.add_text("%s/%s" % (label, name), text, step)
+
     def _str_scalar_in_pack(self, pack):
         outstr = ""
         for name, scalar in pack.named_scalar():
@@ -131,50 +143,66 @@ class ScalarTextPack(object):
             yield name, value
 
 
-class MySummaryWriter(SummaryWriter):
-    def __init__(self, *inputs):
-        super(MySummaryWriter, self).__init__(*inputs)
-        self.added_embedding_checklist = []
-
-    def add_embedding(self, mat, metadata=None, label_img=None,
-                      global_step=None, tag='default'):
-        """Override make_tsv function in order to handle multi-column tsv file.
-
-        Args(changed):
-            metadata (dict): Keys -> headers of metadata
-                             Values -> values of metatdata
-        """
-        if global_step is None:
-            global_step = 0
-
-        logdir = self.file_writer.get_logdir()
-        step = str(global_step).zfill(8)
-        save_path = os.path.join(logdir, tag, step)
-
-        try:
-            os.makedirs(save_path)
-        except OSError:
-            pass
-            # to control log level
-            #log.warning('warning: Embedding dir exists, '
-            #             'did you set global_step for add_embedding()?')
-
-        if metadata is not None:
-            assert all(mat.size(0) == len(d) for d in metadata.values()), \
-                   '#labels should equal with #data points'
-            append_tsv(metadata, save_path)
-
-        if label_img is not None:
-            assert mat.size(0) == label_img.size(0), \
-                  '#images should equal with #data points'
-            make_sprite(label_img, save_path)
-
-        assert mat.dim() == 2, \
-               'mat should be 2D and mat.size(0) is the number of data points'
-        append_mat(mat.tolist(), save_path)
-        # new funcion to append to the config file a new embedding
-        append_pbtxt(self.added_embedding_checklist,
-                     metadata, label_img, logdir, step, tag)
+_MySummaryWriter = None
+
+
+def _my_summary_writer_class():
+    """tensorboardX is imported only when a ResultWriter is created, not to
+    load it in the modes that never write summaries (generate, serve, ..)"""
+    global _MySummaryWriter
+    if _MySummaryWriter is not None:
+        return _MySummaryWriter
+    from tensorboardX import SummaryWriter
+    from tensorboardX.embedding import make_sprite
+
+    class MySummaryWriter(SummaryWriter):
+        def __init__(self, *inputs):
+            super(MySummaryWriter, self).__init__(*inputs)
+            self.added_embedding_checklist = []
+
+        def add_embedding(self, mat, metadata=None, label_img=None,
+                          global_step=None, tag='default'):
+            """Override make_tsv function in order to handle multi-column
+            tsv file.
+
+            Args(changed):
+                metadata (dict): Keys -> headers of metadata
+                                 Values -> values of metatdata
+            """
+            if global_step is None:
+                global_step = 0
+
+            logdir = self.file_writer.get_logdir()
+            step = str(global_step).zfill(8)
+            save_path = os.path.join(logdir, tag, step)
+
+            try:
+                os.makedirs(save_path)
+            except OSError:
+                pass
+                # to control log level
+                #log.warning('warning: Embedding dir exists, '
+                #             'did you set global_step for add_embedding()?')
+
+            if metadata is not None:
+                assert all(mat.size(0) == len(d) for d in metadata.values()), \
+                       '#labels should equal with #data points'
+                append_tsv(metadata, save_path)
+
+            if label_img is not None:
+                assert mat.size(0) == label_img.size(0), \
+                      '#images should equal with #data points'
+                make_sprite(label_img, save_path)
+
+            assert mat.dim() == 2, ('mat should be 2D and mat.size(0) is '
+                                    'the number of data points')
+            append_mat(mat.tolist(), save_path)
+            # new funcion to append to the config file a new embedding
+            append_pbtxt(self.added_embedding_checklist,
+                         metadata, label_img, logdir, step, tag)
+
+    _MySummaryWriter = MySummaryWriter
+    return _MySummaryWriter
 
 
 def append_tsv(metadata, save_path):